@@ -1,10 +1,21 @@
 import os
 import sys
 sys.path.append(os.getcwd())
+import re
+import json
+import tempfile
+import numpy as np
 import pysam
-from collections import defaultdict
-from itertools import groupby
-from genomic_interval import Interval
+from collections import defaultdict, OrderedDict
+from itertools import groupby, chain
+from functools import lru_cache
+from twobit import load_genome
+from junction_graph import load_junctions
+from annotation_index import load_index
+
+CIGAR_RE = re.compile(r'(\d+)(\D)')
+# fusion fragments farther apart are not paired, longer than any circRNA
+WINDOW = 10000000
 
 
 class Segment(object):
@@ -13,90 +24,213 @@ class Segment(object):
     '''
     def __init__(self, pos, cigar):
         self.ref_start = int(pos) - 1
-        self.ref_end = self.ref_start
-        read_consuming_ops = ("M", "I")
-        ref_consuming_ops = ("M", "D")
-        cig_iter = groupby(cigar, lambda c: c.isdigit())
-        self.read_start, self.read_end = 0, 0
-        for i, (g, n) in enumerate(cig_iter):
-            counts, tag = int("".join(n)), "".join(next(cig_iter)[1])
-            if i == 0 and tag == 'S':
-                self.read_start += counts
-                self.read_end += counts
-            if tag in read_consuming_ops:
-                self.read_end += counts
-            if tag in ref_consuming_ops:
-                self.ref_end += counts
-
-
-def parse_fusion_bam(bam_f, pair_flag):
-    fusions = {}
+        self.read_start, self.read_end, ref_span = decode_cigar(cigar)
+        self.ref_end = self.ref_start + ref_span
+
+
+@lru_cache(maxsize=65536)
+def decode_cigar(cigar):
+    '''
+    (read_start, read_end, ref_span) of CIGAR string for Segment, only a
+    leading soft clip is counted in read_start. Recurrent CIGAR strings are
+    decoded once.
+    '''
+    read_start, read_end, ref_span = 0, 0, 0
+    for i, (counts, tag) in enumerate(CIGAR_RE.findall(cigar)):
+        counts = int(counts)
+        if i == 0 and tag == 'S':
+            read_start += counts
+            read_end += counts
+        if tag in ('M', 'I'):  # read consuming
+            read_end += counts
+        if tag in ('M', 'D'):  # reference consuming
+            ref_span += counts
+    return (read_start, read_end, ref_span)
+
+
+def decode_cigars(cigars):
+    '''
+    Batch decode_cigar for many CIGAR strings
+    Return (read_start, read_end, ref_span) arrays
+    '''
+    if not len(cigars):
+        return tuple(np.zeros(0, np.int64) for _ in range(3))
+    uniq, inverse = np.unique(np.asarray(cigars, dtype=str),
+                              return_inverse=True)
+    offsets = np.array([decode_cigar(x) for x in uniq.tolist()], np.int64)
+    offsets = offsets[inverse.reshape(-1)]
+    return (offsets[:, 0], offsets[:, 1], offsets[:, 2])
+
+
+@lru_cache(maxsize=65536)
+def decode_alignment(cigar):
+    '''
+    (query_alignment_start, query_alignment_end, reference span) of CIGAR
+    string, same as pysam
+    '''
+    read_start, read_end, ref_span = 0, 0, 0
+    clip_flag = True  # leading clips
+    for counts, tag in CIGAR_RE.findall(cigar):
+        counts = int(counts)
+        if tag == 'S' and clip_flag:
+            read_start += counts
+            read_end += counts
+        elif tag != 'H':
+            clip_flag = False
+        if tag in 'MI=X':
+            read_end += counts
+        if tag in 'MDN=X':
+            ref_span += counts
+    return (read_start, read_end, ref_span)
+
+
+class FusionPairs(object):
+    '''
+    Class: FusionPairs
+
+    Usage: pairs = FusionPairs(max_pending)
+           pairs.add(qname, fragment) -> first fragment if paired else None
+           pairs.evict(pos) -> drop first fragments starting before pos
+           pairs.flush() -> pair spilled fragments and reset
+
+    Notes: a first fragment is kept until a fragment of the same read on the
+           same chromosome and strand arrives, then it is evicted. The
+           oldest first fragments are spilled to a temporary file when more
+           than max_pending are kept, and they are paired again by flush.
+    '''
+    def __init__(self, max_pending=None):
+        self.max_pending = max_pending
+        self.pending = OrderedDict()
+        self.spill = None
+
+    def add(self, qname, fragment):
+        first = self.pending.get(qname)
+        if first is None:  # first fragment
+            self.pending[qname] = fragment
+            if self.max_pending and len(self.pending) > self.max_pending:
+                self._spill(len(self.pending) // 2)
+            return None
+        if fragment[:2] == first[:2]:  # same chromosome and strand
+            del self.pending[qname]
+            return first
+        return None
+
+    def evict(self, pos):
+        while self.pending:
+            qname, first = next(iter(self.pending.items()))
+            if first[2] >= pos:
+                break
+            del self.pending[qname]
+
+    def _spill(self, num):
+        if self.spill is None:
+            self.spill = tempfile.TemporaryFile(mode='w+')
+        for _ in range(num):
+            self.spill.write(json.dumps(self.pending.popitem(last=False)))
+            self.spill.write('\n')
+
+    def flush(self):
+        '''
+        Yield (fragment, first fragment) pairs of spilled fragments and drop
+        the unpaired ones.
+        '''
+        pending, spill = self.pending, self.spill
+        self.pending, self.spill = OrderedDict(), None
+        if spill is None:
+            return
+        spill.seek(0)
+        replay = FusionPairs()
+        # spilled fragments are older than the kept ones
+        for qname, fragment in chain((json.loads(x) for x in spill),
+                                     pending.items()):
+            first = replay.add(qname, fragment)
+            if first is not None:
+                yield (fragment, first)
+        spill.close()
+
+
+def fusion_fragment(read, pair_flag):
+    if not read.has_tag('XF'):  # not fusion junctions
+        return None
+    if pair_flag is True and not read.has_tag('XP'):
+        return None
+    chr1, chr2 = read.get_tag('XF').split()[1].split('-')
+    if chr1 != chr2:  # not on the same chromosome
+        return None
+    strand = '+' if not read.is_reverse else '-'
+    if pair_flag is True:
+        xp_info = read.get_tag('XP')
+    else:
+        xp_info = ''
+    return [chr1, strand, read.reference_start, read.reference_end, xp_info]
+
+
+def parse_fusion_bam(bam_f, pair_flag, window=WINDOW, max_pending=1000000,
+                     chrom=None):
+    '''
+    Yield the two fragments of each fusion read one after another (only
+    reads on chrom if chrom is set).
+    Coordinate-sorted bam is paired within each chromosome (and within
+    window bp unless window is None), fragments spilled over max_pending are
+    paired at the end of the chromosome. Name-sorted bam is paired read by
+    read without an index.
+    '''
     bam = pysam.Samfile(bam_f, 'rb')
-    for read in bam.fetch():
+    header = bam.header
+    if hasattr(header, 'to_dict'):
+        header = header.to_dict()
+    if header.get('HD', {}).get('SO') == 'queryname':
+        reads = bam.fetch(until_eof=True)
+        for qname, group in groupby(reads, lambda x: x.qname):
+            pairs = FusionPairs()
+            for read in group:
+                if read.is_secondary:  # not the primary alignment
+                    continue
+                fragment = fusion_fragment(read, pair_flag)
+                if fragment is None:
+                    continue
+                first = pairs.add(qname, fragment)
+                if first is not None:
+                    yield fragment
+                    yield first
+        bam.close()
+        return
+    pairs = FusionPairs(max_pending)
+    chrom_id = None
+    for read in bam.fetch(chrom):
         if read.is_secondary:  # not the primary alignment
             continue
-        #if not read.has_tag('XF'):  # not fusion junctions
-            continue
-        #if pair_flag is True and not read.has_tag('XP'):
+        if read.reference_id != chrom_id:  # fragments of previous chromosome
+            for fragment, first in pairs.flush():
+                yield fragment
+                yield first
+            chrom_id = read.reference_id
+        elif window is not None:
+            pairs.evict(read.reference_start - window)
+        fragment = fusion_fragment(read, pair_flag)
+        if fragment is None:
             continue
-
-        chr1, chr2 = read.get_tag('XF').split()[1].split('-')
-        if chr1 != chr2:  # not on the same chromosome
-            continue
-        strand = '+' if not read.is_reverse else '-'
-
-        if pair_flag is True:
-            xp_info = read.get_tag('XP')
-        else:
-            xp_info = ''
-
-        if read.qname not in fusions:  # first fragment
-            fusions[read.qname] = [chr1, strand, read.reference_start,
-                                        read.reference_end, xp_info]
-        else:  # second fragment
-            if chr1 == fusions[read.qname][0] \
-               and strand == fusions[read.qname][1]:
-                yield [chr1, strand, read.reference_start, read.reference_end,
-                       xp_info]
-                yield fusions[read.qname]
+        first = pairs.add(read.qname, fragment)
+        if first is not None:  # second fragment
+            yield fragment
+            yield first
+    for fragment, first in pairs.flush():
+        yield fragment
+        yield first
     bam.close()
 
 
 def parse_ref(ref_file, flag):
+    '''
+    flag 1: (genes, novel_genes, gene_info, chrom_info)
+    flag 2: {'gene\tiso\tchrom\tstrand': [starts, ends]}
+    Both are served from the binary annotation index of ref_file.
+    '''
+    index = load_index(ref_file)
     if flag == 1:
-        genes = defaultdict(list)
-        novel_genes = defaultdict(list)
-        gene_info = {}
-        chrom_info = set()
-    else:
-        genes = {}
-    with open(ref_file, 'r') as f:
-        for line in f:
-            gene_id, iso_id, chrom, strand = line.split()[:4]
-            total_id = '\t'.join(['iso', gene_id, iso_id, chrom, strand])
-            starts = [int(x) for x in line.split()[9].rstrip(',').split(',')]
-            ends = [int(x) for x in line.split()[10].rstrip(',').split(',')]
-            start = starts[0]
-            end = ends[-1]
-            if flag == 1:
-                if iso_id.startswith('CUFF'):
-                    novel_genes[chrom].append([start, end, total_id])
-                else:
-                    genes[chrom].append([start, end, total_id])
-                gene_info[total_id] = [starts, ends]
-            else:
-                genes['\t'.join([gene_id, iso_id, chrom, strand])] = [starts,
-                                                                      ends]
-    if flag == 1:
-        for chrom in genes:
-            genes[chrom] = Interval(genes[chrom])
-            chrom_info.add(chrom)
-        for chrom in novel_genes:
-            novel_genes[chrom] = Interval(novel_genes[chrom])
-            chrom_info.add(chrom)
-        return (genes, novel_genes, gene_info, chrom_info)
+        return index.gene_blocks()
     else:
-        return genes
+        return index.exon_table()
 
 
 def parse_bed(fus):
@@ -115,46 +249,18 @@ def parse_bed(fus):
 
 
 def parse_junc(junc_f, flag=0):
-    junc = defaultdict(int)
-    if flag == 1:
-        left_junc = defaultdict(list)
-        right_junc = defaultdict(list)
-    elif flag == 2:
-        left_junc = defaultdict(int)
-        right_junc = defaultdict(int)
-    with open(junc_f, 'r') as f:
-        f.readline()  # skip header
-        for line in f:
-            chrom = line.split()[0]
-            start = int(line.split()[1])
-            reads = int(line.split()[4])
-            size = int(line.split()[10].split(',')[0])
-            offset = int(line.split()[11].split(',')[1])
-            left = str(start + size)
-            right = str(start + offset)
-            junc_id = '\t'.join([chrom, left, right])
-            junc[junc_id] += reads
-            if flag == 1:
-                left_junc_id = '\t'.join([chrom, left])
-                right_junc_id = '\t'.join([chrom, right])
-                left_junc[left_junc_id].append([right, reads])
-                right_junc[right_junc_id].append([left, reads])
-            if flag == 2:
-                left_junc_id = '\t'.join([chrom, left])
-                right_junc_id = '\t'.join([chrom, right])
-                left_junc[left_junc_id] += reads
-                right_junc[right_junc_id] += reads
-    if flag:
-        return (junc, left_junc, right_junc)
-    else:
-        return junc
+    return load_junctions(junc_f).as_flag(flag)
 
 
 def check_fasta(fa_f, pysam_flag=True):
     if not os.path.isfile(fa_f + '.fai'):
         pysam.faidx(fa_f)
-    if pysam_flag:  # return pysam FastaFile object
-        fa = pysam.FastaFile(fa_f)
+    if pysam_flag:  # return 2-bit genome with FastaFile fetch interface
+        try:
+            fa = load_genome(fa_f)
+        except (IOError, OSError):
+            print('Warning: cannot pack %s, use FASTA index!' % fa_f)
+            fa = pysam.FastaFile(fa_f)
         return fa
     else:  # return fasta file path
         return fa_f
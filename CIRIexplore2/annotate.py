@@ -12,12 +12,28 @@ Options:
     --no-fix                       No-fix mode (useful for species \
 with poor gene annotations).
     --low-confidence               Extract low confidence circRNAs.
+    --tabix                        Also write sorted and BGZF-compressed \
+output with tabix index (<output>.gz).
+    --spill                        Keep annotated junctions in a private \
+temporary directory instead of memory.
+    -p THREAD --thread=THREAD      Running threads. [default: 1]
+    --cache=CACHE                  Junction result cache directory, only \
+new junctions are annotated and realigned.
 '''
 
 import os
-from genomic_interval import Interval
+import json
+import pickle
+import shutil
+import hashlib
+import tempfile
+from multiprocessing import Pool
+from annotation_index import load_index
+from interval_array import IntervalArray
+from file_func import fingerprint
 from parser import parse_ref, parse_bed, check_fasta
-from helper import logger, map_fusion_to_iso, fix_bed, generate_bed
+from helper import logger, map_block, fix_bed, generate_bed, Candidate
+from sorted_output import index_bed
 from collections import defaultdict
 
 __author__ = [
@@ -27,119 +43,448 @@ __author__ = [
 
 __all__ = ['annotate']
 
+CACHE_VERSION = 3  # format of junction result cache files
+
+_fix_context = {}  # annotation and genome of fix_shard in this process
+
 
 @logger
 def annotate(options):
-    # annotate fusion junctions
-    annotate_fusion(options['--ref'], options['--bed'],
-                    secondary_flag=options['--low-confidence'])
-    # fix fusion juncrions
-    fix_fusion(options['--ref'], options['--genome'], options['--output'],
-               options['--no-fix'], secondary_flag=options['--low-confidence'])
+    thread = int(options['--thread'])
+    if options['--cache']:  # incremental annotation
+        cached_fusion(options['--ref'], options['--genome'], options['--bed'],
+                      options['--output'], options['--no-fix'],
+                      options['--cache'],
+                      secondary_flag=options['--low-confidence'],
+                      thread=thread)
+    else:
+        # annotate fusion junctions
+        candidates = annotate_fusion(options['--ref'], options['--bed'],
+                                     secondary_flag=options[
+                                         '--low-confidence'],
+                                     spill_flag=options['--spill'],
+                                     thread=thread)
+        # fix fusion juncrions
+        fix_fusion(options['--ref'], options['--genome'],
+                   options['--output'], options['--no-fix'], candidates,
+                   secondary_flag=options['--low-confidence'], thread=thread)
+    if options['--tabix']:
+        outputs = [options['--output']]
+        if options['--low-confidence']:
+            outputs.append('low_conf_%s' % options['--output'])
+        print('Write sorted and indexed %s!' %
+              ', '.join(index_bed(x) for x in outputs))
+
+
+class CandidateStore(object):
+    '''
+    Class: CandidateStore
+
+    Usage: candidates = CandidateStore(spill_flag)
+           candidates.add(candidate)
+           for candidate in candidates: ...
+           candidates.close()
+
+    Notes: annotated fusion junctions (helper.Candidate) are handed from
+           annotate_fusion to fix_fusion in memory, or through a file in a
+           private temporary directory in spill mode.
+    '''
+    def __init__(self, spill_flag=False):
+        self.records = []
+        self.num = 0
+        self.tmp_dir = None
+        if spill_flag:
+            self.tmp_dir = tempfile.mkdtemp(prefix='circ_annotate_')
+            self.spill = open('%s/candidates.txt' % self.tmp_dir, 'w')
+
+    def __len__(self):
+        return self.num
 
+    def add(self, candidate):
+        self.num += 1
+        if self.tmp_dir is None:
+            self.records.append(candidate)
+        else:
+            self.spill.write('\t'.join(str(x) for x in candidate) + '\n')
 
-def annotate_fusion(ref_f, junc_bed, secondary_flag=0, denovo_flag=0):
+    def __iter__(self):
+        if self.tmp_dir is None:
+            for candidate in self.records:
+                yield candidate
+            return
+        self.spill.close()
+        with open('%s/candidates.txt' % self.tmp_dir, 'r') as f:
+            for line in f:
+                chrom, start, end, reads, rest = line.split('\t', 4)
+                yield Candidate(chrom, int(start), int(end), int(reads),
+                                *rest.rstrip('\n').split('\t'))
+
+    def close(self):
+        self.records = []
+        if self.tmp_dir is not None:
+            self.spill.close()
+            shutil.rmtree(self.tmp_dir)
+            self.tmp_dir = None
+
+
+def annotate_fusion(ref_f, junc_bed, secondary_flag=0, denovo_flag=0,
+                    spill_flag=False, thread=1):
     """
     Align fusion juncrions to gene annotations
+    Return annotated fusion junctions as CandidateStore
     """
     print('Start to annotate fusion junctions...')
     # gene annotations
-    genes, novel_genes, gene_info, chrom_info = parse_ref(ref_f, 1)
+    ref_index = load_index(ref_f)
     fusion_bed = junc_bed
     fusions, fusion_index = parse_bed(fusion_bed)  # fusion junctions
     total = set()
-    annotated_fusion_f = 'annotated_fusion.txt.tmp'
-    with open(annotated_fusion_f, 'w') as outf:
-        for chrom in chrom_info:
-            # overlap gene annotations with fusion juncrions
-            result = []
-            # overlap genes
-            if chrom in genes:
-                result += Interval.overlapwith(genes[chrom].interval,
-                                               fusions[chrom])
-            # overlap novel genes in denovo mode
-            if denovo_flag and chrom in novel_genes:
-                result += Interval.overlapwith(novel_genes[chrom].interval,
-                                               fusions[chrom])
-            for itl in result:
-                # extract gene annotations
-                iso = list([x for x in itl[2:] if x.startswith('iso')])
-                # for each overlapped fusion junction
-                for fus in itl[(2 + len(iso)):]:
-                    reads = fus.split()[1]
-                    fus_start, fus_end = fusion_index[fus]
-                    fus_loc = '%s\t%d\t%d\tFUSIONJUNC/%s' % (chrom, fus_start,
-                                                             fus_end, reads)
-                    edge_annotations = []  # first or last exon flag
-                    secondary_exon = defaultdict(dict)  # secondary exons
-                    annotate_flag = 0
-                    for iso_id in iso:
-                        g, i, c, s = iso_id.split()[1:]
-                        start = gene_info[iso_id][0][0]
-                        end = gene_info[iso_id][-1][-1]
-                        # fusion junction excesses boundaries of gene
-                        # annotation
-                        if fus_start < start - 10 or fus_end > end + 10:
-                            if not secondary_flag:
-                                continue
-                        (fusion_info,
-                         index,
-                         edge,
-                         secondary) = map_fusion_to_iso(fus_start,
-                                                        fus_end, s,
-                                                        gene_info[iso_id])
-                        if fusion_info:
-                            annotate_flag += 1
-                            bed_info = '\t'.join([fus_loc, '0', s,
-                                                  str(fus_start),
-                                                  str(fus_start), '0,0,0'])
-                            bed = '\t'.join([bed_info, fusion_info, g, i,
-                                             index])
-                            if not edge:  # not first or last exon
-                                outf.write(bed + '\n')
-                                total.add(fus)
-                            else:  # first or last exon
-                                edge_annotations.append(bed)
-                        elif secondary_flag and secondary is not None:
-                            li, ri = secondary
-                            gene = ':'.join([g, s])
-                            if li is not None:
-                                li = str(li)
-                                secondary_exon['left'][gene] = ':'.join([i,
-                                                                         li])
-                            if ri is not None:
-                                ri = str(ri)
-                                secondary_exon['right'][gene] = ':'.join([i,
-                                                                          ri])
-                    if edge_annotations:
-                        for bed in edge_annotations:
-                            outf.write(bed + '\n')
-                        total.add(fus)
-                    if secondary_flag and not annotate_flag:
-                        for gene in secondary_exon['left']:
-                            if gene in secondary_exon['right']:
-                                left = secondary_exon['left'][gene]
-                                right = secondary_exon['right'][gene]
-                                g, s = gene.split(':')
-                                # for avoid dup, use fus_loc_new
-                                fus_loc_new = fus_loc + '\t0\t%s' % s
-                                outf.write('%s\t%s:%s\t%s:%s\n' % (fus_loc_new,
-                                                                   g, left, g,
-                                                                   right))
+    candidates = CandidateStore(spill_flag)
+    # contiguous junction ranges of each chromosome
+    size = shard_size(len(fusion_index), thread)
+    shards = [(ref_f, chrom, junctions, secondary_flag, denovo_flag)
+              for chrom in sorted(ref_index.chroms)
+              for junctions in split_shards(sorted(fusions[chrom]),
+                                            lambda x: x[:2], size)]
+    # candidates of known isoforms go before novel ones in each chromosome
+    novel_candidates, last_chrom = [], None
+    for shard, (shard_candidates, shard_novel,
+                shard_total) in zip(shards, pool_map(annotate_shard, shards,
+                                                     thread)):
+        if shard[1] != last_chrom:
+            for candidate in novel_candidates:
+                candidates.add(candidate)
+            novel_candidates, last_chrom = [], shard[1]
+        for candidate in shard_candidates:
+            candidates.add(candidate)
+        novel_candidates += shard_novel
+        total |= shard_total
+    for candidate in novel_candidates:
+        candidates.add(candidate)
     print('Annotated %d fusion junctions!' % len(total))
+    return candidates
+
+
+def annotate_shard(args):
+    '''
+    Annotate sorted fusion junctions of one chromosome
+    args: (ref_f, chrom, junctions, secondary_flag, denovo_flag)
+    Return ([Candidate, ...] of known isoforms, [Candidate, ...] of novel
+            isoforms, set of annotated junctions)
+    '''
+    ref_f, chrom, junctions, secondary_flag, denovo_flag = args
+    ref_index = load_index(ref_f)  # memory-mapped and shared by processes
+    candidates = []
+    novel_candidates = []  # novel isoforms only in denovo mode
+    total = set()
+    iso_cache = {}  # exon boundaries shared by nearby junctions
+    groups = [(ref_index.block_array(chrom), candidates)]
+    # overlap novel genes only in denovo mode
+    if denovo_flag:
+        groups.append((ref_index.block_array(chrom, True), novel_candidates))
+    # known and novel genes are annotated separately
+    for genes, group_candidates in groups:
+        # fusion junctions of each gene block (padded by 11bp) they are in
+        blocks = {}
+        for block, junction in IntervalArray.overlapjoin(genes, junctions):
+            if block[0] not in blocks:
+                blocks[block[0]] = (block[2:], [])
+            blocks[block[0]][1].append(junction)
+        for block_start in sorted(blocks):
+            iso, block_junctions = blocks[block_start]
+            total.update(annotate_block(ref_index, iso_cache, chrom,
+                                        block_junctions, iso, secondary_flag,
+                                        group_candidates))
+    return (candidates, novel_candidates, total)
+
+
+def annotate_block(ref_index, iso_cache, chrom, junctions, iso,
+                   secondary_flag, candidates):
+    '''
+    Append candidates of fusion junctions in one gene block mapped to its
+    isoforms iso
+    Return [annotated fusion junction, ...]
+    '''
+    fus_starts = [x[0] for x in junctions]
+    fus_ends = [x[1] for x in junctions]
+    isoforms = []
+    for iso_id in iso:
+        if iso_id not in iso_cache:
+            iso_cache[iso_id] = ref_index.exons(iso_id)
+        iso_info = iso_cache[iso_id]
+        g, i, c, s = ref_index.info(iso_id)
+        # all junctions of the block mapped to the isoform at once
+        isoforms.append((g, i, s, iso_info[0][0], iso_info[1][-1],
+                         map_block(fus_starts, fus_ends, s, iso_info)))
+    annotated = []
+    for n, (fus_start, fus_end, fus) in enumerate(junctions):
+        reads = int(fus.split()[1])
+        if annotate_iso(chrom, fus_start, fus_end, reads,
+                        [x[:5] + (x[5][n],) for x in isoforms],
+                        secondary_flag, candidates):
+            annotated.append(fus)
+    return annotated
+
+
+def annotate_iso(chrom, fus_start, fus_end, reads, isoforms, secondary_flag,
+                 candidates):
+    '''
+    Append candidates of one fusion junction mapped to isoforms
+    isoforms: [(gene, isoform, strand, start, end, map_fusion_to_iso
+                result), ...]
+    Return True if the junction is annotated
+    '''
+    edge_annotations = []  # first or last exon flag
+    secondary_exon = defaultdict(dict)  # secondary exons
+    annotate_flag = 0
+    annotated = False
+    for g, i, s, start, end, mapped in isoforms:
+        # fusion junction excesses boundaries of gene annotation
+        if fus_start < start - 10 or fus_end > end + 10:
+            if not secondary_flag:
+                continue
+        fusion_info, index, edge, secondary = mapped
+        if fusion_info:
+            annotate_flag += 1
+            flag = fusion_info.rsplit('\t', 1)[-1]  # circRNA/ciRNA
+            candidate = Candidate(chrom, fus_start, fus_end, reads,
+                                  s, flag, g, i, index)
+            if not edge:  # not first or last exon
+                candidates.append(candidate)
+                annotated = True
+            else:  # first or last exon
+                edge_annotations.append(candidate)
+        elif secondary_flag and secondary is not None:
+            li, ri = secondary
+            gene = ':'.join([g, s])
+            if li is not None:
+                li = str(li)
+                secondary_exon['left'][gene] = ':'.join([i, li])
+            if ri is not None:
+                ri = str(ri)
+                secondary_exon['right'][gene] = ':'.join([i, ri])
+    if edge_annotations:
+        candidates += edge_annotations
+        annotated = True
+    if secondary_flag and not annotate_flag:
+        for gene in secondary_exon['left']:
+            if gene in secondary_exon['right']:
+                left = secondary_exon['left'][gene]
+                right = secondary_exon['right'][gene]
+                g, s = gene.split(':')
+                candidates.append(Candidate(chrom, fus_start, fus_end,
+                                            reads, s, 'secondary',
+                                            '%s:%s' % (g, left),
+                                            '%s:%s' % (g, right), ''))
+    return annotated
+
+
+
+
+def shard_size(num, thread):
+    '''
+    Size of shards for thread processes, None for one shard per chromosome
+    '''
+    if thread <= 1:
+        return None
+    return max(num // (thread * 4), 1000)
+
+
+def split_shards(items, key, size=None):
+    '''
+    Split items into lists of about size items (all items if size is None),
+    consecutive items with the same key are kept in one list
+    '''
+    shard, last = [], None
+    for item in items:
+        item_key = key(item)
+        if size and len(shard) >= size and item_key != last:
+            yield shard
+            shard = []
+        shard.append(item)
+        last = item_key
+    if shard:
+        yield shard
+
 
+def pool_map(func, shards, thread=1):
+    '''
+    Map func over shards with thread processes, results are in order
+    '''
+    if thread <= 1:
+        for shard in shards:
+            yield func(shard)
+        return
+    pool = Pool(thread)
+    try:
+        for result in pool.imap(func, shards):
+            yield result
+    finally:
+        pool.close()
+        pool.join()
 
-def fix_fusion(ref_f, genome_fa, out_file, no_fix, secondary_flag=0,
-               denovo_flag=0):
+
+def fix_fusion(ref_f, genome_fa, out_file, no_fix, candidates,
+               secondary_flag=0, denovo_flag=0, thread=1):
     """
-    Realign fusion juncrions
+    Realign fusion juncrions annotated by annotate_fusion
     """
     print('Start to fix fusion junctions...')
-    fa = check_fasta(genome_fa)
+    ref = fix_context(ref_f, genome_fa)[0]
+    # candidates of the same junction are kept in one shard
+    size = shard_size(len(candidates), thread)
+    shards = ((ref_f, genome_fa, shard, no_fix, denovo_flag)
+              for shard in split_shards(candidates, lambda x: x[:3], size))
+    fusions = defaultdict(int)
+    fusion_names = []
+    fixed_flag = defaultdict(int)
+    for shard_fusions, shard_names, shard_fixed in pool_map(fix_shard, shards,
+                                                            thread):
+        for name in shard_names:
+            if name not in fusions:
+                fusion_names.append(name)
+            fusions[name] += shard_fusions[name]
+            if name in shard_fixed:
+                fixed_flag[name] += shard_fixed[name]
+    candidates.close()
+    write_fusion(ref, out_file, fusions, fusion_names, fixed_flag,
+                 secondary_flag, denovo_flag)
+
+
+def cached_fusion(ref_f, genome_fa, junc_bed, out_file, no_fix, cache_dir,
+                  secondary_flag=0, denovo_flag=0, thread=1):
+    """
+    Annotate and realign fusion junctions with a junction result cache,
+    only junctions missing in the cache are annotated and realigned
+    """
+    print('Start to annotate and fix fusion junctions with cache...')
+    ref_index = load_index(ref_f)
     ref = parse_ref(ref_f, 2)
-    annotated_fusion_f = 'annotated_fusion.txt.tmp'
-    fusions, fusion_names, fixed_flag = fix_bed(annotated_fusion_f, ref, fa,
-                                                no_fix, denovo_flag)
+    cache_f = cache_file(cache_dir, ref_index.content_hash, genome_fa,
+                         no_fix, secondary_flag, denovo_flag)
+    verdicts = load_cache(cache_f)
+    fusions, fusion_index = parse_bed(junc_bed)  # fusion junctions
+    chroms = sorted(ref_index.chroms)
+    # new junctions, once for each coordinate
+    new_junctions = {}
+    for chrom in chroms:
+        junctions = []
+        for junction in sorted(fusions[chrom]):
+            if (chrom, junction[0], junction[1]) in verdicts:
+                continue
+            if junctions and junctions[-1][:2] == junction[:2]:
+                continue
+            junctions.append(junction)
+        if junctions:
+            new_junctions[chrom] = junctions
+    new_num = sum(len(x) for x in new_junctions.values())
+    if new_num:  # pack genome before forking verdict_shard processes
+        fix_context(ref_f, genome_fa)
+    size = shard_size(new_num, thread)
+    shards = [(ref_f, genome_fa, chrom, junctions, no_fix, secondary_flag,
+               denovo_flag)
+              for chrom in sorted(new_junctions)
+              for junctions in split_shards(new_junctions[chrom],
+                                            lambda x: x[:2], size)]
+    for shard_verdicts in pool_map(verdict_shard, shards, thread):
+        verdicts.update(shard_verdicts)
+    if new_num:
+        save_cache(cache_f, verdicts)
+    # merge read counts of junctions in the order of fix_fusion
+    fusion_reads = defaultdict(int)
+    fusion_names = []
+    fixed_flag = defaultdict(int)
+    seen = set()
+    for chrom in chroms:
+        accepted = set()
+        # known isoforms of all the junctions first, then novel isoforms
+        for section in (0, 1):
+            for fus_start, fus_end, fus in sorted(fusions[chrom]):
+                junction_info = (chrom, fus_start, fus_end)
+                if not denovo_flag and junction_info in accepted:
+                    continue
+                reads = int(fus.split()[1])
+                for name, num, fixed in verdicts[junction_info][section]:
+                    if name not in fusion_reads:
+                        fusion_names.append(name)
+                    fusion_reads[name] += reads * num
+                    if fixed:
+                        fixed_flag[name] += fixed
+                    accepted.add(junction_info)
+                seen.add(junction_info)
+    print('Reused %d and fixed %d new fusion junctions!' % (len(seen) -
+                                                            new_num,
+                                                            new_num))
+    write_fusion(ref, out_file, fusion_reads, fusion_names, fixed_flag,
+                 secondary_flag, denovo_flag)
+
+
+def verdict_shard(args):
+    '''
+    Annotate and realign new fusion junctions of one chromosome
+    args: (ref_f, genome_fa, chrom, junctions, no_fix, secondary_flag,
+           denovo_flag)
+    Return {(chrom, start, end): ([(name, reads per junction read, fixed)]
+                                  of known isoforms, [...] of novel ones)}
+    '''
+    (ref_f, genome_fa, chrom, junctions, no_fix, secondary_flag,
+     denovo_flag) = args
+    candidates, novel_candidates, _ = annotate_shard((ref_f, chrom, junctions,
+                                                      secondary_flag,
+                                                      denovo_flag))
+    verdicts = dict(((chrom, start, end), ([], []))
+                    for start, end, _ in junctions)
+    for section, section_candidates in enumerate((candidates,
+                                                  novel_candidates)):
+        # one read for each candidate, so that verdicts are kept for any reads
+        section_candidates = [x._replace(reads=1) for x in section_candidates]
+        for group in split_shards(section_candidates, lambda x: x[:3], 1):
+            fusions, names, fixed = fix_shard((ref_f, genome_fa, group,
+                                               no_fix, denovo_flag))
+            verdicts[tuple(group[0][:3])][section].extend(
+                (name, fusions[name], fixed.get(name, 0)) for name in names)
+    return verdicts
+
+
+def cache_file(cache_dir, ref_hash, genome_fa, no_fix, secondary_flag,
+               denovo_flag):
+    '''
+    Cache file of junction results for the reference, genome and options
+    '''
+    key = json.dumps([CACHE_VERSION, ref_hash, fingerprint(genome_fa),
+                      bool(no_fix), bool(secondary_flag), bool(denovo_flag)])
+    return os.path.join(cache_dir,
+                        hashlib.md5(key.encode()).hexdigest() + '.cache')
+
+
+def load_cache(cache_f):
+    '''
+    Load {(chrom, start, end): verdicts} from cache_f, empty if missing
+    '''
+    if not os.path.isfile(cache_f):
+        return {}
+    with open(cache_f, 'rb') as f:
+        return pickle.load(f)
+
+
+def save_cache(cache_f, verdicts):
+    '''
+    Save verdicts into cache_f atomically
+    '''
+    cache_dir = os.path.dirname(cache_f)
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    tmp_f = '%s.tmp%d' % (cache_f, os.getpid())
+    with open(tmp_f, 'wb') as f:
+        pickle.dump(verdicts, f, pickle.HIGHEST_PROTOCOL)
+    os.rename(tmp_f, cache_f)
+
+
+def write_fusion(ref, out_file, fusions, fusion_names, fixed_flag,
+                 secondary_flag=0, denovo_flag=0):
+    """
+    Write realigned circular RNAs
+    """
     total = 0
     annotations = set()
     fixed_fusion_f = out_file
@@ -215,7 +560,27 @@ def fix_fusion(ref_f, genome_fa, out_file, no_fix, secondary_flag=0,
             outf.write(bed + '\n')
     if secondary_flag:
         secondary_f.close()
+    print('Fixed %d fusion junctions!' % total)
 
-    os.remove('annotated_fusion.txt.tmp')
 
-    print('Fixed %d fusion junctions!' % total)
+def fix_shard(args):
+    '''
+    Realign annotated fusion junctions with fix_bed
+    args: (ref_f, genome_fa, candidates, no_fix, denovo_flag)
+    '''
+    ref_f, genome_fa, candidates, no_fix, denovo_flag = args
+    ref, fa = fix_context(ref_f, genome_fa)
+    return fix_bed(candidates, ref, fa, no_fix, denovo_flag)
+
+
+def fix_context(ref_f, genome_fa):
+    '''
+    Annotation and genome of fix_shard, loaded once for each process.
+    Call it before pool_map, so that the genome is packed only once and
+    forked processes share the loaded context.
+    '''
+    if (ref_f, genome_fa) not in _fix_context:
+        _fix_context.clear()
+        _fix_context[(ref_f, genome_fa)] = (parse_ref(ref_f, 2),
+                                            check_fasta(genome_fa))
+    return _fix_context[(ref_f, genome_fa)]
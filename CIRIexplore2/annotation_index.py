@@ -0,0 +1,491 @@
+'''
+annotation_index.py
+Persistent per-chromosome isoform index for gene annotations
+'''
+
+import os
+import os.path
+import json
+import shutil
+import hashlib
+import numpy as np
+from interval_array import IntervalArray
+from file_func import fingerprint, content_hash
+
+__all__ = ['AnnotationIndex', 'ExonTable', 'load_index', 'load_overlay']
+
+_indexes = {}  # annotation indexes loaded in this process
+
+# arrays saved as .npy files inside the index directory
+ARRAYS = ('tx_start', 'tx_end', 'max_end', 'novel', 'row', 'exon_offset',
+          'exon_start', 'exon_end', 'block_start', 'block_end',
+          'block_offset', 'block_iso')
+
+
+class AnnotationIndex(object):
+    '''
+    Class: AnnotationIndex
+
+    Usage: index = load_index(ref_file)
+           index.query(chrom, start, end) -> isoform ids
+           index.point(chrom, pos) -> isoform ids
+           index.info(k) -> (gene, iso, chrom, strand)
+           index.exons(k) -> (starts, ends)
+           index.block_array(chrom, novel) -> gene blocks as IntervalArray
+           index.gene_blocks() -> same results as parse_ref(ref_file, 1)
+           index.exon_table() -> same results as parse_ref(ref_file, 2)
+           index.boundaries(chrom) -> (sorted exon starts, sorted exon ends)
+
+    Notes: isoforms of each chromosome are stored contiguously, sorted by
+           (txStart, txEnd, id), together with the running maximum of txEnd.
+           A lookup bisects txStart for the right border and the running
+           maximum for the left border, so only isoforms whose span is
+           nested in a hit are scanned. All the arrays are saved as .npy
+           files and memory-mapped when loaded. Gene blocks (merged
+           isoforms) of known and novel genes are kept as block arrays
+           with offsets into isoform ids. An overlay index merges indexes
+           of several annotation files without a combined file, and keeps
+           fingerprints of them as sources.
+    '''
+    def __init__(self, arrays, isoforms, chroms, blocks, fingerprint,
+                 content_hash=None, sources=None):
+        for name in ARRAYS:
+            setattr(self, name, arrays[name])
+        self.isoforms = isoforms
+        self.chroms = chroms
+        self.blocks = blocks
+        self.fingerprint = fingerprint
+        self.content_hash = content_hash
+        self.sources = sources
+        self._boundaries = {}
+        self._block_arrays = {}
+
+    @classmethod
+    def build(cls, ref_file, line_prefix=''):
+        '''
+        Usage: index = AnnotationIndex.build(ref_file)
+        parse refFlat file and build index, only lines starting with
+        line_prefix are indexed if it is given.
+        '''
+        rows = []
+        with open(ref_file, 'r') as f:
+            lines = (x for x in f if x.startswith(line_prefix))
+            for row, line in enumerate(lines):
+                line_info = line.split()
+                gene_id, iso_id, chrom, strand = line_info[:4]
+                total_id = '\t'.join(['iso', gene_id, iso_id, chrom, strand])
+                starts = [int(x) for x in line_info[9].rstrip(',').split(',')]
+                ends = [int(x) for x in line_info[10].rstrip(',').split(',')]
+                rows.append((chrom, starts[0], ends[-1], total_id, starts,
+                             ends, row))
+        rows.sort(key=lambda x: x[:4])
+        return cls.from_rows(rows, fingerprint(ref_file),
+                             content_hash(ref_file))
+
+    @classmethod
+    def from_rows(cls, rows, ref_fingerprint, ref_hash=None):
+        '''
+        Usage: index = AnnotationIndex.from_rows(rows, fingerprint)
+        build index from (chrom, start, end, total_id, starts, ends, row)
+        rows sorted by their first four fields, row is the line number.
+        '''
+        num = len(rows)
+        arrays = {
+            'tx_start': np.fromiter((x[1] for x in rows), np.int64, num),
+            'tx_end': np.fromiter((x[2] for x in rows), np.int64, num),
+            'novel': np.fromiter((x[3].split('\t')[2].startswith('CUFF')
+                                  for x in rows), np.bool_, num),
+            'row': np.fromiter((x[6] for x in rows), np.int64, num),
+            'exon_offset': np.zeros(num + 1, np.int64)
+        }
+        arrays['exon_offset'][1:] = np.cumsum([len(x[4]) for x in rows])
+        arrays['exon_start'] = np.fromiter((s for x in rows for s in x[4]),
+                                           np.int64)
+        arrays['exon_end'] = np.fromiter((e for x in rows for e in x[5]),
+                                         np.int64)
+        arrays['max_end'] = np.empty(num, np.int64)
+        chroms = {}
+        for n, x in enumerate(rows):
+            if x[0] not in chroms:
+                chroms[x[0]] = [n, n]
+            chroms[x[0]][1] = n + 1
+        for lo, hi in chroms.values():  # running maximum per chromosome
+            arrays['max_end'][lo:hi] = np.maximum.accumulate(
+                arrays['tx_end'][lo:hi])
+        blocks = AnnotationIndex._blocks(arrays, chroms)
+        isoforms = ['\t'.join(x[3].split('\t')[1:]) for x in rows]
+        return cls(arrays, isoforms, chroms, blocks, ref_fingerprint,
+                   ref_hash)
+
+    @classmethod
+    def merge(cls, indexes, ref_fingerprint, ref_hash=None, sources=None):
+        '''
+        Usage: index = AnnotationIndex.merge(indexes, fingerprint)
+        build index of annotation files of indexes concatenated in order,
+        the same as the index built from the concatenated file.
+        '''
+        isoforms, chrom_names, row = [], [], []
+        tx_start, tx_end, novel, exon_num, exon_start, exon_end = \
+            [], [], [], [], [], []
+        line_num = 0
+        for index in indexes:
+            isoforms += index.isoforms
+            for chrom, (lo, hi) in sorted(index.chroms.items(),
+                                          key=lambda x: x[1]):
+                chrom_names += [chrom] * (hi - lo)
+            row.append(index.row + line_num)
+            line_num += len(index.isoforms)
+            tx_start.append(index.tx_start)
+            tx_end.append(index.tx_end)
+            novel.append(index.novel)
+            exon_num.append(np.diff(index.exon_offset))
+            exon_start.append(index.exon_start)
+            exon_end.append(index.exon_end)
+        tx_start = np.concatenate(tx_start)
+        tx_end = np.concatenate(tx_end)
+        # same order as sorted (chrom, start, end, total_id) rows
+        _, chrom_rank = np.unique(np.asarray(chrom_names, dtype=str),
+                                  return_inverse=True)
+        _, iso_rank = np.unique(np.asarray(isoforms, dtype=str),
+                                return_inverse=True)
+        order = np.lexsort((iso_rank.reshape(-1), tx_end, tx_start,
+                            chrom_rank.reshape(-1)))
+        exon_num = np.concatenate(exon_num)
+        exon_offset = np.concatenate(([0], np.cumsum(exon_num)))
+        num = exon_num[order]
+        arrays = {
+            'tx_start': tx_start[order],
+            'tx_end': tx_end[order],
+            'novel': np.concatenate(novel)[order],
+            'row': np.concatenate(row)[order],
+            'exon_offset': np.concatenate(([0], np.cumsum(num))).astype(
+                np.int64)
+        }
+        exon_index = np.repeat(exon_offset[order] - arrays['exon_offset'][:-1],
+                               num) + np.arange(arrays['exon_offset'][-1])
+        arrays['exon_start'] = np.concatenate(exon_start)[exon_index]
+        arrays['exon_end'] = np.concatenate(exon_end)[exon_index]
+        arrays['max_end'] = np.empty(len(order), np.int64)
+        chroms = {}
+        for n, k in enumerate(order.tolist()):
+            if chrom_names[k] not in chroms:
+                chroms[chrom_names[k]] = [n, n]
+            chroms[chrom_names[k]][1] = n + 1
+        for lo, hi in chroms.values():  # running maximum per chromosome
+            arrays['max_end'][lo:hi] = np.maximum.accumulate(
+                arrays['tx_end'][lo:hi])
+        blocks = AnnotationIndex._blocks(arrays, chroms)
+        isoforms = [isoforms[k] for k in order.tolist()]
+        return cls(arrays, isoforms, chroms, blocks, ref_fingerprint,
+                   ref_hash, sources)
+
+    @staticmethod
+    def _blocks(arrays, chroms):
+        '''
+        Merge isoforms of known and novel genes into gene blocks, just as
+        Interval does. Return {chrom: [[lo, hi] of known, [lo, hi] of novel]}
+        '''
+        block_start, block_end, block_iso, block_offset = [], [], [], []
+        blocks = {}
+        num, iso_num = 0, 0
+        for chrom, (lo, hi) in sorted(chroms.items(), key=lambda x: x[1]):
+            blocks[chrom] = []
+            for novel_flag in (False, True):
+                iso = np.flatnonzero(arrays['novel'][lo:hi] == novel_flag) + lo
+                if not len(iso):
+                    blocks[chrom].append([num, num])
+                    continue
+                starts = arrays['tx_start'][iso]
+                reach = np.maximum.accumulate(arrays['tx_end'][iso])
+                first = np.flatnonzero(np.concatenate((
+                    [True], reach[:-1] <= starts[1:])))
+                last = np.append(first[1:], len(iso)) - 1
+                block_start.append(starts[first])
+                block_end.append(reach[last])
+                block_iso.append(iso)
+                block_offset.append(first + iso_num)
+                blocks[chrom].append([num, num + len(first)])
+                num += len(first)
+                iso_num += len(iso)
+        empty = [np.zeros(0, np.int64)]
+        arrays['block_start'] = np.concatenate(block_start or empty)
+        arrays['block_end'] = np.concatenate(block_end or empty)
+        arrays['block_iso'] = np.concatenate(block_iso or empty)
+        arrays['block_offset'] = np.append(
+            np.concatenate(block_offset or empty), iso_num).astype(np.int64)
+        return blocks
+
+    def save(self, index_dir):
+        '''
+        Usage: index.save(index_dir)
+        save index as .npy files into index_dir.
+        '''
+        tmp_dir = index_dir + '.tmp%d' % os.getpid()
+        os.mkdir(tmp_dir)
+        for name in ARRAYS:
+            np.save('%s/%s.npy' % (tmp_dir, name), getattr(self, name))
+        with open('%s/isoforms.txt' % tmp_dir, 'w') as f:
+            for iso in self.isoforms:
+                f.write(iso + '\n')
+        # meta.json is written last to mark a complete index
+        self.save_meta(tmp_dir)
+        if os.path.isdir(index_dir):
+            shutil.rmtree(index_dir)
+        os.rename(tmp_dir, index_dir)
+
+    def save_meta(self, index_dir):
+        '''
+        Usage: index.save_meta(index_dir)
+        (re)write meta.json of index_dir.
+        '''
+        meta_f = '%s/meta.json' % index_dir
+        with open(meta_f + '.tmp', 'w') as f:
+            json.dump({'chroms': self.chroms, 'blocks': self.blocks,
+                       'fingerprint': self.fingerprint,
+                       'content_hash': self.content_hash,
+                       'sources': self.sources}, f)
+        os.rename(meta_f + '.tmp', meta_f)
+
+    @classmethod
+    def load(cls, index_dir):
+        '''
+        Usage: index = AnnotationIndex.load(index_dir)
+        load memory-mapped index from index_dir.
+        '''
+        with open('%s/meta.json' % index_dir, 'r') as f:
+            meta = json.load(f)
+        arrays = {name: np.load('%s/%s.npy' % (index_dir, name),
+                                mmap_mode='r') for name in ARRAYS}
+        with open('%s/isoforms.txt' % index_dir, 'r') as f:
+            isoforms = f.read().splitlines()
+        return cls(arrays, isoforms, meta['chroms'], meta['blocks'],
+                   meta['fingerprint'], meta['content_hash'],
+                   meta.get('sources'))
+
+    def query(self, chrom, start, end):
+        '''
+        Usage: index.query(chrom, start, end) -> isoform ids
+        fetch isoforms overlapped with [start, end).
+        '''
+        if chrom not in self.chroms:
+            return []
+        lo, hi = self.chroms[chrom]
+        right = lo + np.searchsorted(self.tx_start[lo:hi], end, 'left')
+        left = lo + np.searchsorted(self.max_end[lo:hi], start, 'right')
+        if left >= right:
+            return []
+        hit = np.flatnonzero(self.tx_end[left:right] > start) + left
+        return hit.tolist()
+
+    def point(self, chrom, pos):
+        '''
+        Usage: index.point(chrom, pos) -> isoform ids
+        fetch isoforms covering pos.
+        '''
+        return self.query(chrom, pos, pos + 1)
+
+    def info(self, k):
+        '''
+        Usage: index.info(k) -> (gene, iso, chrom, strand)
+        '''
+        return self.isoforms[k].split('\t')
+
+    def exons(self, k):
+        '''
+        Usage: index.exons(k) -> (starts, ends)
+        '''
+        sta, end = self.exon_offset[k], self.exon_offset[k + 1]
+        return (self.exon_start[sta:end].tolist(),
+                self.exon_end[sta:end].tolist())
+
+    def boundaries(self, chrom):
+        '''
+        Usage: index.boundaries(chrom) -> (exon starts, exon ends)
+        sorted unique exon starts and ends of all isoforms in chrom.
+        '''
+        if chrom not in self._boundaries:
+            if chrom in self.chroms:
+                lo, hi = self.chroms[chrom]
+                sta, end = self.exon_offset[lo], self.exon_offset[hi]
+            else:
+                sta, end = 0, 0
+            self._boundaries[chrom] = (np.unique(self.exon_start[sta:end]),
+                                       np.unique(self.exon_end[sta:end]))
+        return self._boundaries[chrom]
+
+    def block_array(self, chrom, novel=False):
+        '''
+        Usage: index.block_array(chrom, novel) -> IntervalArray
+        gene blocks of known (or novel) genes in chrom with isoform ids as
+        payload.
+        '''
+        if chrom not in self._block_arrays:
+            self._block_arrays[chrom] = []
+            for lo, hi in self.blocks.get(chrom, [[0, 0], [0, 0]]):
+                sta, end = self.block_offset[lo], self.block_offset[hi]
+                genes_array = IntervalArray.from_arrays(
+                    self.block_start[lo:hi], self.block_end[lo:hi],
+                    self.block_iso[sta:end].tolist(),
+                    self.block_offset[lo:(hi + 1)] - sta, instance_flag=1)
+                genes_array.merged = True
+                self._block_arrays[chrom].append(genes_array)
+        return self._block_arrays[chrom][int(novel)]
+
+    def gene_blocks(self):
+        '''
+        Usage: index.gene_blocks() -> (genes, novel_genes, gene_info,
+                                        chrom_info)
+        same results as parse_ref(ref_file, 1), exons in gene_info are
+        decoded on access.
+        '''
+        genes, novel_genes = {}, {}
+        for chrom in self.blocks:
+            for novel, gene_dict in enumerate((genes, novel_genes)):
+                genes_array = self.block_array(chrom, novel).copy()
+                if not len(genes_array.starts):
+                    continue
+                genes_array.payload = ['iso\t' + self.isoforms[k]
+                                       for k in genes_array.payload]
+                gene_dict[chrom] = genes_array
+        return (genes, novel_genes, ExonTable(self, 'iso\t'),
+                set(self.chroms))
+
+    def exon_table(self):
+        '''
+        Usage: index.exon_table() -> same results as parse_ref(ref_file, 2)
+        '''
+        return ExonTable(self)
+
+
+class ExonTable(object):
+    '''
+    Class: ExonTable
+
+    Usage: table = index.exon_table()
+           table[isoform] -> [starts, ends]
+
+    Notes: read-only mapping from 'gene\tiso\tchrom\tstrand' (with prefix)
+           to exons, the exon arrays are only decoded on access. The last
+           line of refFlat file wins for duplicated isoforms, as in dict.
+    '''
+    def __init__(self, index, prefix=''):
+        self.index = index
+        self.prefix = prefix
+        self._ids = None
+
+    @property
+    def ids(self):
+        if self._ids is None:
+            isoforms = self.index.isoforms
+            self._ids = {}
+            for k in np.argsort(self.index.row, kind='mergesort').tolist():
+                self._ids[self.prefix + isoforms[k]] = k
+        return self._ids
+
+    def __getitem__(self, iso):
+        return list(self.index.exons(self.ids[iso]))
+
+    def __contains__(self, iso):
+        return iso in self.ids
+
+    def __iter__(self):
+        return iter(self.ids)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def keys(self):
+        return self.ids.keys()
+
+    def get(self, iso, default=None):
+        return self[iso] if iso in self.ids else default
+
+    def items(self):
+        for iso in self.ids:
+            yield (iso, self[iso])
+
+
+def load_index(ref_file):
+    '''
+    Load annotation index saved next to ref_file, or build and save it
+    '''
+    index_dir = ref_file + '.cidx'
+    if ref_file in _indexes:
+        index = _indexes[ref_file]
+        if index.sources is not None:  # overlay checked by load_overlay
+            return index
+        if index.fingerprint == fingerprint(ref_file):
+            return index
+    if os.path.isfile('%s/meta.json' % index_dir):
+        try:
+            index = AnnotationIndex.load(index_dir)
+        except (IOError, OSError, KeyError, ValueError):
+            index = None  # index of older version
+        if index is not None and index.sources is not None:
+            # overlay saved by load_overlay, ref_file is not read
+            if index.sources != [fingerprint(x[0]) for x in index.sources]:
+                raise IOError('Annotation overlay %s is out of date!' %
+                              index_dir)
+            print('Load annotation index %s...' % index_dir)
+            _indexes[ref_file] = index
+            return index
+        ref_fingerprint = fingerprint(ref_file)
+        if index is not None and index.fingerprint != ref_fingerprint:
+            # touched or copied annotation, compare content only
+            if index.fingerprint[1:2] == ref_fingerprint[1:2] and \
+               index.content_hash == content_hash(ref_file):
+                index.fingerprint = ref_fingerprint
+                try:
+                    index.save_meta(index_dir)
+                except (IOError, OSError):
+                    pass
+            else:
+                index = None
+        if index is not None:
+            print('Load annotation index %s...' % index_dir)
+            _indexes[ref_file] = index
+            return index
+    print('Build annotation index for %s...' % ref_file)
+    index = AnnotationIndex.build(ref_file)
+    try:
+        index.save(index_dir)
+    except (IOError, OSError):
+        print('Warning: cannot save annotation index to %s!' % index_dir)
+    _indexes[ref_file] = index
+    return index
+
+
+def load_overlay(ref_file, delta_file, overlay_file, line_prefix='CUFF'):
+    '''
+    Load annotation index of lines starting with line_prefix in delta_file
+    followed by all lines of ref_file, saved as overlay_file.cidx, or merge
+    and save it. overlay_file itself is neither read nor written,
+    load_index(overlay_file) returns the overlay index afterwards.
+    '''
+    index_dir = overlay_file + '.cidx'
+    sources = [fingerprint(ref_file), fingerprint(delta_file)]
+    index = _indexes.get(overlay_file)
+    if (index is None or index.sources != sources) and \
+       os.path.isfile('%s/meta.json' % index_dir):
+        try:
+            index = AnnotationIndex.load(index_dir)
+        except (IOError, OSError, KeyError, ValueError):
+            index = None  # index of older version
+    if index is not None and index.sources == sources:
+        print('Load annotation index %s...' % index_dir)
+        _indexes[overlay_file] = index
+        return index
+    print('Build annotation overlay for %s and %s...' % (ref_file,
+                                                         delta_file))
+    base = load_index(ref_file)
+    delta = AnnotationIndex.build(delta_file, line_prefix)
+    ref_hash = hashlib.md5(json.dumps([line_prefix, content_hash(delta_file),
+                                       base.content_hash]).encode())
+    index = AnnotationIndex.merge([delta, base], None, ref_hash.hexdigest(),
+                                  sources)
+    try:
+        index.save(index_dir)
+    except (IOError, OSError):
+        print('Warning: cannot save annotation index to %s!' % index_dir)
+    _indexes[overlay_file] = index
+    return index
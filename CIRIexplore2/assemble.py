@@ -12,13 +12,16 @@ Options:
     --chrom-size=CHROM_SIZE        Chrom size file for converting to BigBed.
     --remove-rRNA                  Ignore rRNA during assembling (only for \
 human hg19).
+    --exclude=EXCLUDE              BED file of regions (e.g. rRNA or chrM) \
+ignored during assembling.
     --max-bundle-frags=FRAGMENTS   Cufflinks --max-bundle-frags option.
 '''
 
 import sys
 import os
 import os.path
-#from parser import parse_junc
+from junction_graph import load_junctions
+from bam_filter import read_regions, filter_bam
 #from helper import logger, which, genepred_to_bed
 #from dir_func import create_dir
 
@@ -52,7 +55,8 @@ def assemble(options):
     ref_filter(options['--ref'], tophat_dir, cufflinks_dir)
     # assemble with cufflinks
     cufflinks_assemble(tophat_dir, cufflinks_dir, options['--thread'],
-                       options['--remove-rRNA'], options['--max-bundle-frags'])
+                       options['--remove-rRNA'], options['--max-bundle-frags'],
+                       options['--exclude'])
     # convert assembly results
     convert_assembly_gtf(tophat_dir, cufflinks_dir, options['--ref'],
                          options['--bb'], options['--chrom-size'])
@@ -67,7 +71,7 @@ def ref_filter(ref, tophat_dir, cufflinks_dir):
     # read junction information
     junction_f = tophat_dir + '/junctions.bed'
 
-    junc = parse_junc(junction_f)
+    junc = load_junctions(junction_f)
     print('Filter gene annotations with junction information...')
     # filter out gene annotations using junction reads
     filtered_junction_f = '%s/filtered_junction.txt' % cufflinks_dir
@@ -77,8 +81,7 @@ def ref_filter(ref, tophat_dir, cufflinks_dir):
             starts = line.split()[10].rstrip(',').split(',')[:-1]
             ends = line.split()[9].rstrip(',').split(',')[1:]
             for s, e in zip(starts, ends):
-                junc_id = '%s\t%s\t%s' % (chrom, s, e)
-                if junc[junc_id] < 2:
+                if junc.reads(chrom, int(s), int(e)) < 2:
                     break
             else:  # all the junctions have enough reads
                 out_f.write('\t'.join(line.split()[1:]) + '\n')
@@ -90,24 +93,18 @@ def ref_filter(ref, tophat_dir, cufflinks_dir):
 
 
 def cufflinks_assemble(tophat_dir, cufflinks_dir, thread, flag_rRNA,
-                       fragments):
+                       fragments, exclude_bed=None):
     '''
     Cufflinks RABT assembly
     '''
     # prepare cufflinks command
     gtf_path = '%s/filtered_junction.gtf' % cufflinks_dir
     bam_path = '%s/accepted_hits.bam' % tophat_dir
-    if flag_rRNA:  # remove rRNA
+    if flag_rRNA or exclude_bed:  # remove rRNA and excluded regions
+        contigs = ['chrUn_gl000220'] if flag_rRNA else []
+        regions = read_regions(exclude_bed) if exclude_bed else None
         new_bam_path = '%s/tophat_no_rRNA.bam' % cufflinks_dir
-        previous_bam = pysam.AlignmentFile(bam_path, 'rb')
-        new_bam = pysam.AlignmentFile(new_bam_path, 'wb',
-                                      template=previous_bam)
-        for read in previous_bam:
-            chr = previous_bam.getrname(read.reference_id)
-            if chr != 'chrUn_gl000220':
-                new_bam.write(read)
-        previous_bam.close()
-        new_bam.close()
+        filter_bam(bam_path, new_bam_path, contigs, regions, int(thread))
         bam_path = new_bam_path
     cufflinks_cmd = 'cufflinks -u -F 0 -j 0 '
     cufflinks_cmd += '-p %s ' % thread
@@ -0,0 +1,105 @@
+'''
+bam_filter.py
+Exclude contigs and regions from coordinate-sorted BAM files
+'''
+
+from collections import defaultdict
+import numpy as np
+import pysam
+
+__all__ = ['read_regions', 'filter_bam']
+
+
+def read_regions(bed_file):
+    '''
+    Read excluded regions from BED file
+    Return {chrom: (starts, ends)} of merged regions as sorted arrays
+    '''
+    regions = defaultdict(list)
+    with open(bed_file, 'r') as f:
+        for line in f:
+            if line.startswith(('#', 'track', 'browser')):
+                continue
+            line_info = line.split()
+            if len(line_info) < 3:
+                continue
+            regions[line_info[0]].append((int(line_info[1]),
+                                          int(line_info[2])))
+    merged = {}
+    for chrom, intervals in regions.items():
+        intervals = np.array(sorted(intervals), dtype=np.int64)
+        starts, ends = intervals[:, 0], np.maximum.accumulate(intervals[:, 1])
+        # overlapped or adjacent regions are merged
+        first = np.flatnonzero(np.concatenate(([True],
+                                               ends[:-1] < starts[1:])))
+        last = np.append(first[1:], len(starts)) - 1
+        merged[chrom] = (starts[first], ends[last])
+    return merged
+
+
+def retained_gaps(length, starts, ends):
+    '''
+    Return [(start, end), ...] of a contig outside excluded regions
+    '''
+    bounds = [0] + np.clip(np.column_stack((starts, ends)), 0,
+                           length).ravel().tolist() + [length]
+    return [(sta, end) for sta, end in zip(bounds[::2], bounds[1::2])
+            if sta < end]
+
+
+def filter_bam(in_bam, out_bam, contigs=(), regions=None, thread=1):
+    '''
+    Write in_bam without reads on excluded contigs or overlapped with
+    excluded regions ({chrom: (starts, ends)} from read_regions) to out_bam.
+    Indexed BAM is copied by fetching retained parts of each contig, so
+    that excluded parts are never decompressed. Unindexed BAM is filtered
+    read by read. Return the number of written reads.
+    '''
+    contigs = set(contigs)
+    regions = regions or {}
+    bam = pysam.AlignmentFile(in_bam, 'rb', threads=thread)
+    out = pysam.AlignmentFile(out_bam, 'wb', template=bam, threads=thread)
+    num = 0
+    if bam.has_index():
+        for chrom, length in zip(bam.references, bam.lengths):
+            if chrom in contigs:
+                continue
+            if chrom in regions:
+                gaps = retained_gaps(length, *regions[chrom])
+            else:
+                gaps = [(0, length)]
+            for sta, end in gaps:
+                for read in bam.fetch(chrom, sta, end):
+                    # overlapped with previous excluded region
+                    if read.reference_start < sta:
+                        continue
+                    read_end = read.reference_end or read.reference_start + 1
+                    # overlapped with next excluded region
+                    if read_end > end and end < length:
+                        continue
+                    out.write(read)
+                    num += 1
+        for read in bam.fetch('*'):  # unplaced unmapped reads
+            out.write(read)
+            num += 1
+    else:
+        excluded = set(n for n, chrom in enumerate(bam.references)
+                       if chrom in contigs)
+        region_ids = dict((bam.get_tid(chrom), x)
+                          for chrom, x in regions.items()
+                          if bam.get_tid(chrom) >= 0)
+        for read in bam.fetch(until_eof=True):
+            tid = read.reference_id
+            if tid in excluded:
+                continue
+            if tid in region_ids:
+                starts, ends = region_ids[tid]
+                read_end = read.reference_end or read.reference_start + 1
+                i = np.searchsorted(ends, read.reference_start, 'right')
+                if i < len(starts) and starts[i] < read_end:
+                    continue
+            out.write(read)
+            num += 1
+    bam.close()
+    out.close()
+    return num
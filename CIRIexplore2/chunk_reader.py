@@ -0,0 +1,124 @@
+'''
+chunk_reader.py
+Chunked column reader for plain, gzip and BGZF compressed text files
+'''
+
+import gzip
+import warnings
+from itertools import islice
+import numpy as np
+
+__all__ = ['open_text', 'read_chunks', 'count_keys']
+
+
+def open_text(file_name):
+    '''
+    Open plain or gzip/BGZF compressed text file
+    '''
+    with open(file_name, 'rb') as f:
+        magic = f.read(2)
+    if magic == b'\x1f\x8b':  # BGZF is a series of gzip members
+        return gzip.open(file_name, 'rt')
+    return open(file_name, 'r')
+
+
+def read_chunks(file_name, ncol, chunk_lines=1000000, int_cols=()):
+    '''
+    Yield (line numbers, [column arrays]) of the first ncol columns for
+    every chunk_lines lines, columns of int_cols are converted to int64.
+    Comment lines, lines with less than ncol columns and lines with
+    non-integer int_cols are skipped.
+    '''
+    line_num = 0
+    with open_text(file_name) as f:
+        while True:
+            lines = list(islice(f, chunk_lines))
+            if not lines:
+                break
+            chunk = parse_chunk(lines, ncol)
+            if chunk is None:  # chunk with comment, blank or short lines
+                chunk = split_chunk(lines, ncol)
+            index, cols = chunk
+            index += line_num
+            line_num += len(lines)
+            if int_cols:
+                index, cols = convert_ints(index, cols, int_cols)
+            if not len(index):
+                continue
+            yield (index, cols)
+
+
+def parse_chunk(lines, ncol):
+    '''
+    Return (line numbers, [column arrays]) of lines parsed by np.loadtxt,
+    or None if not every line is a row of at least ncol columns
+    '''
+    if '#' in ''.join(lines):
+        return None
+    try:
+        with warnings.catch_warnings():  # warned on blank lines
+            warnings.simplefilter('ignore', UserWarning)
+            rows = np.loadtxt(lines, dtype=str, comments=None,
+                              usecols=range(ncol), ndmin=2)
+    except ValueError:
+        return None
+    if len(rows) != len(lines):  # blank lines are dropped by np.loadtxt
+        return None
+    return (np.arange(len(lines), dtype=np.int64),
+            [rows[:, n] for n in range(ncol)])
+
+
+def split_chunk(lines, ncol):
+    '''
+    Return (line numbers, [column arrays]) of lines split one by one
+    '''
+    index, rows = [], []
+    for n, line in enumerate(lines):
+        if line.startswith('#'):
+            continue
+        row = line.split(None, ncol)
+        if len(row) < ncol:
+            continue
+        index.append(n)
+        rows.append(row[:ncol])
+    if not rows:
+        return (np.zeros(0, np.int64), [np.zeros(0, str)] * ncol)
+    return (np.asarray(index, np.int64),
+            [np.asarray(col) for col in zip(*rows)])
+
+
+def convert_ints(index, cols, int_cols):
+    '''
+    Convert columns of int_cols to int64 once, dropping rows (e.g. headers)
+    whose int_cols are not integers
+    '''
+    try:
+        ints = [cols[n].astype(np.int64) for n in int_cols]
+    except ValueError:
+        keep = np.ones(len(index), np.bool_)
+        for n in int_cols:
+            keep &= np.char.isdigit(np.char.lstrip(cols[n], '-'))
+        index = index[keep]
+        cols = [x[keep] for x in cols]
+        ints = [cols[n].astype(np.int64) for n in int_cols]
+    cols = list(cols)
+    for n, col in zip(int_cols, ints):
+        cols[n] = col
+    return (index, cols)
+
+
+def count_keys(counts, chroms, starts, ends):
+    '''
+    Add (chrom, start, end) keys of one chunk into counts dict, keeping the
+    order of their first appearance
+    '''
+    if not len(chroms):
+        return
+    names, chrom_ids = np.unique(chroms, return_inverse=True)
+    keys = np.column_stack((chrom_ids.reshape(-1), starts, ends))
+    uniq, first, num = np.unique(keys, axis=0, return_index=True,
+                                 return_counts=True)
+    for n in np.argsort(first, kind='mergesort').tolist():
+        chrom_id, start, end = uniq[n].tolist()
+        key = (str(names[chrom_id]), start, end)
+        counts[key] = counts.get(key, 0) + int(num[n])
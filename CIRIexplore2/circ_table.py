@@ -0,0 +1,88 @@
+'''
+circ_table.py
+Columnar table of circRNA records loaded from circularRNA_full.txt
+'''
+
+import os
+import os.path
+import numpy as np
+
+__all__ = ['CircTable', 'load_circ']
+
+_tables = {}  # circRNA tables loaded in this process
+
+
+class CircTable(object):
+    '''
+    Class: CircTable
+
+    Usage: circ = load_circ(circ_f)
+           circ.start[n], circ.strand[n], circ.gene[n] -> fields of record n
+           circ.exons(n) -> [[exon_start, exon_end], ...]
+
+    Notes: one row per line of circularRNA_full.txt in file order.
+           Coordinates, scores and reads are kept as integer arrays (tolist
+           copies in *_list for fast iteration), text fields as lists.
+           Blocks of all records are kept as flat exon_start and exon_end
+           arrays, blocks of record n are in block_ptr[n]:block_ptr[n + 1].
+    '''
+    def __init__(self, circ_f):
+        self.chrom, self.name, self.strand = [], [], []
+        self.type, self.gene, self.iso = [], [], []
+        starts, ends, scores, reads = [], [], [], []
+        block_num = [0]
+        sizes, offsets = [], []
+        with open(circ_f, 'r') as f:
+            for line in f:
+                info = line.split()
+                self.chrom.append(info[0])
+                starts.append(int(info[1]))
+                ends.append(int(info[2]))
+                self.name.append(info[3])
+                scores.append(int(info[4]))
+                self.strand.append(info[5])
+                size = info[10].split(',')
+                sizes += size
+                offsets += info[11].split(',')
+                block_num.append(len(size))
+                reads.append(int(info[12]))
+                self.type.append(info[13])
+                self.gene.append(info[14])
+                self.iso.append(info[15])
+        self.start = np.asarray(starts, dtype=np.int64)
+        self.end = np.asarray(ends, dtype=np.int64)
+        self.score = np.asarray(scores, dtype=np.int64)
+        self.reads = np.asarray(reads, dtype=np.int64)
+        self.block_ptr = np.cumsum(block_num, dtype=np.int64)
+        block_start = np.repeat(self.start, np.diff(self.block_ptr))
+        self.exon_start = block_start + np.asarray(offsets, dtype=np.int64)
+        self.exon_end = self.exon_start + np.asarray(sizes, dtype=np.int64)
+        self.start_list = starts
+        self.end_list = ends
+        self.score_list = scores
+        self.reads_list = reads
+        self._exon_start = self.exon_start.tolist()
+        self._exon_end = self.exon_end.tolist()
+        self._block_ptr = self.block_ptr.tolist()
+
+    def __len__(self):
+        return len(self.chrom)
+
+    def exons(self, n):
+        '''
+        Usage: circ.exons(n) -> [[exon_start, exon_end], ...] of record n
+        '''
+        sta, end = self._block_ptr[n], self._block_ptr[n + 1]
+        return [list(x) for x in zip(self._exon_start[sta:end],
+                                     self._exon_end[sta:end])]
+
+
+def load_circ(circ_f):
+    '''
+    Load circRNA table once per process and share it between stages
+    '''
+    stat = os.stat(circ_f)
+    key = (os.path.abspath(circ_f), stat.st_size, stat.st_mtime)
+    if key not in _tables:
+        _tables[key] = CircTable(circ_f)
+    return _tables[key]
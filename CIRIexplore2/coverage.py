@@ -0,0 +1,256 @@
+'''
+coverage.py
+Per-chromosome cumulative base coverage of BAM files
+'''
+
+import os
+import os.path
+import json
+import shutil
+import numpy as np
+from file_func import fingerprint
+
+__all__ = ['BaseCoverage', 'load_coverage', 'count_intron_reads']
+
+BUFFER = 1 << 16  # aligned blocks buffered in lists by read_blocks
+
+
+class BaseCoverage(object):
+    '''
+    Class: BaseCoverage
+
+    Usage: cov = load_coverage(bam_f, bam)
+           cov.bases(chrom, start, end) -> aligned bases in [start, end)
+
+    Notes: coverage of each chromosome is kept as run-length breakpoints
+           (pos), the depth after each breakpoint (depth) and the
+           cumulative bases before each breakpoint (cum), so that memory
+           follows the number of coverage changes instead of chromosome
+           length and a lookup is two binary searches.
+    '''
+    def __init__(self, pos, depth, cum, chroms, meta=None):
+        self.pos = pos
+        self.depth = depth
+        self.cum = cum
+        self.chroms = chroms
+        self.meta = meta or {}
+
+    @classmethod
+    def build(cls, bam, splice_flag=True):
+        '''
+        Usage: cov = BaseCoverage.build(bam, splice_flag)
+        scan each chromosome of indexed bam once.
+        '''
+        pos, depth, cum = [], [], []
+        chroms = {}
+        offset = 0
+        for chrom in bam.references:
+            starts, ends = [], []
+            for read in bam.fetch(chrom):
+                if read.reference_end is None:
+                    continue
+                if splice_flag:  # aligned blocks only
+                    for s, e in read.get_blocks():
+                        starts.append(s)
+                        ends.append(e)
+                else:  # whole span of reads
+                    starts.append(read.reference_start)
+                    ends.append(read.reference_end)
+            if not starts:
+                continue
+            p, d, c = coverage_runs(starts, ends)
+            chroms[chrom] = [offset, offset + len(p)]
+            offset += len(p)
+            pos.append(p)
+            depth.append(d)
+            cum.append(c)
+        if not chroms:
+            pos = depth = cum = [np.zeros(0, np.int64)]
+        return cls(np.concatenate(pos), np.concatenate(depth),
+                   np.concatenate(cum), chroms)
+
+    def save(self, cov_dir):
+        '''
+        Usage: cov.save(cov_dir)
+        save coverage as .npy files into cov_dir.
+        '''
+        tmp_dir = cov_dir + '.tmp%d' % os.getpid()
+        os.mkdir(tmp_dir)
+        for name in ('pos', 'depth', 'cum'):
+            np.save('%s/%s.npy' % (tmp_dir, name), getattr(self, name))
+        # meta.json is written last to mark complete coverage
+        with open('%s/meta.json' % tmp_dir, 'w') as f:
+            json.dump(dict(self.meta, chroms=self.chroms), f)
+        if os.path.isdir(cov_dir):
+            shutil.rmtree(cov_dir)
+        os.rename(tmp_dir, cov_dir)
+
+    @classmethod
+    def load(cls, cov_dir):
+        '''
+        Usage: cov = BaseCoverage.load(cov_dir)
+        load memory-mapped coverage from cov_dir.
+        '''
+        with open('%s/meta.json' % cov_dir, 'r') as f:
+            meta = json.load(f)
+        arrays = [np.load('%s/%s.npy' % (cov_dir, name), mmap_mode='r')
+                  for name in ('pos', 'depth', 'cum')]
+        return cls(*arrays, chroms=meta.pop('chroms'), meta=meta)
+
+    def cumulative(self, chrom, x):
+        '''
+        Usage: cov.cumulative(chrom, x) -> aligned bases before x
+        '''
+        if chrom not in self.chroms:
+            return 0
+        lo, hi = self.chroms[chrom]
+        return int(cumulative_bases(self.pos[lo:hi], self.depth[lo:hi],
+                                    self.cum[lo:hi], x))
+
+    def bases(self, chrom, start, end):
+        '''
+        Usage: cov.bases(chrom, start, end) -> aligned bases in [start, end)
+        '''
+        return self.cumulative(chrom, end) - self.cumulative(chrom, start)
+
+
+def coverage_runs(starts, ends):
+    '''
+    Convert aligned blocks into (pos, depth, cum) coverage runs
+    '''
+    pos = np.concatenate((np.asarray(starts, np.int64),
+                          np.asarray(ends, np.int64)))
+    delta = np.concatenate((np.ones(len(starts), np.int64),
+                            -np.ones(len(ends), np.int64)))
+    order = np.argsort(pos, kind='mergesort')
+    pos, index = np.unique(pos[order], return_index=True)
+    depth = np.cumsum(np.add.reduceat(delta[order], index))
+    cum = np.zeros(len(pos), np.int64)
+    cum[1:] = np.cumsum(depth[:-1] * np.diff(pos))
+    return (pos, depth, cum)
+
+
+def cumulative_bases(pos, depth, cum, x):
+    '''
+    Aligned bases before x (scalar or array) from coverage runs
+    '''
+    x = np.asarray(x, np.int64)
+    if not len(pos):
+        return np.zeros_like(x)
+    k = np.searchsorted(pos, x, 'right') - 1
+    safe = np.maximum(k, 0)
+    return np.where(k < 0, 0, cum[safe] + depth[safe] * (x - pos[safe]))
+
+
+def count_intron_reads(bam, introns, flank=8):
+    '''
+    Count reads spanning the left and right flanks (+/-flank bp) of each
+    intron and mean base coverage of each intron, reading each chromosome
+    of indexed bam once.
+    introns: [[chrom, sta, end], ...]
+    Return (left, right, body) arrays in the order of introns
+    '''
+    num = len(introns)
+    left = np.zeros(num, np.int64)
+    right = np.zeros(num, np.int64)
+    body = np.zeros(num, np.float64)
+    chrom_index = {}
+    for n, (chrom, sta, end) in enumerate(introns):
+        chrom_index.setdefault(chrom, []).append(n)
+    for chrom in sorted(chrom_index):
+        index = np.asarray(chrom_index[chrom], np.int64)
+        sta = np.asarray([introns[n][1] for n in index], np.int64)
+        end = np.asarray([introns[n][2] for n in index], np.int64)
+        block_starts, block_ends, read_id = read_blocks(
+            bam, chrom, max(int(sta.min()) - flank, 0),
+            int(end.max()) + flank)
+        if not len(block_starts):
+            continue
+        # contiguous aligned segments of reads, split by deletions and
+        # skipped regions
+        new_seg = np.ones(len(block_starts), np.bool_)
+        new_seg[1:] = ((read_id[1:] != read_id[:-1]) |
+                       (block_starts[1:] > block_ends[:-1]))
+        seg_starts = block_starts[new_seg]
+        seg_ends = block_ends[np.append(np.flatnonzero(new_seg)[1:] - 1,
+                                        len(new_seg) - 1)]
+        # reads whose segment covers [x - flank, x + flank) of a boundary
+        points = np.unique(np.concatenate((sta, end))) - flank
+        lo = np.searchsorted(points, seg_starts, 'left')
+        hi = np.searchsorted(points, seg_ends - 2 * flank, 'right')
+        spanned = hi > lo
+        diff = np.zeros(len(points) + 1, np.int64)
+        np.add.at(diff, lo[spanned], 1)
+        np.add.at(diff, hi[spanned], -1)
+        counts = np.cumsum(diff)[:-1]
+        left[index] = counts[np.searchsorted(points, sta - flank)]
+        right[index] = counts[np.searchsorted(points, end - flank)]
+        # mean base coverage of introns
+        runs = coverage_runs(block_starts, block_ends)
+        body[index] = ((cumulative_bases(*(runs + (end,))) -
+                        cumulative_bases(*(runs + (sta,)))) * 1.0 /
+                       (end - sta))
+    return (left, right, body)
+
+
+def read_blocks(bam, chrom, start, end):
+    '''
+    Return (starts, ends, read numbers) of aligned blocks of reads in
+    region as int64 arrays, blocks are buffered in lists of BUFFER blocks
+    and copied into arrays grown by doubling
+    '''
+    size = BUFFER
+    blocks = np.zeros((size, 2), np.int64)
+    read_id = np.zeros(size, np.int64)
+    num = 0
+    tmp_blocks, tmp_id = [], []
+    for n, read in enumerate(bam.fetch(chrom, start, end)):
+        for block in read.get_blocks():
+            tmp_blocks.append(block)
+            tmp_id.append(n)
+        if len(tmp_blocks) >= BUFFER:
+            size, blocks, read_id = flush_blocks(size, blocks, read_id, num,
+                                                 tmp_blocks, tmp_id)
+            num += len(tmp_blocks)
+            tmp_blocks, tmp_id = [], []
+    if tmp_blocks:
+        size, blocks, read_id = flush_blocks(size, blocks, read_id, num,
+                                             tmp_blocks, tmp_id)
+        num += len(tmp_blocks)
+    return (blocks[:num, 0], blocks[:num, 1], read_id[:num])
+
+
+def flush_blocks(size, blocks, read_id, num, tmp_blocks, tmp_id):
+    '''
+    Copy buffered blocks after the first num blocks of arrays
+    '''
+    while num + len(tmp_blocks) > size:
+        size *= 2
+        blocks = np.resize(blocks, (size, 2))
+        read_id = np.resize(read_id, size)
+    blocks[num:(num + len(tmp_blocks))] = tmp_blocks
+    read_id[num:(num + len(tmp_id))] = tmp_id
+    return (size, blocks, read_id)
+
+
+def load_coverage(bam_f, bam, splice_flag=True):
+    '''
+    Load coverage saved next to bam_f, or build and save it
+    '''
+    cov_dir = '%s.%s.cov' % (bam_f, 'split' if splice_flag else 'span')
+    if os.path.isfile('%s/meta.json' % cov_dir):
+        try:
+            cov = BaseCoverage.load(cov_dir)
+        except (IOError, OSError, KeyError, ValueError):
+            cov = None  # coverage of older version or partly removed
+        if cov is not None and \
+           cov.meta.get('fingerprint') == fingerprint(bam_f):
+            return cov
+    print('Build base coverage for %s...' % bam_f)
+    cov = BaseCoverage.build(bam, splice_flag)
+    cov.meta = {'fingerprint': fingerprint(bam_f)}
+    try:
+        cov.save(cov_dir)
+    except (IOError, OSError):
+        print('Warning: cannot save base coverage to %s!' % cov_dir)
+    return cov
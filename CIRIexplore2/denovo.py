@@ -12,7 +12,10 @@ events.
     --abs=ABS                      Detect alternative back-splicing and output.
     -b JUNC --bed=JUNC             Input file.
     -d CUFF --cuff=CUFF            assemble folder output by CIRCexplorer2 \
-assemble. [default: '']
+assemble, its novel isoforms are overlaid on the gene annotation index \
+(<OUT>/combined_ref.txt.cidx). [default: '']
+    --combined-ref                 Also write the combined gene annotation \
+<OUT>/combined_ref.txt (not written by default).
     -m TOPHAT --tophat=TOPHAT      TopHat mapping folder.
     -n PLUS_OUT --pAplus=PLUS_OUT  TopHat mapping directory for p(A)+ RNA-seq.
     -o OUT --output=OUT            Output Folder. [default: denovo]
@@ -20,17 +23,31 @@ assemble. [default: '']
     --no-fix                       No-fix mode (useful for species \
 with poor gene annotations).
     --rpkm                         Calculate RPKM for cassette exons.
+    --tabix                        Also write sorted and BGZF-compressed \
+circRNA outputs with tabix index (<output>.gz).
+    -p THREAD --thread=THREAD      Running threads, AS and ABS analyses are \
+run concurrently. [default: 1]
 """
 
 import sys
+import time
+import shutil
 import os.path
+import pysam
+import numpy as np
 from collections import defaultdict, deque
-from annotate import annotate_fusion, fix_fusion
-from parser import parse_junc
-from helper import logger, fetch_psi, fetch_read, Expression
+from annotate import annotate_fusion, fix_fusion, pool_map
+from parser import check_fasta
+from junction_graph import load_junctions
+from twobit import TwoBitGenome
+from helper import logger, Expression
+from coverage import count_intron_reads
 from dir_func import check_dir, create_dir
-from scipy.stats import fisher_exact, binom
-from genomic_interval import Interval
+from stat_test import fisher_exact_batch, binom_cdf_batch
+from interval_array import IntervalArray
+from sorted_output import index_bed
+from circ_table import load_circ
+from annotation_index import load_index, load_overlay
 
 __author__ = [
     'Xiao-Ou Zhang (zhangxiaoou@picb.ac.cn)',
@@ -39,6 +56,10 @@ __author__ = [
 
 __all__ = ['denovo']
 
+# dinucleotides as (first base << 8 | second base)
+DINUCLEOTIDE = dict((x, (ord(x[0]) << 8) | ord(x[1]))
+                    for x in ('AG', 'GT', 'AC', 'CT'))
+
 
 @logger
 def denovo(options):
@@ -54,25 +75,30 @@ def denovo(options):
         print('Combine %s with %s to create a new ref file!' %
               (options['--ref'], cufflinks_ref_path))
         ref_path = '%s/combined_ref.txt' % denovo_dir
-        new_ref_f = open(ref_path, 'w')
-        with open(cufflinks_ref_path, 'r') as cuff_ref:
-            for line in cuff_ref:
-                if line.startswith('CUFF'):  # only import novel isoforms
-                    new_ref_f.write(line)
-        new_ref_f.write(open(options['--ref'], 'r').read())
-        new_ref_f.close()
+        # only import novel isoforms, overlaid on the annotation index
+        load_overlay(options['--ref'], cufflinks_ref_path, ref_path)
+        if options['--combined-ref']:
+            write_combined_ref(options['--ref'], cufflinks_ref_path,
+                               ref_path)
     else:
         print('Warning: no cufflinks directory %s!' % options['--cuff'])
         print('Please run CIRCexplorer2 assembly before this step!')
         ref_path = options['--ref']
+    thread = int(options['--thread'])
     # annotate fusion junctions
-    annotate_fusion(ref_path, options['--bed'], denovo_flag=1)
+    candidates = annotate_fusion(ref_path, options['--bed'], denovo_flag=1,
+                                 thread=thread)
     # fix fusion juncrions
     out_f = '%s/circularRNA_full.txt' % denovo_dir
     fix_fusion(ref_path, options['--genome'], out_f,
-               options['--no-fix'], denovo_flag=1)
+               options['--no-fix'], candidates, denovo_flag=1, thread=thread)
     # extract novel circRNAs
     extract_novel_circ(denovo_dir, options['--ref'])
+    if options['--tabix']:
+        for circ_f in ('circularRNA_full', 'novel_circ', 'annotated_circ'):
+            index_bed('%s/%s.txt' % (denovo_dir, circ_f))
+        print('Write sorted and indexed circRNAs in %s!' % denovo_dir)
+    analyses = []  # (name, function, args) of AS and ABS analyses
     if options['--as']:
         create_dir(options['--as'])
 
@@ -88,21 +114,60 @@ def denovo(options):
 
         if not options['--as-type'] or options['--as-type'] == 'CE':
             # extract cassette exons
-            extract_cassette_exon(denovo_dir, tophat_dir, pAplus_dir,
-                                  options['--as'], options['--rpkm'])
+            analyses.append(('CE', extract_cassette_exon,
+                             (denovo_dir, tophat_dir, pAplus_dir,
+                              options['--as'], options['--rpkm'])))
         if not options['--as-type'] or options['--as-type'] == 'RI':
             # extract retained introns
-            extract_retained_intron(denovo_dir, tophat_dir, pAplus_dir,
-                                    options['--as'])
+            analyses.append(('RI', extract_retained_intron,
+                             (denovo_dir, tophat_dir, pAplus_dir,
+                              options['--as'])))
         if not options['--as-type'] or options['--as-type'] == 'ASS':
             # characterize A5SS and A3SS
-            parse_splice_site(denovo_dir, tophat_dir, pAplus_dir,
-                              options['--as'])
+            analyses.append(('ASS', parse_splice_site,
+                             (denovo_dir, tophat_dir, pAplus_dir,
+                              options['--as'])))
+        # shared by forked analysis processes
+        load_junctions(tophat_dir + '/junctions.bed')
+        load_junctions('%s/junctions.bed' % pAplus_dir)
 
     if options['--abs']:
         create_dir(options['--abs'])
 
-        analyze_abs(denovo_dir, options['--genome'], options['--abs'])
+        analyses.append(('ABS', analyze_abs,
+                         (denovo_dir, options['--genome'], options['--abs'])))
+
+    if analyses:
+        load_circ(out_f)  # shared by forked analysis processes
+        for name, elapsed in pool_map(run_analysis, analyses,
+                                      min(thread, len(analyses))):
+            print('%s analysis finished in %.1f seconds!' % (name, elapsed))
+
+
+def run_analysis(args):
+    '''
+    Run one AS or ABS analysis
+    args: (name, function, function args)
+    Return (name, wall time in seconds)
+    '''
+    name, func, func_args = args
+    start = time.time()
+    func(*func_args)
+    return (name, time.time() - start)
+
+
+def write_combined_ref(ref_path, cufflinks_ref_path, combined_ref_path):
+    """
+    Write novel isoforms followed by gene annotations without reading the
+    whole gene annotation file into memory
+    """
+    with open(combined_ref_path, 'w') as new_ref_f:
+        with open(cufflinks_ref_path, 'r') as cuff_ref:
+            for line in cuff_ref:
+                if line.startswith('CUFF'):  # only import novel isoforms
+                    new_ref_f.write(line)
+        with open(ref_path, 'r') as ref_f:
+            shutil.copyfileobj(ref_f, new_ref_f)
 
 
 def extract_novel_circ(denovo_dir, ref_path):
@@ -112,29 +177,22 @@ def extract_novel_circ(denovo_dir, ref_path):
     print('Start to fetch novel circular RNAs...')
     all_circ = {}
     # set path
-    fusion_f = '%s/circularRNA_full.txt' % denovo_dir
-    with open(fusion_f, 'r') as f:
-        for line in f:
-            circ_type = line.split()[13]
-            if circ_type == 'ciRNA':  # not fetch ciRNAs
-                continue
-            chrom, start, end, name, score, strand = line.split()[:6]
-            circ_id = '\t'.join([chrom, start, end, name, score, strand])
-            iso = line.split()[14]
-            if circ_id in all_circ:
-                if all_circ[circ_id].startswith('CUFF'):
-                    all_circ[circ_id] = iso
-            else:
-                all_circ[circ_id] = iso
-    ref_left = set()
-    ref_right = set()
-    with open(ref_path, 'r') as ref_f:
-        for line in ref_f:
-            chrom = line.split()[2]
-            for x in line.split()[9].rstrip(',').split(','):
-                ref_left.add('\t'.join([chrom, x]))
-            for x in line.split()[10].rstrip(',').split(','):
-                ref_right.add('\t'.join([chrom, x]))
+    circ = load_circ('%s/circularRNA_full.txt' % denovo_dir)
+    for n in range(len(circ)):
+        if circ.type[n] == 'ciRNA':  # not fetch ciRNAs
+            continue
+        circ_id = '%s\t%d\t%d\t%s\t%d\t%s' % (circ.chrom[n],
+                                              circ.start_list[n],
+                                              circ.end_list[n], circ.name[n],
+                                              circ.score_list[n],
+                                              circ.strand[n])
+        gene = circ.gene[n]
+        if circ_id in all_circ:
+            if all_circ[circ_id].startswith('CUFF'):
+                all_circ[circ_id] = gene
+        else:
+            all_circ[circ_id] = gene
+    ref_index = load_index(ref_path)
     novel_out = '%s/novel_circ.txt' % denovo_dir
     annotated_out = '%s/annotated_circ.txt' % denovo_dir
     novel_circ_num = 0
@@ -143,13 +201,12 @@ def extract_novel_circ(denovo_dir, ref_path):
             if all_circ[circ_id].startswith('CUFF'):
                 novel_circ_num += 1
                 chrom, start, end, name, score, strand = circ_id.split()
-                left_id = '\t'.join([chrom, start])
-                right_id = '\t'.join([chrom, end])
-                if left_id in ref_left:
+                ref_left, ref_right = ref_index.boundaries(chrom)
+                if in_sorted(int(start), ref_left):
                     left_flag = 'Annotated'
                 else:
                     left_flag = 'Novel'
-                if right_id in ref_right:
+                if in_sorted(int(end), ref_right):
                     right_flag = 'Annotated'
                 else:
                     right_flag = 'Novel'
@@ -161,6 +218,14 @@ def extract_novel_circ(denovo_dir, ref_path):
     print('Fetch %d circular RNAs!' % novel_circ_num)
 
 
+def in_sorted(value, array):
+    """
+    Whether value is in sorted array
+    """
+    i = np.searchsorted(array, value)
+    return i < len(array) and array[i] == value
+
+
 def extract_cassette_exon(denovo_dir, tophat_dir, pAplus_dir, output_dir,
                           rpkm_flag):
     """
@@ -170,93 +235,74 @@ def extract_cassette_exon(denovo_dir, tophat_dir, pAplus_dir, output_dir,
     """
     print('Start to parse circular RNA exons...')
     exons = {}
+    exon_stats = []
     # set path
-    fusion_f = '%s/circularRNA_full.txt' % denovo_dir
-    pAminus_junc_f = tophat_dir + '/junctions.bed'
-    (pAminus_junc,
-     pAminus_left_junc,
-     pAminus_right_junc) = parse_junc(pAminus_junc_f, 1)
-    pAplus_junc_f = '%s/junctions.bed' % pAplus_dir
-    (pAplus_junc,
-     pAplus_left_junc,
-     pAplus_right_junc) = parse_junc(pAplus_junc_f, 1)
+    circ = load_circ('%s/circularRNA_full.txt' % denovo_dir)
+    pAminus_junc = load_junctions(tophat_dir + '/junctions.bed')
+    pAplus_junc = load_junctions('%s/junctions.bed' % pAplus_dir)
     if rpkm_flag:
-        pAminus_bam = Expression('%s/accepted_hits.bam' % tophat_dir)
-        pAplus_bam = Expression('%s/accepted_hits.bam' % pAplus_dir)
-    with open(fusion_f, 'r') as f:
-        for line in f:
-            circ_type = line.split()[13]
-            if circ_type == 'ciRNA':  # not check ciRNAs
-                continue
-            reads = line.split()[12]
-            chrom = line.split()[0]
-            start = int(line.split()[1])
-            strand = line.split()[5]
-            sizes = [int(x) for x in line.split()[10].split(',')]
-            offsets = [int(x) for x in line.split()[11].split(',')]
-            gene, iso = line.split()[14:16]
-            exon_deque = deque(maxlen=3)  # set exon sliding window
-            for s, o in zip(sizes, offsets):
-                sta = start + o
-                end = start + o + s
-                exon_id = [sta, end]
-                exon_deque.append(exon_id)
-                gene_info = '\t'.join([strand, gene, iso])
-                if len(exon_deque) == 3:  # only check middle exon
-                    exon_info = '%s\t%d\t%d' % (chrom, exon_deque[1][0],
-                                                exon_deque[1][1])
-                    if exon_info in exons:
-                        if exons[exon_info][0].find('CUFF'):
-                            if not gene.startswith('CUFF'):  # annotated exon
-                                exons[exon_info][0] = gene_info
-                        if int(reads) > int(exons[exon_info][1]):  # more reads
-                            exons[exon_info][1] = reads
+        pAminus_bam = Expression('%s/accepted_hits.bam' % tophat_dir,
+                                 coverage_flag=True)
+        pAplus_bam = Expression('%s/accepted_hits.bam' % pAplus_dir,
+                                coverage_flag=True)
+    for n in range(len(circ)):
+        if circ.type[n] == 'ciRNA':  # not check ciRNAs
+            continue
+        reads = str(circ.reads_list[n])
+        chrom = circ.chrom[n]
+        strand = circ.strand[n]
+        gene, iso = circ.gene[n], circ.iso[n]
+        exon_deque = deque(maxlen=3)  # set exon sliding window
+        for exon_id in circ.exons(n):
+            exon_deque.append(exon_id)
+            gene_info = '\t'.join([strand, gene, iso])
+            if len(exon_deque) == 3:  # only check middle exon
+                exon_info = '%s\t%d\t%d' % (chrom, exon_deque[1][0],
+                                            exon_deque[1][1])
+                if exon_info in exons:
+                    if exons[exon_info][0].find('CUFF'):
+                        if not gene.startswith('CUFF'):  # annotated exon
+                            exons[exon_info][0] = gene_info
+                    if int(reads) > int(exons[exon_info][1]):  # more reads
+                        exons[exon_info][1] = reads
+                else:
+                    # fetch junctions for circular RNAs
+                    (psi_circ,
+                     inclusion_circ,
+                     exclusion_circ,
+                     max_left_circ,
+                     max_right_circ) = pAminus_junc.psi(chrom,
+                                                        *exon_deque[1])
+                    if max_left_circ is None or max_right_circ is None:
+                        flag = []
                     else:
-                        # fetch junctions for circular RNAs
-                        (psi_circ,
-                         inclusion_circ,
-                         exclusion_circ,
-                         max_left_circ,
-                         max_right_circ) = fetch_psi(exon_info,
-                                                     pAminus_junc,
-                                                     pAminus_left_junc,
-                                                     pAminus_right_junc)
-                        if max_left_circ == 'None' or max_left_circ == 'None':
-                            flag = []
-                        else:
-                            flag = [max_left_circ, max_right_circ]
-                        # fetch junctions for linear RNAs
-                        (psi_linear,
-                         inclusion_linear,
-                         exclusion_linear) = fetch_psi(exon_info,
-                                                       pAplus_junc,
-                                                       pAplus_left_junc,
-                                                       pAplus_right_junc,
-                                                       flag)
-                        # fisher exact test (circular > linear)
-                        odd1, p1 = fisher_exact([[inclusion_circ,
-                                                  2 * exclusion_circ],
-                                                 [inclusion_linear,
-                                                  2 * exclusion_linear]],
-                                                alternative='greater')
-                        # fisher exact test (circular < linear)
-                        odd2, p2 = fisher_exact([[inclusion_circ,
-                                                  2 * exclusion_circ],
-                                                [inclusion_linear,
-                                                 2 * exclusion_linear]],
-                                                alternative='less')
-                        info = '\t'.join(str(round(float(x), 3))
-                                         for x in (psi_circ, psi_linear, p1,
-                                                   p2,
-                                                   inclusion_circ,
-                                                   exclusion_circ,
-                                                   inclusion_linear,
-                                                   exclusion_linear))
-                        if rpkm_flag:
-                            circ_exp = pAminus_bam.rpkm(chrom, *exon_deque[1])
-                            linear_exp = pAplus_bam.rpkm(chrom, *exon_deque[1])
-                            info += '\t%.3f\t%.3f' % (circ_exp, linear_exp)
-                        exons[exon_info] = [gene_info, reads, info]
+                        flag = [max_left_circ, max_right_circ]
+                    # fetch junctions for linear RNAs
+                    (psi_linear,
+                     inclusion_linear,
+                     exclusion_linear) = pAplus_junc.psi(chrom,
+                                                         *exon_deque[1],
+                                                         max_flag=flag)
+                    # fisher exact tests are done after parsing
+                    exon_stats.append([exon_info, psi_circ, psi_linear,
+                                       inclusion_circ, exclusion_circ,
+                                       inclusion_linear,
+                                       exclusion_linear])
+                    if rpkm_flag:
+                        circ_exp = pAminus_bam.rpkm(chrom, *exon_deque[1])
+                        linear_exp = pAplus_bam.rpkm(chrom, *exon_deque[1])
+                        exon_stats[-1] += [circ_exp, linear_exp]
+                    exons[exon_info] = [gene_info, reads, None]
+    # fisher exact test (circular > linear and circular < linear)
+    p1, p2 = fisher_exact_batch([[x[3], 2 * x[4], x[5], 2 * x[6]]
+                                 for x in exon_stats])
+    for n, stat in enumerate(exon_stats):
+        info = '\t'.join(str(round(float(x), 3))
+                         for x in (stat[1], stat[2], p1[n], p2[n],
+                                   stat[3], stat[4], stat[5], stat[6]))
+        if rpkm_flag:
+            info += '\t%.3f\t%.3f' % (stat[7], stat[8])
+        exons[stat[0]][2] = info
     output_f = '%s/all_exon_info.txt' % output_dir
     with open(output_f, 'w') as output:
         for exon in exons:
@@ -274,13 +320,11 @@ def extract_retained_intron(denovo_dir, tophat_dir, pAplus_dir, output_dir):
     """
     print('Start to parse circular RNA introns...')
     # set path
-    fusion_f = '%s/circularRNA_full.txt' % denovo_dir
-    pAminus_junc_f = tophat_dir + '/junctions.bed'
-    pAminus_junc = parse_junc(pAminus_junc_f)
+    circ = load_circ('%s/circularRNA_full.txt' % denovo_dir)
+    pAminus_junc = load_junctions(tophat_dir + '/junctions.bed')
     pAminus_bam_f = tophat_dir + '/accepted_hits.bam'
     pAminus_bam = pysam.AlignmentFile(pAminus_bam_f, 'rb')
-    pAplus_junc_f = '%s/junctions.bed' % pAplus_dir
-    pAplus_junc = parse_junc(pAplus_junc_f)
+    pAplus_junc = load_junctions('%s/junctions.bed' % pAplus_dir)
     pAplus_bam_f = '%s/accepted_hits.bam' % pAplus_dir
     pAplus_bam = pysam.AlignmentFile(pAplus_bam_f, 'rb')
     excluded_region = defaultdict(list)
@@ -288,104 +332,106 @@ def extract_retained_intron(denovo_dir, tophat_dir, pAplus_dir, output_dir):
     intron = defaultdict(list)
     intron_list = set()
     intron_info_list = {}
-    with open(fusion_f, 'r') as f:
-        for line in f:
-            chrom, start, end = line.split()[:3]
-            start = int(start)
-            end = int(end)
-            strand = line.split()[5]
-            circ_type = line.split()[13]
-            if circ_type == 'ciRNA':  # not check ciRNAs
-                excluded_region[chrom].append([start, end])
+    for n in range(len(circ)):
+        chrom = circ.chrom[n]
+        strand = circ.strand[n]
+        if circ.type[n] == 'ciRNA':  # not check ciRNAs
+            excluded_region[chrom].append([circ.start_list[n],
+                                           circ.end_list[n]])
+            continue
+        exons = circ.exons(n)
+        reads = str(circ.reads_list[n])
+        gene, iso = circ.gene[n], circ.iso[n]
+        if gene.startswith('CUFF'):
+            novel_region[chrom] += exons
+            continue  # only check annotated introns
+        excluded_region[chrom] += exons
+        for i in range(len(exons) - 1):
+            sta = exons[i][1]
+            end = exons[i + 1][0]
+            if end - sta == 0:
                 continue
-            sizes = [int(x) for x in line.split()[10].split(',')]
-            offsets = [int(x) for x in line.split()[11].split(',')]
-            reads = line.split()[12]
-            gene, iso = line.split()[14:16]
-            for s, o in zip(sizes, offsets):
-                if gene.startswith('CUFF'):
-                    novel_region[chrom].append([start + o, start + o + s])
-                else:
-                    excluded_region[chrom].append([start + o, start + o + s])
-            if gene.startswith('CUFF'):  # only check annotated introns
+            intron_info = '%s\t%d\t%d\t%s' % (chrom, sta, end, strand)
+            if intron_info in intron_list:
+                if int(reads) > int(intron_info_list[intron_info][2]):
+                    intron_info_list[intron_info] = [gene, iso, reads]
                 continue
-            num = int(line.split()[9])
-            for i in range(num - 1):
-                sta = start + offsets[i] + sizes[i]
-                end = start + offsets[i + 1]
-                if end - sta == 0:
-                    continue
-                intron_info = '%s\t%d\t%d\t%s' % (chrom, sta, end, strand)
-                if intron_info in intron_list:
-                    if int(reads) > int(intron_info_list[intron_info][2]):
-                        intron_info_list[intron_info] = [gene, iso, reads]
-                    continue
-                intron[chrom].append([sta, end, intron_info])
-                intron_list.add(intron_info)
-                intron_info_list[intron_info] = [gene, iso, reads]
+            intron[chrom].append([sta, end, intron_info])
+            intron_list.add(intron_info)
+            intron_info_list[intron_info] = [gene, iso, reads]
     intron_set = set()
     for chrom in excluded_region:
         intron_region = []
         # retain introns covered by novel assembled transcripts
-        combined_region = Interval(novel_region[chrom]).interval
-        for region in Interval.overlapwith(combined_region, intron[chrom]):
+        combined_region = IntervalArray(novel_region[chrom])
+        for region in IntervalArray.overlapwith(combined_region,
+                                                intron[chrom]):
             if len(region) >= 3:
                 for intron_info in region[2:]:
                     chrom, start, end = intron_info.split()[:3]
                     intron_region.append([int(start), int(end), intron_info])
                     intron_set.add(intron_info)
         # remove introns overlapped with annotated exons
-        combined_region = Interval(excluded_region[chrom]).interval
-        for region in Interval.overlapwith(combined_region, intron_region):
+        combined_region = IntervalArray(excluded_region[chrom])
+        for region in IntervalArray.overlapwith(combined_region,
+                                                intron_region):
             if len(region) >= 3:
                 for intron_info in region[2:]:
                     intron_set.discard(intron_info)
+    intron_list = list(intron_set)
+    regions = []
+    for intron in intron_list:
+        chrom, sta, end = intron.split()[:3]
+        regions.append([chrom, int(sta), int(end)])
+    # count flank-spanning reads and intron coverage for all introns
+    (circ_left_reads,
+     circ_right_reads,
+     circ_intron_reads) = count_intron_reads(pAminus_bam, regions)
+    (linear_left_reads,
+     linear_right_reads,
+     linear_intron_reads) = count_intron_reads(pAplus_bam, regions)
+    # exact one-side binomial tests for circular and linear RNAs
+    p = 1 / 3.5
+    circ_reads = np.column_stack((circ_left_reads, circ_right_reads,
+                                  circ_intron_reads))
+    m = circ_reads.min(axis=1)
+    p1 = binom_cdf_batch(m, m + circ_reads.max(axis=1), p)
+    linear_reads = np.column_stack((linear_left_reads, linear_right_reads,
+                                    linear_intron_reads))
+    m = linear_reads.min(axis=1)
+    p2 = binom_cdf_batch(m, m + linear_reads.max(axis=1), p)
     output_f = '%s/all_intron_info.txt' % output_dir
     with open(output_f, 'w') as output:
-        for intron in intron_set:
+        for n, intron in enumerate(intron_list):
             chrom, sta, end, strand = intron.split()
-            intron_info = '\t'.join([chrom, sta, end])
             sta = int(sta)
             end = int(end)
             # fetch junctions for circular RNAs
-            circ_junc_read = pAminus_junc[intron_info]
-            circ_left_read = fetch_read(pAminus_bam, chrom, sta - 8, sta + 8)
-            circ_right_read = fetch_read(pAminus_bam, chrom, end - 8, end + 8)
+            circ_junc_read = pAminus_junc.reads(chrom, sta, end)
+            circ_left_read = int(circ_left_reads[n])
+            circ_right_read = int(circ_right_reads[n])
             circ_ri_read = circ_left_read + circ_right_read
-            circ_intron_read = fetch_read(pAminus_bam, chrom, sta, end, flag=0)
+            circ_intron_read = float(circ_intron_reads[n])
             # calculate PIR for circular RNAs
             if circ_ri_read == 0 and circ_junc_read == 0:
                 pir_circ = 0
             else:
                 pir_circ = 100.0 * circ_ri_read / (circ_ri_read +
                                                    2 * circ_junc_read)
-            # exact binomial test for circular RNAs
-            m = min(circ_left_read, circ_right_read, circ_intron_read)
-            n = m + max(circ_left_read, circ_right_read, circ_intron_read)
-            p = 1 / 3.5
-            p1 = binom.cdf(m, n, p)  # one-side binomial test
             # fetch junctions for linear RNAs
-            linear_junc_read = pAplus_junc[intron_info]
-            linear_left_read = fetch_read(pAplus_bam, chrom, sta - 8, sta + 8)
-            linear_right_read = fetch_read(pAplus_bam, chrom, end - 8, end + 8)
+            linear_junc_read = pAplus_junc.reads(chrom, sta, end)
+            linear_left_read = int(linear_left_reads[n])
+            linear_right_read = int(linear_right_reads[n])
             linear_ri_read = linear_left_read + linear_right_read
-            linear_intron_read = fetch_read(pAplus_bam, chrom, sta, end,
-                                            flag=0)
+            linear_intron_read = float(linear_intron_reads[n])
             # calculate PIR for linear RNAs
             if linear_ri_read == 0 and linear_junc_read == 0:
                 pir_linear = 0
             else:
                 pir_linear = 100.0 * linear_ri_read / (linear_ri_read +
                                                        linear_junc_read * 2)
-            # exact binomial test for linear RNAs
-            m = min(linear_left_read, linear_right_read,
-                    linear_intron_read)
-            n = m + max(linear_left_read, linear_right_read,
-                        linear_intron_read)
-            p = 1 / 3.5
-            p2 = binom.cdf(m, n, p)  # one-side binomial test
             info = '\t'.join(str(round(float(x), 3))
-                             for x in (pir_circ, pir_linear, p1, p2,
+                             for x in (pir_circ, pir_linear, p1[n], p2[n],
                                        circ_ri_read,
                                        circ_junc_read,
                                        circ_intron_read,
@@ -407,86 +453,69 @@ def parse_splice_site(denovo_dir, tophat_dir, pAplus_dir, output_dir):
     splice_site_5 = set()
     splice_site_3 = set()
     # set path
-    fusion_f = '%s/circularRNA_full.txt' % denovo_dir
-    pAminus_junc_f = tophat_dir + '/junctions.bed'
-    (pAminus_junc,
-     pAminus_left_junc,
-     pAminus_right_junc) = parse_junc(pAminus_junc_f, 2)
-    pAplus_junc_f = '%s/junctions.bed' % pAplus_dir
-    (pAplus_junc,
-     pAplus_left_junc,
-     pAplus_right_junc) = parse_junc(pAplus_junc_f, 2)
-    with open(fusion_f, 'r') as f:
-        for line in f:
-            circ_type = line.split()[13]
-            if circ_type == 'ciRNA':  # not check ciRNAs
+    circ = load_circ('%s/circularRNA_full.txt' % denovo_dir)
+    pAminus_junc = load_junctions(tophat_dir + '/junctions.bed')
+    pAplus_junc = load_junctions('%s/junctions.bed' % pAplus_dir)
+    for n in range(len(circ)):
+        if circ.type[n] == 'ciRNA':  # not check ciRNAs
+            continue
+        chrom = circ.chrom[n]
+        strand = circ.strand[n]
+        exons = circ.exons(n)
+        starts = [x[0] for x in exons[1:]]
+        ends = [x[1] for x in exons[:-1]]
+        for s, e in zip(ends, starts):
+            loc = '%s\t%d\t%d' % (chrom, s, e)
+            if (chrom, s, e) in pAminus_junc:
+                pAminus_reads = pAminus_junc.reads(chrom, s, e)
+            else:  # circ_pcu=0
                 continue
-            chrom = line.split()[0]
-            start = int(line.split()[1])
-            strand = line.split()[5]
-            sizes = [int(x) for x in line.split()[10].split(',')]
-            offsets = [int(x) for x in line.split()[11].split(',')]
-            starts, ends = [], []
-            for s, o in zip(sizes, offsets):
-                starts.append(start + o)
-                ends.append(start + o + s)
-            starts = starts[1:]
-            ends = ends[:-1]
-            for s, e in zip(ends, starts):
-                loc = '%s\t%d\t%d' % (chrom, s, e)
-                left_id = '%s\t%d' % (chrom, s)
-                right_id = '%s\t%d' % (chrom, e)
-                if loc in pAminus_junc:
-                    pAminus_reads = pAminus_junc[loc]
-                else:  # circ_pcu=0
-                    continue
-                if loc in pAplus_junc:
-                    pAplus_reads = pAplus_junc[loc]
+            pAplus_reads = pAplus_junc.reads(chrom, s, e)
+            if pAminus_junc.donor_total(chrom, s) != 0:
+                pAminus_left_total = pAminus_junc.donor_total(chrom, s)
+                pAminus_left_psu = (pAminus_reads * 100.0 /
+                                    pAminus_left_total)
+                pAplus_left_total = pAplus_junc.donor_total(chrom, s)
+                if pAplus_left_total != 0:
+                    pAplus_left_psu = (pAplus_reads * 100.0 /
+                                       pAplus_left_total)
                 else:
-                    pAplus_reads = 0
-                if pAminus_left_junc[left_id] != 0:
-                    pAminus_left_total = pAminus_left_junc[left_id]
-                    pAminus_left_psu = (pAminus_reads * 100.0 /
-                                        pAminus_left_total)
-                    pAplus_left_total = pAplus_left_junc[left_id]
-                    if pAplus_left_total != 0:
-                        pAplus_left_psu = (pAplus_reads * 100.0 /
-                                           pAplus_left_total)
-                    else:
-                        pAplus_left_psu = 0.0
-                else:  # circ_left_total_reads=0
-                    continue
-                if pAminus_right_junc[right_id] != 0:
-                    pAminus_right_total = pAminus_right_junc[right_id]
-                    pAminus_right_psu = (pAminus_reads * 100.0 /
-                                         pAminus_right_total)
-                    pAplus_right_total = pAplus_right_junc[right_id]
-                    if pAplus_right_total != 0:
-                        pAplus_right_psu = (pAplus_reads * 100.0 /
-                                            pAplus_right_total)
-                    else:
-                        pAplus_right_psu = 0.0
-                else:  # circ_right_total_reads=0
-                    continue
-                f = '%s\t%s\t%d\t%d\t%f\t%d\t%d\t%f\n'
-                left_info = f % (loc, strand, pAminus_reads,
-                                 pAminus_left_total, pAminus_left_psu,
-                                 pAplus_reads, pAplus_left_total,
-                                 pAplus_left_psu)
-                right_info = f % (loc, strand, pAminus_reads,
-                                  pAminus_right_total, pAminus_right_psu,
-                                  pAplus_reads, pAplus_right_total,
-                                  pAplus_right_psu)
-                if strand == '+':
-                    if pAminus_left_psu != 100:
-                        splice_site_3.add(left_info)
-                    if pAminus_right_psu != 100:
-                        splice_site_5.add(right_info)
+                    pAplus_left_psu = 0.0
+            else:  # circ_left_total_reads=0
+                continue
+            if pAminus_junc.acceptor_total(chrom, e) != 0:
+                pAminus_right_total = pAminus_junc.acceptor_total(chrom,
+                                                                  e)
+                pAminus_right_psu = (pAminus_reads * 100.0 /
+                                     pAminus_right_total)
+                pAplus_right_total = pAplus_junc.acceptor_total(chrom,
+                                                                e)
+                if pAplus_right_total != 0:
+                    pAplus_right_psu = (pAplus_reads * 100.0 /
+                                        pAplus_right_total)
                 else:
-                    if pAminus_left_psu != 100:
-                        splice_site_5.add(left_info)
-                    if pAminus_right_psu != 100:
-                        splice_site_3.add(right_info)
+                    pAplus_right_psu = 0.0
+            else:  # circ_right_total_reads=0
+                continue
+            f = '%s\t%s\t%d\t%d\t%f\t%d\t%d\t%f\n'
+            left_info = f % (loc, strand, pAminus_reads,
+                             pAminus_left_total, pAminus_left_psu,
+                             pAplus_reads, pAplus_left_total,
+                             pAplus_left_psu)
+            right_info = f % (loc, strand, pAminus_reads,
+                              pAminus_right_total, pAminus_right_psu,
+                              pAplus_reads, pAplus_right_total,
+                              pAplus_right_psu)
+            if strand == '+':
+                if pAminus_left_psu != 100:
+                    splice_site_3.add(left_info)
+                if pAminus_right_psu != 100:
+                    splice_site_5.add(right_info)
+            else:
+                if pAminus_left_psu != 100:
+                    splice_site_5.add(left_info)
+                if pAminus_right_psu != 100:
+                    splice_site_3.add(right_info)
     output_f = '%s/all_A5SS_info.txt' % output_dir
     with open(output_f, 'w') as output:
         output.write(''.join(splice_site_5))
@@ -497,8 +526,11 @@ def parse_splice_site(denovo_dir, tophat_dir, pAplus_dir, output_dir):
 
 
 def get_strand(fa, chrom, start, end, strand):
-    left = fa.fetch(chrom, start - 2, start).upper()
-    right = fa.fetch(chrom, end, end + 2).upper()
+    left = fa.fetch(chrom, start - 2, start)
+    right = fa.fetch(chrom, end, end + 2)
+    if not isinstance(fa, TwoBitGenome):
+        left = left.upper()
+        right = right.upper()
     if left == 'AG' or right == 'GT':
         return '+'
     elif left == 'AC' or right == 'CT':
@@ -507,98 +539,103 @@ def get_strand(fa, chrom, start, end, strand):
         return strand
 
 
+def get_strands(fa, chroms, starts, ends, strands):
+    """
+    Batched get_strand for junctions, bases flanking all the junctions of
+    one chromosome are fetched in one sorted sweep of the 2-bit genome
+    """
+    if not isinstance(fa, TwoBitGenome):
+        return [get_strand(fa, chrom, start, end, strand)
+                for chrom, start, end, strand in zip(chroms, starts, ends,
+                                                     strands)]
+    starts = np.asarray(starts, dtype=np.int64)
+    ends = np.asarray(ends, dtype=np.int64)
+    num = len(starts)
+    # left dinucleotide [start - 2, start), right dinucleotide [end, end + 2)
+    bases = np.zeros((4, num), np.uint8)
+    chrom_names, chrom_ids = np.unique(np.asarray(chroms, dtype=str),
+                                       return_inverse=True)
+    chrom_ids = chrom_ids.reshape(-1)
+    for n, chrom in enumerate(chrom_names.tolist()):
+        rows = np.flatnonzero(chrom_ids == n)
+        positions = np.concatenate((starts[rows] - 2, starts[rows] - 1,
+                                    ends[rows], ends[rows] + 1))
+        order = np.argsort(positions, kind='mergesort')
+        chrom_bases = np.empty(len(positions), np.uint8)
+        chrom_bases[order] = fa.bases(chrom, positions[order])
+        bases[:, rows] = chrom_bases.reshape(4, -1)
+    left = (bases[0].astype(np.int64) << 8) | bases[1]
+    right = (bases[2].astype(np.int64) << 8) | bases[3]
+    plus = (left == DINUCLEOTIDE['AG']) | (right == DINUCLEOTIDE['GT'])
+    minus = (left == DINUCLEOTIDE['AC']) | (right == DINUCLEOTIDE['CT'])
+    strands = np.asarray(strands, dtype=str)
+    return np.where(plus, '+', np.where(minus, '-', strands)).tolist()
+
+
 def analyze_abs(denovo_dir, fasta, output_dir):
-    fa = pysam.FastaFile(fasta)
-    main_circ = set()
-    all_circ = set()
-    site5 = defaultdict(int)
-    site3 = defaultdict(int)
-    circ_f = '%s/circularRNA_full.txt' % denovo_dir
-    with open(circ_f, 'r') as f:
-        for line in f:
-            chrom, start, end, name, _, strand = line.split()[:6]
-            read = name.split('/')[1]
-            gene = line.split()[14]
-            if gene.startswith('CUFF'):
-                strand = get_strand(fa, chrom, int(start), int(end), strand)
-            circ_id = '\t'.join([chrom, start, end, read, strand])
-            if circ_id not in all_circ:
-                all_circ.add(circ_id)
-                rpm = float(line.split()[12])
-                if rpm >= 0.1:
-                    main_circ.add(circ_id)
-                left_id = '\t'.join([chrom, start])
-                right_id = '\t'.join([chrom, end])
-                if strand == '+':
-                    site3[left_id] += int(read)
-                    site5[right_id] += int(read)
-                else:
-                    site3[right_id] += int(read)
-                    site5[left_id] += int(read)
+    fa = check_fasta(fasta)
+    circ = load_circ('%s/circularRNA_full.txt' % denovo_dir)
+    reads = np.asarray([int(x.split('/')[1]) for x in circ.name],
+                       dtype=np.int64)
+    strands = list(circ.strand)
+    # infer strands of novel circRNAs
+    novel = [n for n, gene in enumerate(circ.gene) if gene.startswith('CUFF')]
+    novel_strands = get_strands(fa, [circ.chrom[n] for n in novel],
+                                circ.start[novel], circ.end[novel],
+                                [strands[n] for n in novel])
+    for n, strand in zip(novel, novel_strands):
+        strands[n] = strand
+    chrom_names, chrom_ids = np.unique(np.asarray(circ.chrom, dtype=str),
+                                       return_inverse=True)
+    chrom_ids = chrom_ids.reshape(-1)
+    strands = np.asarray(strands, dtype=str)
+    _, strand_ids = np.unique(strands, return_inverse=True)
+    # first record of each circRNA in file order
+    keys = np.column_stack((chrom_ids, circ.start, circ.end, reads,
+                            strand_ids.reshape(-1)))
+    _, first = np.unique(keys, axis=0, return_index=True)
+    rows = np.sort(first)
+    main = circ.reads[rows] >= 0.1
+    read = reads[rows]
+    start = circ.start[rows]
+    end = circ.end[rows]
+    plus = strands[rows] == '+'
+    chrom_key = chrom_ids[rows] << 32
+    # 3' and 5' splice sites of circRNAs, keyed by chrom_id << 32 | site
+    site3 = np.where(plus, start, end)
+    site5 = np.where(plus, end, start)
+    site3_total, site3_main = site_totals(chrom_key | site3, read, main)
+    site5_total, site5_main = site_totals(chrom_key | site5, read, main)
+    site3_pci = read / site3_total
+    site5_pci = read / site5_total
+    chroms = chrom_names[chrom_ids[rows]].tolist()
+    circ_strands = strands[rows].tolist()
+    # circRNAs with main expression first, then the others at their sites
+    out5 = (site3_pci < 1.0) & (main | site3_main)
+    out3 = (site5_pci < 1.0) & (main | site5_main)
+    order = np.concatenate((np.flatnonzero(main), np.flatnonzero(~main)))
     alter5 = '%s/a5bs.txt' % output_dir
     alter3 = '%s/a3bs.txt' % output_dir
-    site3_set = set()
-    site5_set = set()
     with open(alter5, 'w') as f5, open(alter3, 'w') as f3:
-        for circ in main_circ:
-            chrom, start, end, read, strand = circ.split()
-            read = int(read)
-            left_id = '\t'.join([chrom, start])
-            right_id = '\t'.join([chrom, end])
-            if strand == '+':
-                site3_total = site3[left_id]
-                site3_id = left_id
-                site5_total = site5[right_id]
-                site5_id = right_id
-            else:
-                site3_total = site3[right_id]
-                site3_id = right_id
-                site5_total = site5[left_id]
-                site5_id = left_id
-            site3_set.add(site3_id)
-            site5_set.add(site5_id)
-            site3_pci = read * 1.0 / site3_total
-            site5_pci = read * 1.0 / site5_total
-            if site3_pci < 1.0:
-                f5.write('%s\t%s\t%s\t%s\t%s\t%d\t%f\n' % (chrom, start,
-                                                           end, strand,
-                                                           site3_id,
-                                                           site3_total,
-                                                           site3_pci))
-            if site5_pci < 1.0:
-                f3.write('%s\t%s\t%s\t%s\t%s\t%d\t%f\n' % (chrom, start,
-                                                           end, strand,
-                                                           site5_id,
-                                                           site5_total,
-                                                           site5_pci))
-        for circ in all_circ:
-            if circ in main_circ:
-                continue
-            chrom, start, end, read, strand = circ.split()
-            read = int(read)
-            left_id = '\t'.join([chrom, start])
-            right_id = '\t'.join([chrom, end])
-            if strand == '+':
-                site3_total = site3[left_id]
-                site3_id = left_id
-                site5_total = site5[right_id]
-                site5_id = right_id
-            else:
-                site3_total = site3[right_id]
-                site3_id = right_id
-                site5_total = site5[left_id]
-                site5_id = left_id
-            site3_pci = read * 1.0 / site3_total
-            site5_pci = read * 1.0 / site5_total
-            if site3_id in site3_set and site3_pci < 1.0:
-                f5.write('%s\t%s\t%s\t%s\t%s\t%d\t%f\n' % (chrom, start,
-                                                           end, strand,
-                                                           site3_id,
-                                                           site3_total,
-                                                           site3_pci))
-            if site5_id in site5_set and site5_pci < 1.0:
-                f3.write('%s\t%s\t%s\t%s\t%s\t%d\t%f\n' % (chrom, start,
-                                                           end, strand,
-                                                           site5_id,
-                                                           site5_total,
-                                                           site5_pci))
+        for n in order.tolist():
+            info = (chroms[n], start[n], end[n], circ_strands[n], chroms[n])
+            if out5[n]:
+                f5.write('%s\t%d\t%d\t%s\t%s\t%d\t%d\t%f\n' %
+                         (info + (site3[n], site3_total[n], site3_pci[n])))
+            if out3[n]:
+                f3.write('%s\t%d\t%d\t%s\t%s\t%d\t%d\t%f\n' %
+                         (info + (site5[n], site5_total[n], site5_pci[n])))
+
+
+def site_totals(site, read, main):
+    """
+    Grouped read sums of splice sites, and whether each site is used by
+    any main circRNA, returned for each circRNA
+    """
+    sites, index = np.unique(site, return_inverse=True)
+    index = index.reshape(-1)
+    total = np.zeros(len(sites), np.int64)
+    np.add.at(total, index, read)
+    main_site = np.zeros(len(sites), np.bool_)
+    main_site[index[main]] = True
+    return (total[index], main_site[index])
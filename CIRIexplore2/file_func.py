@@ -0,0 +1,29 @@
+'''
+file_func.py
+Fingerprints of input files for the saved indexes and caches
+'''
+
+import os
+import os.path
+import hashlib
+
+__all__ = ['fingerprint', 'content_hash']
+
+
+def fingerprint(in_file):
+    '''
+    Return [absolute path, size, mtime in nanoseconds] of in_file
+    '''
+    stat = os.stat(in_file)
+    return [os.path.abspath(in_file), stat.st_size, stat.st_mtime_ns]
+
+
+def content_hash(in_file):
+    '''
+    Return MD5 hex digest of in_file content
+    '''
+    md5 = hashlib.md5()
+    with open(in_file, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
@@ -6,6 +6,7 @@ version: 1.0
 '''
 
 import copy
+from collections import deque
 
 
 class Interval(object):
@@ -41,6 +42,7 @@ class Interval(object):
                a.extractwithout(b)
                mapto(interval, index) -> interval
                overlapwith(index, interval) -> index
+               overlapjoin(index, interval) -> (index, interval) pairs
     '''
     def __init__(self, interval, instance_flag=0):
         self.interval = [[int(i[0]), int(i[1])] + i[2:]
@@ -249,6 +251,19 @@ class Interval(object):
         tmp2 = Interval.__init(interval)
         return Interval.__map(tmp1, tmp2)
 
+    @staticmethod
+    def overlapjoin(index, interval, flank=11):
+        '''
+        overlapjoin(index, interval) -> (index, interval) pairs
+        Lazily yield each interval with the padded index it is overlapped
+        with in overlapwith, in sorted order of interval.
+        '''
+        tmp1 = Interval.__init(index)
+        # for boundaries conditions
+        tmp1 = [[i[0] - flank, i[1] + flank] + i[2:] for i in tmp1]
+        tmp2 = Interval.__init(interval)
+        return Interval.__sweep(tmp1, tmp2)
+
     @staticmethod
     def __convert(interval):
         assert type(interval) is list, ('the type you used is ' +
@@ -268,41 +283,34 @@ class Interval(object):
         return mapping
 
     @staticmethod
-    def __map(index, interval):
+    def __sweep(index, interval):
         '''
-        update for CIRCexplorer particularly.
+        sweep-line join of two sorted lists: each fragment goes to the first
+        dex (in sorted order) with dex[0] <= fragment[0] < dex[1] and
+        fragment[1] <= dex[1], which is O(n + m) for mutually exclusive
+        index.
         '''
-        tmp_fragment = []
-        if not interval:
-            return index
-
-        for dex in index:
-            while True:
-                try:
-                    fragment = interval.pop(0)
-                except IndexError:
-                    if tmp_fragment:
-                        interval.extend(tmp_fragment)
-                        tmp_fragment = []
-                        break
-                    else:
-                        return index
-
-                if fragment[0] < dex[0]:
-                    continue
-
-                elif fragment[0] >= dex[1]:
-                    interval.insert(0, fragment)
-                    interval[0:0] = tmp_fragment
-                    tmp_fragment = []
+        active = deque()
+        dex_iter = iter(index)
+        dex = next(dex_iter, None)
+        for fragment in interval:
+            # open dexes starting before fragment
+            while dex is not None and dex[0] <= fragment[0]:
+                active.append(dex)
+                dex = next(dex_iter, None)
+            # close dexes ending before fragment
+            while active and active[0][1] <= fragment[0]:
+                active.popleft()
+            for item in active:
+                if fragment[0] < item[1] and fragment[1] <= item[1]:
+                    yield (item, fragment)
                     break
 
-                elif fragment[1] > dex[1]:
-                    tmp_fragment.append(fragment)
-                    continue
-
-                else:
-                    dex += fragment[2:]
-
-        else:
-            return index
+    @staticmethod
+    def __map(index, interval):
+        '''
+        update for CIRCexplorer particularly.
+        '''
+        for dex, fragment in Interval.__sweep(index, interval):
+            dex += fragment[2:]
+        return index
@@ -3,9 +3,13 @@ import os
 import os.path
 import math
 import time
-from collections import defaultdict
+from collections import defaultdict, namedtuple
 from functools import wraps
+from bisect import bisect_left
+import numpy as np
 import pysam
+from twobit import TwoBitGenome
+from coverage import load_coverage
 try:
     from string import maketrans
 except ImportError:
@@ -42,21 +46,30 @@ def logger(fn):
 
 
 class Expression(object):
-    def __init__(self, bam_f):
+    def __init__(self, bam_f, coverage_flag=False, splice_flag=True,
+                 sample=10000):
         if not os.path.isfile(bam_f + '.bai'):  # index bam if not exist
             pysam.index(bam_f)
         self.bam = pysam.AlignmentFile(bam_f, 'rb')
         self.total_reads = self.bam.mapped
-        for read in self.bam:
-            read_length = read.query_length
-            break
+        # estimate read length from the first reads with sequences
+        lengths = [read.query_length for read in self.bam.head(sample)
+                   if not read.is_secondary and read.query_length]
+        read_length = 1.0 * sum(lengths) / len(lengths) if lengths else 0
         self.total_bases = self.total_reads * read_length
+        if coverage_flag:  # answer rpkm from cumulative base coverage
+            self.coverage = load_coverage(bam_f, self.bam, splice_flag)
+        else:
+            self.coverage = None
 
     def rpkm(self, chrom, start, end):
-        bases = 0
         region_length = end - start
-        for read in self.bam.fetch(chrom, start, end):
-            bases += read.get_overlap(start, end)
+        if self.coverage is not None:
+            bases = self.coverage.bases(chrom, start, end)
+        else:
+            bases = 0
+            for read in self.bam.fetch(chrom, start, end):
+                bases += read.get_overlap(start, end)
         return (bases * math.pow(10, 9)) * 1.0 / (self.total_bases *
                                                   region_length)
 
@@ -65,34 +78,80 @@ def map_fusion_to_iso(start, end, strand, iso_info):
     starts = iso_info[0]
     ends = iso_info[1]
     # check sequnence within +/-10bp
-    start_points = list(range(start - 10, start + 11))
-    end_points = list(range(end - 10, end + 11))
     start_index, end_index = None, None
     start_intron_flag, end_intron_flag = False, False
     # check starts
-    for i, s in enumerate(starts):
-        if s in start_points:
-            start_index = i
-            break
+    i = bisect_left(starts, start - 10)
+    if i < len(starts) and starts[i] <= start + 10:
+        start_index = i
     else:
-        for j, e in enumerate(ends):
-            if e in start_points:
-                if j != len(ends) - 1:
-                    start_index = j
-                    start_intron_flag = True
-                    break
+        j = bisect_left(ends, start - 10)
+        if j < len(ends) - 1 and ends[j] <= start + 10:
+            start_index = j
+            start_intron_flag = True
     # check ends
-    for j, e in enumerate(ends):
-        if e in end_points:
-            end_index = j
-            break
+    j = bisect_left(ends, end - 10)
+    if j < len(ends) and ends[j] <= end + 10:
+        end_index = j
     else:
-        for i, s in enumerate(starts):
-            if s in end_points:
-                if i != 0:
-                    end_index = i - 1
-                    end_intron_flag = True
-                    break
+        i = max(bisect_left(starts, end - 10), 1)  # skip the first exon
+        if i < len(starts) and starts[i] <= end + 10:
+            end_index = i - 1
+            end_intron_flag = True
+    return fusion_result(start, end, strand, starts, ends, start_index,
+                         end_index, start_intron_flag, end_intron_flag)
+
+
+def map_block(fus_starts, fus_ends, strand, iso_info):
+    '''
+    map_fusion_to_iso of all fusion junctions in one gene block
+    Return [(bed, index, edge, secondary), ...] in order of junctions
+    '''
+    starts, ends = iso_info
+    exon_starts = np.asarray(starts, dtype=np.int64)
+    exon_ends = np.asarray(ends, dtype=np.int64)
+    fus_starts = np.asarray(fus_starts, dtype=np.int64)
+    fus_ends = np.asarray(fus_ends, dtype=np.int64)
+    last = len(starts) - 1
+    # check starts
+    i = np.searchsorted(exon_starts, fus_starts - 10)
+    start_flag = ((i <= last) &
+                  (exon_starts[np.minimum(i, last)] <= fus_starts + 10))
+    j = np.searchsorted(exon_ends, fus_starts - 10)
+    start_intron = (~start_flag & (j < last) &
+                    (exon_ends[np.minimum(j, last)] <= fus_starts + 10))
+    start_index = np.where(start_flag, i, j)
+    start_flag |= start_intron
+    # check ends
+    j = np.searchsorted(exon_ends, fus_ends - 10)
+    end_flag = (j <= last) & (exon_ends[np.minimum(j, last)] <= fus_ends + 10)
+    # skip the first exon
+    i = np.maximum(np.searchsorted(exon_starts, fus_ends - 10), 1)
+    end_intron = (~end_flag & (i <= last) &
+                  (exon_starts[np.minimum(i, last)] <= fus_ends + 10))
+    end_index = np.where(end_flag, j, i - 1)
+    end_flag |= end_intron
+    start_index = np.where(start_flag, start_index, -1).tolist()
+    end_index = np.where(end_flag, end_index, -1).tolist()
+    start_intron = start_intron.tolist()
+    end_intron = end_intron.tolist()
+    results = []
+    for n, (start, end) in enumerate(zip(fus_starts.tolist(),
+                                         fus_ends.tolist())):
+        results.append(fusion_result(
+            start, end, strand, starts, ends,
+            start_index[n] if start_index[n] >= 0 else None,
+            end_index[n] if end_index[n] >= 0 else None,
+            start_intron[n], end_intron[n]))
+    return results
+
+
+def fusion_result(start, end, strand, starts, ends, start_index, end_index,
+                  start_intron_flag, end_intron_flag):
+    '''
+    (bed, index, edge, secondary) of fusion junction with matched exon
+    boundaries
+    '''
     # ciRNAs
     if start_intron_flag and strand == '+' and end < starts[start_index + 1]:
         return ('\t'.join(['1', str(end - start), '0', 'ciRNA']),
@@ -130,117 +189,120 @@ def convert_to_bed(start, end, starts, ends):
     return ('\t'.join([str(length), block_sizes, block_starts, 'circRNA']))
 
 
-def fix_bed(fusion_file, ref, fa, no_fix, denovo_flag):
+# annotated fusion junction, flag is circRNA, ciRNA or secondary (gene and
+# iso are left and right exon infos of secondary candidates)
+Candidate = namedtuple('Candidate', ['chrom', 'start', 'end', 'reads',
+                                     'strand', 'flag', 'gene', 'iso',
+                                     'index'])
+
+
+def fix_bed(candidates, ref, fa, no_fix, denovo_flag):
     fusions = defaultdict(int)
-    # make sure order of fusion names according to fusion_file
+    # make sure order of fusion names according to candidates
     fusion_names = []
     fusion_set = set()
     fixed_flag = defaultdict(int)  # flag to indicate realignment
     junctions = set()
-    with open(fusion_file, 'r') as f:
-        for line in f:
-            secondary_flag = False
-            chrom = line.split()[0]
-            strand = line.split()[5]
-            start, end = [int(x) for x in line.split()[1:3]]
-            junction_info = '%s\t%d\t%d' % (chrom, start, end)
-            if not denovo_flag and junction_info in junctions:
-                continue
-            reads = int(line.split()[3].split('/')[1])
-            if len(line.split()) == 8:
-                secondary_flag = True
-                flag = False
-                left_info, right_info = line.split()[6:8]
-                left_gene, left_iso, left_index = left_info.split(':')
-                right_gene, right_iso, right_index = right_info.split(':')
-                s = int(left_index)
-                e = int(right_index)
-                iso_starts = ref['\t'.join([left_gene, left_iso, chrom,
-                                            strand])][0]
-                iso_ends = ref['\t'.join([right_gene, right_iso, chrom,
-                                          strand])][1]
-                loc = '%s\t%d\t%d' % (chrom, iso_starts[s], iso_ends[e])
-                name = '|'.join(['secondary', loc, strand, left_info,
-                                 right_info])
-            else:
-                flag, gene, iso, index = line.split()[-4:]
-                flag = True if flag == 'ciRNA' else False
-                name = '\t'.join([gene, iso, chrom, strand, index])
-                iso_starts, iso_ends = ref['\t'.join([gene, iso, chrom,
-                                                      strand])]
-            if not flag:  # back spliced exons
-                if not secondary_flag:
-                    s, e = [int(x) for x in index.split(',')]
+    for candidate in candidates:
+        secondary_flag = False
+        chrom, start, end, reads, strand = candidate[:5]
+        junction_info = (chrom, start, end)
+        if not denovo_flag and junction_info in junctions:
+            continue
+        if candidate.flag == 'secondary':
+            secondary_flag = True
+            flag = False
+            left_info, right_info = candidate.gene, candidate.iso
+            left_gene, left_iso, left_index = left_info.split(':')
+            right_gene, right_iso, right_index = right_info.split(':')
+            s = int(left_index)
+            e = int(right_index)
+            iso_starts = ref['\t'.join([left_gene, left_iso, chrom,
+                                        strand])][0]
+            iso_ends = ref['\t'.join([right_gene, right_iso, chrom,
+                                      strand])][1]
+            loc = '%s\t%d\t%d' % (chrom, iso_starts[s], iso_ends[e])
+            name = '|'.join(['secondary', loc, strand, left_info,
+                             right_info])
+        else:
+            flag, gene, iso, index = candidate[-4:]
+            flag = True if flag == 'ciRNA' else False
+            name = '\t'.join([gene, iso, chrom, strand, index])
+            iso_starts, iso_ends = ref['\t'.join([gene, iso, chrom,
+                                                  strand])]
+        if not flag:  # back spliced exons
+            if not secondary_flag:
+                s, e = [int(x) for x in index.split(',')]
+            # not realign
+            if start == iso_starts[s] and end == iso_ends[e]:
+                fusions[name] += reads
+                if name not in fusion_set:
+                    fusion_set.add(name)
+                    fusion_names.append(name)
+                junctions.add(junction_info)
+            # no fix mode
+            elif no_fix:
+                fusions[name] += reads
+                if name not in fusion_set:
+                    fusion_set.add(name)
+                    fusion_names.append(name)
+                fixed_flag[name] += 1
+                junctions.add(junction_info)
+            # realign
+            elif check_seq(chrom, [start, iso_starts[s], end, iso_ends[e]],
+                           fa):
+                fusions[name] += reads
+                if name not in fusion_set:
+                    fusion_set.add(name)
+                    fusion_names.append(name)
+                fixed_flag[name] += 1
+                junctions.add(junction_info)
+        else:  # ciRNAs
+            index = int(index)
+            if strand == '+':
                 # not realign
-                if start == iso_starts[s] and end == iso_ends[e]:
+                if start == iso_ends[index]:
+                    name += '|'.join(['', str(start), str(end)])
                     fusions[name] += reads
                     if name not in fusion_set:
                         fusion_set.add(name)
                         fusion_names.append(name)
                     junctions.add(junction_info)
-                # no fix mode
-                elif no_fix:
+                # realign
+                elif check_seq(chrom, [start, iso_ends[index], end], fa,
+                               intron_flag=True):
+                    fixed_start = iso_ends[index]
+                    fixed_end = end + fixed_start - start
+                    name += '|'.join(['', str(fixed_start),
+                                      str(fixed_end)])
                     fusions[name] += reads
                     if name not in fusion_set:
                         fusion_set.add(name)
                         fusion_names.append(name)
                     fixed_flag[name] += 1
                     junctions.add(junction_info)
-                # realign
-                elif check_seq(chrom, [start, iso_starts[s], end, iso_ends[e]],
-                               fa):
+            else:
+                if end == iso_starts[index + 1]:
+                    # not realign
+                    name += '|'.join(['', str(start), str(end)])
                     fusions[name] += reads
                     if name not in fusion_set:
                         fusion_set.add(name)
                         fusion_names.append(name)
-                    fixed_flag[name] += 1
                     junctions.add(junction_info)
-            else:  # ciRNAs
-                index = int(index)
-                if strand == '+':
-                    # not realign
-                    if start == iso_ends[index]:
-                        name += '|'.join(['', str(start), str(end)])
-                        fusions[name] += reads
-                        if name not in fusion_set:
-                            fusion_set.add(name)
-                            fusion_names.append(name)
-                        junctions.add(junction_info)
                     # realign
-                    elif check_seq(chrom, [start, iso_ends[index], end], fa,
-                                   intron_flag=True):
-                        fixed_start = iso_ends[index]
-                        fixed_end = end + fixed_start - start
-                        name += '|'.join(['', str(fixed_start),
-                                          str(fixed_end)])
-                        fusions[name] += reads
-                        if name not in fusion_set:
-                            fusion_set.add(name)
-                            fusion_names.append(name)
-                        fixed_flag[name] += 1
-                        junctions.add(junction_info)
-                else:
-                    if end == iso_starts[index + 1]:
-                        # not realign
-                        name += '|'.join(['', str(start), str(end)])
-                        fusions[name] += reads
-                        if name not in fusion_set:
-                            fusion_set.add(name)
-                            fusion_names.append(name)
-                        junctions.add(junction_info)
-                        # realign
-                    elif check_seq(chrom, [end, iso_starts[index + 1], start],
-                                   fa, intron_flag=True):
-                        fixed_end = iso_starts[index + 1]
-                        fixed_start = start + fixed_end - end
-                        name += '|'.join(['', str(fixed_start),
-                                          str(fixed_end)])
-                        fusions[name] += reads
-                        if name not in fusion_set:
-                            fusion_set.add(name)
-                            fusion_names.append(name)
-                        fixed_flag[name] += 1
-                        junctions.add(junction_info)
+                elif check_seq(chrom, [end, iso_starts[index + 1], start],
+                               fa, intron_flag=True):
+                    fixed_end = iso_starts[index + 1]
+                    fixed_start = start + fixed_end - end
+                    name += '|'.join(['', str(fixed_start),
+                                      str(fixed_end)])
+                    fusions[name] += reads
+                    if name not in fusion_set:
+                        fusion_set.add(name)
+                        fusion_names.append(name)
+                    fixed_flag[name] += 1
+                    junctions.add(junction_info)
     return (fusions, fusion_names, fixed_flag)
 
 
@@ -263,6 +325,8 @@ def check_seq(chrom, pos, fa, intron_flag=False):
         else:
             seq1 = fa.fetch(chrom, pos[1], pos[0])
             seq2 = fa.fetch(chrom, pos[2] - pos[0] + pos[1], pos[2])
+    if isinstance(fa, TwoBitGenome):  # already uppercased
+        return seq1 == seq2
     if seq1.upper() == seq2.upper():
         return True
     else:
@@ -364,6 +428,8 @@ def fetch_psi(exon, junc, left_junc, right_junc, max_flag=None):
 
 
 def fetch_anchor(fa, chrom, start, end, strand):
+    if isinstance(fa, TwoBitGenome):  # uppercased and reverse complemented
+        return fa.fetch(chrom, start, end, strand)
     seq = fa.fetch(chrom, start, end)
     if strand == '+':
         seq = seq.upper()
@@ -0,0 +1,407 @@
+'''
+interval_array.py
+NumPy-backed engine with the same interface as genomic_interval.Interval
+'''
+
+import numpy as np
+from genomic_interval import Interval
+
+
+class IntervalArray(object):
+    '''
+    Class: IntervalArray
+
+    Usage: a = IntervalArray(list)
+           (nested list: [[x,x,f1...],[x,x,f2...]...] / [[x,x],[x,x]...] or
+            simple list: [x,x,f1...] / [x,x])
+    Notes: drop-in replacement for genomic_interval.Interval with the same
+           results. Starts and ends are kept in contiguous int64 arrays, and
+           the extra fields (f1...) of all intervals are kept in one flat
+           payload list, so that interval n carries
+           payload[offset[n]:offset[n + 1]].
+
+    Attributes: starts, ends, offsets, payload, interval
+
+    Functions: c = a + b or a += b
+               c = b + a
+               c = a * b or a *= b
+               c = b * a
+               c = a - b or a -= b
+               c = b - a
+               a[n] or a[n:m]
+               [x, x] in a or [[x, x], [x, x]] not in a
+               a.complement(sta, end)
+               a.extractwith(b)
+               a.extractwithout(b)
+               mapto(interval, index) -> interval
+               overlapwith(index, interval) -> index
+               overlapjoin(index, interval) -> (index, interval) pairs
+    '''
+    def __init__(self, interval, instance_flag=0):
+        if isinstance(interval, (Interval, IntervalArray)):
+            interval = interval.interval
+        items = IntervalArray._convert(interval)
+        num = len(items)
+        starts = np.fromiter((int(i[0]) for i in items), np.int64, num)
+        ends = np.fromiter((int(i[1]) for i in items), np.int64, num)
+        payload = []
+        offsets = np.zeros(num + 1, np.int64)
+        for n, i in enumerate(items):
+            payload.extend(i[2:])
+            offsets[n + 1] = len(payload)
+        self._load(starts, ends, payload, offsets, not instance_flag)
+
+    @classmethod
+    def from_arrays(cls, starts, ends, payload=None, offsets=None,
+                    instance_flag=0):
+        '''
+        Usage: a = IntervalArray.from_arrays(starts, ends)
+        build intervals from coordinate arrays without list conversion.
+        '''
+        obj = cls.__new__(cls)
+        starts = np.asarray(starts, dtype=np.int64)
+        ends = np.asarray(ends, dtype=np.int64)
+        if payload is None:
+            payload = []
+            offsets = np.zeros(len(starts) + 1, np.int64)
+        obj._load(starts, ends, list(payload),
+                  np.asarray(offsets, dtype=np.int64), not instance_flag)
+        return obj
+
+    def _load(self, starts, ends, payload, offsets, merge_flag):
+        self.starts = starts
+        self.ends = ends
+        self.payload = payload
+        self.offsets = offsets
+        self.merged = merge_flag
+        if merge_flag and len(starts):
+            self._merge()
+
+    def _merge(self):
+        '''
+        sort intervals and merge the overlapped ones, just as Interval does.
+        '''
+        starts, ends, offsets = self.starts, self.ends, self.offsets
+        num = len(starts)
+        order = np.lexsort((ends, starts))
+        if self.payload:  # equal coordinates are sorted by their payload
+            same = np.flatnonzero((starts[order][1:] == starts[order][:-1]) &
+                                  (ends[order][1:] == ends[order][:-1]))
+            if len(same):
+                order = order.tolist()
+                for i in IntervalArray._runs(same):
+                    run = order[i[0]:i[1]]
+                    run.sort(key=lambda x: self.payload[offsets[x]:
+                                                        offsets[x + 1]])
+                    order[i[0]:i[1]] = run
+                order = np.asarray(order, dtype=np.int64)
+        starts = starts[order]
+        ends = ends[order]
+        if self.payload:
+            payload = []
+            sizes = np.empty(num, np.int64)
+            for n, x in enumerate(order.tolist()):
+                extra = self.payload[offsets[x]:offsets[x + 1]]
+                payload.extend(extra)
+                sizes[n] = len(extra)
+            item_offsets = np.concatenate(([0], np.cumsum(sizes)))
+        else:
+            payload = []
+            item_offsets = np.zeros(num + 1, np.int64)
+        # running maximum of ends is the end of the current merged interval
+        reach = np.maximum.accumulate(ends)
+        first = np.flatnonzero(np.concatenate(([True],
+                                               reach[:-1] <= starts[1:])))
+        last = np.append(first[1:], num) - 1
+        self.starts = starts[first]
+        self.ends = reach[last]
+        self.offsets = np.append(item_offsets[first], item_offsets[-1])
+        self.payload = payload
+
+    @staticmethod
+    def _runs(same):
+        '''
+        convert indexes of equal neighbours into [sta, end) runs of items.
+        '''
+        sta = same[0]
+        prev = same[0]
+        for i in same[1:].tolist():
+            if i != prev + 1:
+                yield (sta, prev + 2)
+                sta = i
+            prev = i
+        yield (sta, prev + 2)
+
+    def _extra(self, n):
+        return self.payload[self.offsets[n]:self.offsets[n + 1]]
+
+    @property
+    def interval(self):
+        if not self.payload:
+            return [[s, e] for s, e in zip(self.starts.tolist(),
+                                           self.ends.tolist())]
+        offsets = self.offsets.tolist()
+        return [[s, e] + self.payload[offsets[n]:offsets[n + 1]]
+                for n, (s, e) in enumerate(zip(self.starts.tolist(),
+                                               self.ends.tolist()))]
+
+    @interval.setter
+    def interval(self, interval):
+        tmp = IntervalArray(interval, 1)
+        self._load(tmp.starts, tmp.ends, tmp.payload, tmp.offsets, False)
+
+    def __add__(self, interval):
+        '''
+        Usage: c = a + b or a += b
+        extract union intervals, 'a' should be instance.
+        '''
+        if not isinstance(interval, IntervalArray):
+            interval = IntervalArray(interval, 1)
+        offsets = np.concatenate((self.offsets[:-1],
+                                  interval.offsets + len(self.payload)))
+        return IntervalArray.from_arrays(
+            np.concatenate((self.starts, interval.starts)),
+            np.concatenate((self.ends, interval.ends)),
+            self.payload + interval.payload, offsets)
+
+    def __radd__(self, interval):
+        '''
+        Usage: c = b + a
+        extract union intervals, 'a' should be instance.
+        '''
+        return self.__add__(interval)
+
+    def __mul__(self, interval, real_flag=1):
+        '''
+        Usage: c = a * b or a *= b
+        extract intersection intervals, 'a' should be instance.
+        '''
+        if not isinstance(interval, IntervalArray):
+            interval = IntervalArray(interval, isinstance(interval, Interval))
+        if not len(self.starts) or not len(interval.starts):
+            return IntervalArray([])
+        if not self.merged or not interval.merged:
+            # overlapped intervals need the original two-pointer walk
+            return IntervalArray(Interval.__mul__(Interval(self.interval, 1),
+                                                  Interval(interval.interval,
+                                                           1),
+                                                  real_flag).interval, 1)
+        # b[lo:hi] are all the intervals overlapped with each a
+        lo = np.searchsorted(interval.ends, self.starts, 'right')
+        hi = np.searchsorted(interval.starts, self.ends, 'left')
+        counts = np.maximum(hi - lo, 0)
+        a_index = np.repeat(np.arange(len(self.starts)), counts)
+        b_index = (lo[a_index] + np.arange(len(a_index)) -
+                   np.repeat(np.cumsum(counts) - counts, counts))
+        starts = np.maximum(self.starts[a_index], interval.starts[b_index])
+        ends = np.minimum(self.ends[a_index], interval.ends[b_index])
+        # zero-length intervals touch their neighbours without overlapping
+        keep = starts < ends
+        a_index, b_index = a_index[keep], b_index[keep]
+        if real_flag:
+            starts, ends = starts[keep], ends[keep]
+        else:
+            starts = self.starts[a_index]
+            ends = self.ends[a_index]
+        if not self.payload and (not real_flag or not interval.payload):
+            tmp = IntervalArray.from_arrays(starts, ends, instance_flag=1)
+        else:
+            payload = []
+            offsets = np.zeros(len(a_index) + 1, np.int64)
+            for n, (a, b) in enumerate(zip(a_index.tolist(),
+                                           b_index.tolist())):
+                payload.extend(self._extra(a))
+                if real_flag:
+                    payload.extend(interval._extra(b))
+                offsets[n + 1] = len(payload)
+            tmp = IntervalArray.from_arrays(starts, ends, payload, offsets, 1)
+        # intersections of two merged intervals are still mutually exclusive
+        tmp.merged = bool(real_flag)
+        return tmp
+
+    def __rmul__(self, interval):
+        '''
+        Usage: c = b * a
+        extract intersection intervals, 'a' should be instance.
+        '''
+        return self.__mul__(interval)
+
+    def __sub__(self, interval, real_flag=1):
+        '''
+        Usage: c = a - b or a -= b
+        extract difference intervals, 'a' should be instance.
+        '''
+        if not len(self.starts):
+            return IntervalArray([])
+        if not isinstance(interval, IntervalArray):
+            interval = IntervalArray(interval)
+        if not len(interval.starts):
+            return self.copy()
+        sta = min(self.starts[0], interval.starts[0])
+        end = max(self.ends[-1], interval.ends[-1])
+        tmp = interval.copy()
+        tmp.complement(sta, end)
+        return self.__mul__(tmp, real_flag)
+
+    def __rsub__(self, interval):
+        '''
+        Usage: c = b - a
+        extract difference intervals, 'a' should be instance.
+        '''
+        if not isinstance(interval, IntervalArray):
+            interval = IntervalArray(interval)
+        if not len(self.starts):
+            return interval.copy()
+        if not len(interval.starts):
+            return IntervalArray([])
+        sta = min(self.starts[0], interval.starts[0])
+        end = max(self.ends[-1], interval.ends[-1])
+        tmp = self.copy()
+        tmp.complement(sta, end)
+        return interval.__mul__(tmp)
+
+    def __getitem__(self, index):
+        '''
+        Usage: a[n] or a[n:m]
+        intercept index and slice on interval objects.
+        '''
+        if isinstance(index, slice):
+            return self.interval[index]
+        index = range(len(self.starts))[index]
+        return ([int(self.starts[index]), int(self.ends[index])] +
+                self._extra(index))
+
+    def __repr__(self):
+        '''
+        print objects.
+        '''
+        return repr(self.interval)
+
+    def __contains__(self, interval):
+        '''
+        Usage: [x, x] in a or [[x, x], [x, x]] not in a
+        judge whether interval is in a or not, 'a' should be instance.
+        '''
+        return bool(len(self.__mul__(interval).starts))
+
+    def copy(self):
+        '''
+        Usage: b = a.copy()
+        copy arrays of 'a', payload items are shared.
+        '''
+        return IntervalArray.from_arrays(self.starts.copy(), self.ends.copy(),
+                                         self.payload, self.offsets.copy(),
+                                         instance_flag=not self.merged)
+
+    def complement(self, sta='#', end='#'):
+        '''
+        Usage: a.complement(sta, end)
+        complement of 'a'.
+        '''
+        starts = self.ends[:-1]
+        ends = self.starts[1:]
+        keep = starts != ends
+        starts = starts[keep]
+        ends = ends[keep]
+        if sta != '#' and sta < self.starts[0]:
+            starts = np.concatenate(([sta], starts))
+            ends = np.concatenate(([self.starts[0]], ends))
+        if end != '#' and end > self.ends[-1]:
+            starts = np.append(starts, self.ends[-1])
+            ends = np.append(ends, end)
+        self._load(starts.astype(np.int64), ends.astype(np.int64), [],
+                   np.zeros(len(starts) + 1, np.int64), False)
+        self.merged = bool(np.all(starts[1:] >= ends[:-1]))
+
+    def extractwith(self, interval):
+        '''
+        Usage: a.extractwith(b)
+        extract intervals in 'b'.
+        '''
+        tmp = self.__mul__(interval, 0)
+        self._load(tmp.starts, tmp.ends, tmp.payload, tmp.offsets, False)
+
+    def extractwithout(self, interval):
+        '''
+        Usage: a.extractwithout(b)
+        extract intervals not in 'b'.
+        '''
+        tmp = self.__sub__(interval, 0)
+        self._load(tmp.starts, tmp.ends, tmp.payload, tmp.offsets, False)
+
+    @staticmethod
+    def mapto(interval, index):
+        '''
+        mapto(interval, index) -> interval
+        Map interval onto index.
+        '''
+        return Interval.mapto(interval, index)
+
+    @staticmethod
+    def overlapwith(index, interval):
+        '''
+        overlapwith(index, interval) -> index
+        Overlap index with interval.
+        '''
+        if not isinstance(index, IntervalArray) or not index.merged:
+            if isinstance(index, IntervalArray):
+                index = index.interval
+            return Interval.overlapwith(index, interval)
+        # for boundaries conditions
+        tmp1 = [[i[0] - 11, i[1] + 11] + i[2:] for i in index.interval]
+        tmp2 = sorted([int(i[0]), int(i[1])] + i[2:]
+                      for i in IntervalArray._convert(interval))
+        for n, i in IntervalArray._join(index, tmp2, 11):
+            tmp1[i] += tmp2[n][2:]
+        return tmp1
+
+    @staticmethod
+    def overlapjoin(index, interval, flank=11):
+        '''
+        overlapjoin(index, interval) -> (index, interval) pairs
+        Lazily yield each interval with the padded index it is overlapped
+        with in overlapwith, in sorted order of interval.
+        '''
+        if not isinstance(index, IntervalArray) or not index.merged:
+            if isinstance(index, IntervalArray):
+                index = index.interval
+            for pair in Interval.overlapjoin(index, interval, flank):
+                yield pair
+            return
+        tmp2 = sorted([int(i[0]), int(i[1])] + i[2:]
+                      for i in IntervalArray._convert(interval))
+        padded = {}  # only the padded index overlapped is built
+        for n, i in IntervalArray._join(index, tmp2, flank):
+            if i not in padded:
+                padded[i] = [int(index.starts[i]) - flank,
+                             int(index.ends[i]) + flank] + index._extra(i)
+            yield (padded[i], tmp2[n])
+
+    @staticmethod
+    def _join(index, interval, flank):
+        '''
+        Return [(n, i), ...] of interval[n] in the first padded index[i]
+        containing it, interval should be sorted and index merged.
+        '''
+        if not len(index.starts) or not interval:
+            return []
+        starts = np.fromiter((i[0] for i in interval), np.int64,
+                             len(interval))
+        ends = np.fromiter((i[1] for i in interval), np.int64, len(interval))
+        # padded ends of merged intervals are still sorted
+        lo = np.searchsorted(index.ends + flank, starts, 'right')
+        hi = np.searchsorted(index.starts - flank, starts, 'right')
+        dex = np.maximum(lo, np.searchsorted(index.ends + flank, ends, 'left'))
+        hit = dex < hi
+        return list(zip(np.flatnonzero(hit).tolist(), dex[hit].tolist()))
+
+    @staticmethod
+    def _convert(interval):
+        assert type(interval) is list, ('the type you used is ' +
+                                        str(type(interval)))
+        if not interval:
+            return interval
+        if type(interval[0]) is list:
+            return interval
+        else:
+            return [interval]
@@ -0,0 +1,204 @@
+'''
+junction_graph.py
+Integer-keyed splice junction graph loaded from TopHat junctions.bed
+'''
+
+import os
+import os.path
+from collections import defaultdict
+import numpy as np
+
+__all__ = ['JunctionGraph', 'load_junctions']
+
+_graphs = {}  # junction graphs loaded in this process
+
+
+class JunctionGraph(object):
+    '''
+    Class: JunctionGraph
+
+    Usage: graph = load_junctions(junc_f)
+           graph.reads(chrom, left, right) -> junction reads
+           graph.acceptors(chrom, left) -> [(right, reads), ...]
+           graph.donors(chrom, right) -> [(left, reads), ...]
+           graph.psi(chrom, start, end, max_flag) -> psi of exon
+           graph.as_flag(flag) -> same results as parse_junc(junc_f, flag)
+
+    Notes: chromosomes are interned as ids and coordinates are kept as
+           integers. Donor->acceptors and acceptor->donors adjacencies are
+           kept as sorted arrays of chrom_id << 32 | site keys with offsets
+           into partner and read arrays, in the order of junctions.bed.
+    '''
+    def __init__(self, junc_f):
+        self.chroms = []
+        self.chrom_ids = {}
+        cids, lefts, rights, reads = [], [], [], []
+        with open(junc_f, 'r') as f:
+            f.readline()  # skip header
+            for line in f:
+                line_info = line.split()
+                chrom = line_info[0]
+                start = int(line_info[1])
+                size = int(line_info[10].split(',')[0])
+                offset = int(line_info[11].split(',')[1])
+                if chrom not in self.chrom_ids:
+                    self.chrom_ids[chrom] = len(self.chroms)
+                    self.chroms.append(chrom)
+                cids.append(self.chrom_ids[chrom])
+                lefts.append(start + size)
+                rights.append(start + offset)
+                reads.append(int(line_info[4]))
+        self.cid = np.asarray(cids, dtype=np.int64)
+        self.left = np.asarray(lefts, dtype=np.int64)
+        self.right = np.asarray(rights, dtype=np.int64)
+        self.read = np.asarray(reads, dtype=np.int64)
+        self.junc = defaultdict(int)
+        for junc_id in zip(cids, lefts, rights, reads):
+            self.junc[junc_id[:3]] += junc_id[3]
+        self.donor = JunctionGraph._adjacency(self.cid, self.left,
+                                              self.right, self.read)
+        self.acceptor = JunctionGraph._adjacency(self.cid, self.right,
+                                                 self.left, self.read)
+
+    @staticmethod
+    def _adjacency(cid, site, partner, read):
+        key = (cid << 32) | site
+        order = np.argsort(key, kind='mergesort')  # keep file order
+        key = key[order]
+        keys, offsets = np.unique(key, return_index=True)
+        offsets = np.append(offsets, len(key))
+        read = read[order]
+        total = np.add.reduceat(read, offsets[:-1]) if len(key) else read
+        return (keys, offsets, partner[order], read, total)
+
+    def _find(self, adjacency, chrom, site):
+        if chrom not in self.chrom_ids:
+            return None
+        key = (self.chrom_ids[chrom] << 32) | site
+        keys = adjacency[0]
+        i = np.searchsorted(keys, key)
+        if i < len(keys) and keys[i] == key:
+            return i
+        return None
+
+    def _partners(self, adjacency, chrom, site):
+        i = self._find(adjacency, chrom, site)
+        if i is None:
+            return []
+        sta, end = adjacency[1][i], adjacency[1][i + 1]
+        return list(zip(adjacency[2][sta:end].tolist(),
+                        adjacency[3][sta:end].tolist()))
+
+    def reads(self, chrom, left, right):
+        if chrom not in self.chrom_ids:
+            return 0
+        return self.junc.get((self.chrom_ids[chrom], left, right), 0)
+
+    def __contains__(self, junc_id):
+        chrom, left, right = junc_id
+        if chrom not in self.chrom_ids:
+            return False
+        return (self.chrom_ids[chrom], left, right) in self.junc
+
+    def acceptors(self, chrom, left):
+        return self._partners(self.donor, chrom, left)
+
+    def donors(self, chrom, right):
+        return self._partners(self.acceptor, chrom, right)
+
+    def donor_total(self, chrom, left):
+        i = self._find(self.donor, chrom, left)
+        return 0 if i is None else int(self.donor[4][i])
+
+    def acceptor_total(self, chrom, right):
+        i = self._find(self.acceptor, chrom, right)
+        return 0 if i is None else int(self.acceptor[4][i])
+
+    def psi(self, chrom, start, end, max_flag=None):
+        '''
+        Integer version of helper.fetch_psi for exon [start, end).
+        '''
+        if max_flag:  # predefine max_left and max_right
+            max_left, max_right = max_flag
+            max_left_right_read = self.reads(chrom, max_left, max_right)
+        else:
+            max_left, max_right = None, None
+            max_read, max_left_right_read = 0, 0
+        # #######------#############-------########
+        #     left     start     end      right
+        tmp_set = set()
+        # inclusion read
+        inclusion_read = 0
+        right_info = self.acceptors(chrom, end)
+        for left, left_read in self.donors(chrom, start):
+            inclusion_read += left_read
+            for right, right_read in right_info:
+                if right not in tmp_set:  # make sure only counting once
+                    inclusion_read += right_read
+                    tmp_set.add(right)
+                if not max_flag:
+                    left_right_read = self.reads(chrom, left, right)
+                    total_read = left_read + right_read + left_right_read
+                    if total_read >= max_read:
+                        max_read = total_read
+                        max_left_right_read = left_right_read
+                        max_left, max_right = left, right
+        # exclusion read
+        exclusion_read = 0
+        if max_left is not None:
+            for right, right_read in self.acceptors(chrom, max_left):
+                if right > end:  # include cassette exon
+                    exclusion_read += right_read
+            for left, left_read in self.donors(chrom, max_right):
+                if left < start:  # include cassette exon
+                    exclusion_read += left_read
+        exclusion_read -= max_left_right_read
+        if inclusion_read == 0 and exclusion_read == 0:
+            psi = 0
+        else:
+            psi = 100.0 * inclusion_read / (inclusion_read +
+                                            2 * exclusion_read)
+        if max_flag is None:
+            return (psi, inclusion_read, exclusion_read, max_left, max_right)
+        else:
+            return (psi, inclusion_read, exclusion_read)
+
+    def as_flag(self, flag=0):
+        '''
+        Usage: graph.as_flag(flag) -> parse_junc(junc_f, flag) results
+        '''
+        junc = defaultdict(int)
+        for (cid, left, right), reads in self.junc.items():
+            junc['%s\t%d\t%d' % (self.chroms[cid], left, right)] = reads
+        if not flag:
+            return junc
+        if flag == 1:
+            left_junc = defaultdict(list)
+            right_junc = defaultdict(list)
+        else:
+            left_junc = defaultdict(int)
+            right_junc = defaultdict(int)
+        for cid, left, right, reads in zip(self.cid.tolist(),
+                                           self.left.tolist(),
+                                           self.right.tolist(),
+                                           self.read.tolist()):
+            left_junc_id = '%s\t%d' % (self.chroms[cid], left)
+            right_junc_id = '%s\t%d' % (self.chroms[cid], right)
+            if flag == 1:
+                left_junc[left_junc_id].append([str(right), reads])
+                right_junc[right_junc_id].append([str(left), reads])
+            else:
+                left_junc[left_junc_id] += reads
+                right_junc[right_junc_id] += reads
+        return (junc, left_junc, right_junc)
+
+
+def load_junctions(junc_f):
+    '''
+    Load junction graph once per process and share it between stages
+    '''
+    stat = os.stat(junc_f)
+    key = (os.path.abspath(junc_f), stat.st_size, stat.st_mtime)
+    if key not in _graphs:
+        _graphs[key] = JunctionGraph(junc_f)
+    return _graphs[key]
@@ -0,0 +1,113 @@
+'''
+junction_matrix.py
+Sparse junctions x samples count matrix of back-spliced junctions
+'''
+
+import numpy as np
+from scipy.sparse import coo_matrix, csr_matrix
+from chunk_reader import read_chunks
+
+__all__ = ['JunctionMatrix']
+
+
+class JunctionMatrix(object):
+    '''
+    Class: JunctionMatrix
+
+    Usage: matrix = JunctionMatrix.from_beds(bed_files, samples)
+           matrix.save(npz_file)
+           matrix.to_tsv(tsv_file)
+           matrix = JunctionMatrix.load(npz_file)
+
+    Notes: junctions of all samples share one index sorted by (chrom,
+           start, end), chromosomes are kept as ids into chrom names.
+           Reads are kept as a CSR matrix of junctions x samples, so that
+           memory follows the number of non-zero counts.
+    '''
+    def __init__(self, chroms, chrom_id, start, end, samples, counts):
+        self.chroms = chroms
+        self.chrom_id = chrom_id
+        self.start = start
+        self.end = end
+        self.samples = samples
+        self.counts = counts
+
+    @classmethod
+    def from_beds(cls, bed_files, samples):
+        '''
+        Usage: matrix = JunctionMatrix.from_beds(bed_files, samples)
+        build matrix from back_spliced_junction.bed files of samples.
+        '''
+        chroms, starts, ends, reads, sample_ids = [], [], [], [], []
+        for n, bed in enumerate(bed_files):
+            for _, cols in read_chunks(bed, 4, int_cols=(1, 2)):
+                chrom, start, end, name = cols
+                chroms.append(chrom)
+                starts.append(start)
+                ends.append(end)
+                reads.append(np.char.rpartition(name, '/')[:, 2].astype(
+                    np.int64))
+                sample_ids.append(np.full(len(chrom), n, np.int64))
+        if not chroms:
+            chrom_names = np.zeros(0, str)
+            empty = np.zeros(0, np.int64)
+            return cls(chrom_names, empty, empty, empty, list(samples),
+                       csr_matrix((0, len(samples)), dtype=np.int64))
+        chrom_names, chrom_id = np.unique(np.concatenate(chroms),
+                                          return_inverse=True)
+        keys = np.column_stack((chrom_id.reshape(-1), np.concatenate(starts),
+                                np.concatenate(ends)))
+        uniq, row = np.unique(keys, axis=0, return_inverse=True)
+        # duplicated junctions of one sample are summed
+        counts = coo_matrix((np.concatenate(reads),
+                             (row.reshape(-1), np.concatenate(sample_ids))),
+                            shape=(len(uniq), len(samples))).tocsr()
+        return cls(chrom_names, uniq[:, 0], uniq[:, 1], uniq[:, 2],
+                   list(samples), counts)
+
+    def save(self, npz_file):
+        '''
+        Usage: matrix.save(npz_file)
+        save matrix as compressed .npz file.
+        '''
+        np.savez_compressed(npz_file, chroms=self.chroms,
+                            chrom_id=self.chrom_id, start=self.start,
+                            end=self.end, samples=np.asarray(self.samples),
+                            data=self.counts.data,
+                            indices=self.counts.indices,
+                            indptr=self.counts.indptr)
+
+    @classmethod
+    def load(cls, npz_file):
+        '''
+        Usage: matrix = JunctionMatrix.load(npz_file)
+        '''
+        arrays = np.load(npz_file)
+        samples = arrays['samples'].tolist()
+        counts = csr_matrix((arrays['data'], arrays['indices'],
+                             arrays['indptr']),
+                            shape=(len(arrays['start']), len(samples)))
+        return cls(arrays['chroms'], arrays['chrom_id'], arrays['start'],
+                   arrays['end'], samples, counts)
+
+    def to_tsv(self, tsv_file):
+        '''
+        Usage: matrix.to_tsv(tsv_file)
+        export dense tab-separated table with a header line.
+        '''
+        indptr, indices = self.counts.indptr, self.counts.indices
+        data = self.counts.data
+        chroms = self.chroms.tolist()
+        with open(tsv_file, 'w') as outf:
+            outf.write('\t'.join(['chrom', 'start', 'end'] + self.samples))
+            outf.write('\n')
+            row = np.zeros(len(self.samples), np.int64)
+            for n, (cid, start, end) in enumerate(zip(self.chrom_id.tolist(),
+                                                      self.start.tolist(),
+                                                      self.end.tolist())):
+                sta, stop = indptr[n], indptr[n + 1]
+                row[indices[sta:stop]] = data[sta:stop]
+                outf.write('%s\t%d\t%d\t' % (chroms[cid], start, end))
+                outf.write('\t'.join(map(str, row.tolist())))
+                outf.write('\n')
+                row[indices[sta:stop]] = 0
@@ -1,5 +1,5 @@
 '''
-Usage: CIRCexplorer2 parse [options] -t ALIGNER <fusion>
+Usage: CIRCexplorer2 parse [options] -t ALIGNER <fusion>...
 
 Options:
     -h --help                      Show help message.
@@ -10,13 +10,28 @@ BWA, segemehl).
                                    [default: back_spliced_junction.bed]
     --pe                           Parse paired-end alignment file (only for \
 TopHat-Fusion).
+    -p THREAD --thread=THREAD      Running threads (only for TopHat-Fusion \
+and BWA, or for multiple samples). [default: 1]
+    -m MATRIX --matrix=MATRIX      Junction count matrix prefix (only for \
+multiple samples). [default: junction_matrix]
+    --tabix                        Also write sorted and BGZF-compressed \
+output with tabix index (<output>.gz).
+    -w WINDOW --window=WINDOW      Pair fusion fragments within WINDOW bp \
+of coordinate-sorted BAM, 0 for whole chromosomes (only for TopHat-Fusion). \
+[default: 10000000]
 '''
 
 import sys
+import os.path
 import pysam
+import numpy as np
+from multiprocessing import Pool
 from collections import defaultdict
 from helper import logger
-from parser import parse_fusion_bam, Segment
+from chunk_reader import read_chunks, count_keys
+from junction_matrix import JunctionMatrix
+from sorted_output import index_bed
+from parser import parse_fusion_bam, Segment, decode_alignment, WINDOW
 
 __author__ = [
     'Xiao-Ou Zhang (zhangxiaoou@picb.ac.cn)',
@@ -42,49 +57,89 @@ def parse(options):
         sys.exit('Sorry. Only Tophat-Fusion are supported to parse the\
  paired-end data')
     # parse fusion junctions from other aligers
-    if options['-t'] == 'TopHat-Fusion':
-        tophat_fusion_parse(options['<fusion>'], out, options['--pe'])
-    elif options['-t'] == 'STAR':
-        star_parse(options['<fusion>'], out)
-    elif options['-t'] == 'MapSplice':
-        mapsplice_parse(options['<fusion>'], out)
-    elif options['-t'] == 'BWA':
-        bwa_parse(options['<fusion>'], out)
-    elif options['-t'] == 'segemehl':
-        segemehl_parse(options['<fusion>'], out)
+    fusions = options['<fusion>']
+    thread = int(options['--thread'])
+    window = int(options['--window']) or None
+    if len(fusions) == 1:
+        parse_sample((options['-t'], fusions[0], out, options['--pe'],
+                      thread, window))
+        if options['--tabix']:
+            print('Write sorted and indexed %s!' % index_bed(out))
+    else:
+        batch_parse(options['-t'], fusions, options['--matrix'],
+                    options['--pe'], thread, options['--tabix'], window)
 
 
-def tophat_fusion_parse(fusion, out, pair_flag=False):
+def parse_sample(args):
     '''
-    Parse fusion junctions from TopHat-Fusion aligner
+    Parse fusion junctions of one sample
+    args: (aligner, fusion, out, pair_flag, thread, window)
     '''
-    print('Start parsing fusion junctions from TopHat-Fusion...')
-    fusions = defaultdict(int)
-    for i, read in enumerate(parse_fusion_bam(fusion, pair_flag)):
-        chrom, strand, start, end, xp_info = read
-        segments = [start, end]
+    aligner, fusion, out, pair_flag, thread, window = args
+    if aligner == 'TopHat-Fusion':
+        tophat_fusion_parse(fusion, out, pair_flag, thread, window)
+    elif aligner == 'STAR':
+        star_parse(fusion, out)
+    elif aligner == 'MapSplice':
+        mapsplice_parse(fusion, out)
+    elif aligner == 'BWA':
+        bwa_parse(fusion, out, thread)
+    elif aligner == 'segemehl':
+        segemehl_parse(fusion, out)
 
-        if pair_flag is True:
-            part_chrom, part_pos, part_cigar = xp_info.split()
-            part_pos = int(part_pos)
 
-            if chrom != part_chrom:
-                continue
-
-        if (i + 1) % 2 == 1:  # first fragment of fusion junction read
-            interval = [start, end]
-        else:  # second fragment of fusion junction read
-            sta1, end1 = interval
-            sta2, end2 = segments
-            if end1 < sta2 or end2 < sta1:  # no overlap between fragments
-                sta = sta1 if sta1 < sta2 else sta2
-                end = end1 if end1 > end2 else end2
+def batch_parse(aligner, fusions, prefix, pair_flag=False, thread=1,
+                tabix_flag=False, window=WINDOW):
+    '''
+    Parse fusion junctions of many samples concurrently and merge them into
+    one junction count matrix (prefix.npz and prefix.tsv)
+    '''
+    beds = ['%s.sample%d.bed' % (prefix, n) for n in range(len(fusions))]
+    samples = [(aligner, fusion, bed, pair_flag, 1, window)
+               for fusion, bed in zip(fusions, beds)]
+    if thread > 1:
+        pool = Pool(min(thread, len(samples)))
+        pool.map(parse_sample, samples)
+        pool.close()
+        pool.join()
+    else:
+        for sample in samples:
+            parse_sample(sample)
+    if tabix_flag:
+        for bed in beds:
+            index_bed(bed)
+        print('Write sorted and indexed outputs of %d samples!' % len(beds))
+    matrix = JunctionMatrix.from_beds(beds, fusions)
+    matrix.save(prefix + '.npz')
+    matrix.to_tsv(prefix + '.tsv')
+    print('Merged %d junctions of %d samples!' % (len(matrix.start),
+                                                  len(fusions)))
 
-                if pair_flag is True:
-                    if part_pos < sta or part_pos > end:
-                        continue
 
-                fusions['%s\t%d\t%d' % (chrom, sta, end)] += 1
+def tophat_fusion_parse(fusion, out, pair_flag=False, thread=1,
+                        window=WINDOW):
+    '''
+    Parse fusion junctions from TopHat-Fusion aligner
+    '''
+    print('Start parsing fusion junctions from TopHat-Fusion...')
+    bam = pysam.AlignmentFile(fusion, 'rb')
+    if thread > 1 and bam.has_index():
+        # each chromosome is parsed by one process in chromosome order
+        chroms = [x.contig for x in bam.get_index_statistics() if x.mapped]
+        bam.close()
+        pool = Pool(thread)
+        results = pool.map(fusion_junctions,
+                           [(fusion, pair_flag, chrom, window)
+                            for chrom in chroms])
+        pool.close()
+        pool.join()
+    else:
+        bam.close()
+        results = [fusion_junctions((fusion, pair_flag, None, window))]
+    fusions = defaultdict(int)
+    for chrom_fusions in results:
+        for pos, reads in chrom_fusions:
+            fusions[pos] += reads
     total = 0
     with open(out, 'w') as outf:
         for i, pos in enumerate(fusions):
@@ -93,34 +148,58 @@ def tophat_fusion_parse(fusion, out, pair_flag=False):
     print('Converted %d fusion reads!' % total)
 
 
+def fusion_junctions(args):
+    '''
+    Count fusion junctions of TopHat-Fusion reads (only on chrom if chrom is
+    not None)
+    args: (fusion, pair_flag, chrom, window)
+    Return [(junction, reads), ...] in the order of first fusion reads
+    '''
+    fusion, pair_flag, chrom, window = args
+    fusions = defaultdict(int)
+    fragments = parse_fusion_bam(fusion, pair_flag, window, chrom=chrom)
+    # fragments of each fusion read are yielded one after another
+    for (chrom, _, sta1, end1, xp1), (_, _, sta2, end2, xp2) in zip(
+            fragments, fragments):
+        if pair_flag is True:
+            part_chrom1 = xp1.split()[0]
+            part_chrom, part_pos, part_cigar = xp2.split()
+            part_pos = int(part_pos)
+            if chrom != part_chrom1 or chrom != part_chrom:
+                continue
+        if end1 < sta2 or end2 < sta1:  # no overlap between fragments
+            sta = sta1 if sta1 < sta2 else sta2
+            end = end1 if end1 > end2 else end2
+
+            if pair_flag is True:
+                if part_pos < sta or part_pos > end:
+                    continue
+
+            fusions['%s\t%d\t%d' % (chrom, sta, end)] += 1
+    return list(fusions.items())
+
+
 def star_parse(fusion, out):
     '''
     Parse fusion junctions from STAR aligner
     '''
     print('Start parsing fusion junctions from STAR...')
-    junc = defaultdict(int)
-    with open(fusion, 'r') as junc_f:
-        for line in junc_f:
-            flag = int(line.split()[6])
-            if flag < 0:
-                continue
-            chr1, site1, strand1, chr2, site2, strand2 = line.split()[:6]
-            if chr1 != chr2 or strand1 != strand2:
-                continue
-            if strand1 == '+':
-                start = int(site2)
-                end = int(site1) - 1
-            else:
-                start = int(site1)
-                end = int(site2) - 1
-            if start > end:
-                continue
-            junc_id = '%s\t%d\t%d' % (chr1, start, end)
-            junc[junc_id] += 1
+    junc = {}
+    # header lines of each sample in concatenated files are skipped as
+    # their sites and flags are not integers
+    for _, cols in read_chunks(fusion, 7, int_cols=(1, 4, 6)):
+        chr1, site1, strand1, chr2, site2, strand2, flag = cols
+        plus = strand1 == '+'
+        start = np.where(plus, site2, site1)
+        end = np.where(plus, site1, site2) - 1
+        keep = (flag >= 0) & (chr1 == chr2) & (strand1 == strand2) & \
+            (start <= end)
+        count_keys(junc, chr1[keep], start[keep], end[keep])
     total = 0
     with open(out, 'w') as outf:
         for i, j in enumerate(junc):
-            outf.write('%s\tFUSIONJUNC_%d/%d\t0\t+\n' % (j, i, junc[j]))
+            outf.write('%s\t%d\t%d\tFUSIONJUNC_%d/%d\t0\t+\n' % (j + (i,
+                                                                    junc[j])))
             total += junc[j]
     print('Converted %d fusion reads!' % total)
 
@@ -131,39 +210,82 @@ def mapsplice_parse(fusion, out):
     '''
     print('Start parsing fusion junctions from MapSplice...')
     total = 0
-    with open(fusion, 'r') as junc_f, open(out, 'w') as outf:
-        for i, line in enumerate(junc_f):
-            chrom, site1, site2, name, reads, strand = line.split()[:6]
-            chr1, chr2 = chrom.split('~')
-            if chr1 != chr2:
-                continue
-            site1 = int(site1)
-            site2 = int(site2)
-            if strand == '++' and site1 > site2:
-                start = site2 - 1
-                end = site1
-            elif strand == '--' and site1 < site2:
-                start = site1 - 1
-                end = site2
-            else:
-                continue
-            outf.write('%s\t%d\t%d\tFUSIONJUNC_%d/%s\t0\t+\n' % (chr1, start,
-                                                                 end, i,
-                                                                 reads))
-            total += int(reads)
+    with open(out, 'w') as outf:
+        for index, cols in read_chunks(fusion, 6, int_cols=(1, 2)):
+            chrom, site1, site2, name, reads, strand = cols
+            chroms = np.char.partition(chrom, '~')
+            chr1, chr2 = chroms[:, 0], chroms[:, 2]
+            plus = (strand == '++') & (site1 > site2)
+            minus = (strand == '--') & (site1 < site2)
+            keep = (chr1 == chr2) & (plus | minus)
+            start = np.where(plus, site2, site1) - 1
+            end = np.where(plus, site1, site2)
+            for i, c, s, e, r in zip(index[keep].tolist(),
+                                     chr1[keep].tolist(),
+                                     start[keep].tolist(),
+                                     end[keep].tolist(),
+                                     reads[keep].tolist()):
+                outf.write('%s\t%d\t%d\tFUSIONJUNC_%d/%s\t0\t+\n' % (c, s, e,
+                                                                     i, r))
+            total += int(reads[keep].astype(np.int64).sum())
     print('Converted %d fusion reads!' % total)
 
 
-def bwa_parse(fusion, out):
+def bwa_parse(fusion, out, thread=1):
     '''
     Parse fusion junctions from BWA aligner
     Origin source codes: Xu-Kai Ma (maxukai@picb.ac.cn)
     Modified: Xiao-Ou Zhang (zhangxiaoou@picb.ac.cn)
     '''
     print('Start parsing fusion junctions from BWA...')
+    with open(fusion, 'rb') as f:
+        bam_flag = f.read(2) == b'\x1f\x8b'  # BGZF compressed
+    if bam_flag:  # chromosomes of indexed BAM file
+        samFile = pysam.AlignmentFile(fusion, 'rb')
+        if thread > 1 and samFile.has_index():
+            chunks = [(fusion, x.contig)
+                      for x in samFile.get_index_statistics() if x.mapped]
+        else:
+            chunks = [(fusion, None)]
+        samFile.close()
+        worker = bwa_bam_junctions
+    else:  # byte ranges of SAM file
+        size = os.path.getsize(fusion)
+        step = size // thread + 1
+        chunks = [(fusion, sta, min(sta + step, size))
+                  for sta in range(0, size, step)]
+        worker = bwa_sam_junctions
+    if thread > 1 and len(chunks) > 1:
+        pool = Pool(thread)
+        results = pool.map(worker, chunks)
+        pool.close()
+        pool.join()
+    else:
+        results = [worker(chunk) for chunk in chunks]
     fusions = defaultdict(int)
-    samFile = pysam.AlignmentFile(fusion, 'r')
-    for read in samFile:
+    for chunk_fusions in results:
+        for pos, reads in chunk_fusions:
+            fusions[pos] += reads
+    total = 0
+    with open(out, 'w') as outF:
+        for i, pos in enumerate(fusions):
+            outF.write('%s\tFUSIONJUNC_%d/%d\t0\t+\n' % (pos, i, fusions[pos]))
+            total += fusions[pos]
+    print('Converted %d fusion reads!' % total)
+
+
+def bwa_bam_junctions(args):
+    '''
+    Count fusion junctions of BWA reads in BAM file (only on chrom if chrom
+    is not None)
+    args: (fusion, chrom)
+    Return [(junction, reads), ...] in the order of reads
+    '''
+    fusion, chrom = args
+    fusions = defaultdict(int)
+    samFile = pysam.AlignmentFile(fusion, 'rb')
+    reads = samFile.fetch(chrom) if chrom is not None else samFile
+    for read in reads:
         if read.is_unmapped:  # unmapped reads
             continue
         if read.is_supplementary:  # supplementary reads
@@ -172,46 +294,100 @@ def bwa_parse(fusion, out):
             continue
         chr1 = samFile.get_reference_name(read.reference_id)
         strand1 = '+' if not read.is_reverse else '-'
-        saInfo = read.get_tag('SA').split(';')[:-1]
         loc = [read.query_alignment_start, read.query_alignment_end,
                read.reference_start, read.reference_end]
-        segments = [loc]
-        for sa in saInfo:
-            chr2, pos, strand2, cigar = sa.split(',')[:4]
-            if chr1 != chr2:  # not same chromosome
-                continue
-            if strand1 != strand2:  # not same strand
-                continue
-            segment = Segment(pos=pos, cigar=cigar)
-            segments.append([segment.read_start, segment.read_end,
-                             segment.ref_start, segment.ref_end])
-        segments.sort()
-        cov_loc = segments[0][1]
-        ref_loc = segments[0][3]
-        bflag = 0
-        cigar_l, cigar_r = 0, 0
-        ref_l, ref_r = 0, 0
-        for s in segments[1:]:
-            if s[2] < ref_loc and s[0] <= cov_loc:
-                bflag += 1
-                cigar_l = s[0]
-                cigar_r = cov_loc
-                ref_l = s[2]
-                ref_r = ref_loc
-            cov_loc = s[1]
-            ref_loc = s[3]
-        if bflag == 1:
-            fusion_left = str(ref_l)
-            fusion_right = str(ref_r - (cigar_r - cigar_l))
-            fusion_loc = '\t'.join([chr1, fusion_left, fusion_right])
+        fusion_loc = bwa_junction(chr1, strand1, loc, read.get_tag('SA'))
+        if fusion_loc is not None:
             fusions[fusion_loc] += 1
     samFile.close()
-    total = 0
-    with open(out, 'w') as outF:
-        for i, pos in enumerate(fusions):
-            outF.write('%s\tFUSIONJUNC_%d/%d\t0\t+\n' % (pos, i, fusions[pos]))
-            total += fusions[pos]
-    print('Converted %d fusion reads!' % total)
+    return list(fusions.items())
+
+
+def bwa_sam_junctions(args):
+    '''
+    Count fusion junctions of BWA reads starting in [sta, end) bytes of SAM
+    file. Reads without SA tag are skipped before parsing.
+    args: (fusion, sta, end)
+    Return [(junction, reads), ...] in the order of reads
+    '''
+    fusion, sta, end = args
+    fusions = defaultdict(int)
+    with open(fusion, 'rb') as samFile:
+        if sta:  # the line across sta belongs to the previous range
+            samFile.seek(sta - 1)
+            samFile.readline()
+        pos = samFile.tell()
+        while pos < end:
+            line = samFile.readline()
+            if not line:
+                break
+            pos += len(line)
+            if b'\tSA:Z:' not in line or line.startswith(b'@'):
+                continue
+            line_info = line.decode().rstrip('\r\n').split('\t')
+            flag = int(line_info[1])
+            if flag & 4 or flag & 2048:  # unmapped or supplementary reads
+                continue
+            for tag in line_info[11:]:
+                if tag.startswith('SA:Z:'):
+                    sa = tag[5:]
+                    break
+            else:  # SA:Z: in other fields
+                continue
+            strand1 = '+' if not flag & 16 else '-'
+            loc = alignment_loc(line_info[3], line_info[5])
+            fusion_loc = bwa_junction(line_info[2], strand1, loc, sa)
+            if fusion_loc is not None:
+                fusions[fusion_loc] += 1
+    return list(fusions.items())
+
+
+def alignment_loc(pos, cigar):
+    '''
+    [query_alignment_start, query_alignment_end, reference_start,
+     reference_end] of SAM alignment, same as pysam
+    '''
+    read_start, read_end, ref_span = decode_alignment(cigar)
+    ref_start = int(pos) - 1
+    return [read_start, read_end, ref_start, ref_start + ref_span]
+
+
+def bwa_junction(chr1, strand1, loc, sa_tag):
+    '''
+    Back-spliced junction of primary alignment loc and its SA tag
+    Return 'chrom\tstart\tend' or None
+    '''
+    saInfo = sa_tag.split(';')[:-1]
+    segments = [loc]
+    for sa in saInfo:
+        chr2, pos, strand2, cigar = sa.split(',')[:4]
+        if chr1 != chr2:  # not same chromosome
+            continue
+        if strand1 != strand2:  # not same strand
+            continue
+        segment = Segment(pos=pos, cigar=cigar)
+        segments.append([segment.read_start, segment.read_end,
+                         segment.ref_start, segment.ref_end])
+    segments.sort()
+    cov_loc = segments[0][1]
+    ref_loc = segments[0][3]
+    bflag = 0
+    cigar_l, cigar_r = 0, 0
+    ref_l, ref_r = 0, 0
+    for s in segments[1:]:
+        if s[2] < ref_loc and s[0] <= cov_loc:
+            bflag += 1
+            cigar_l = s[0]
+            cigar_r = cov_loc
+            ref_l = s[2]
+            ref_r = ref_loc
+        cov_loc = s[1]
+        ref_loc = s[3]
+    if bflag == 1:
+        fusion_left = str(ref_l)
+        fusion_right = str(ref_r - (cigar_r - cigar_l))
+        return '\t'.join([chr1, fusion_left, fusion_right])
+    return None
 
 
 def segemehl_parse(fusion, out):
@@ -220,14 +396,17 @@ def segemehl_parse(fusion, out):
     '''
     print('Start parsing fusion junctions from segemehl...')
     total = 0
-    with open(fusion, 'r') as junc_f, open(out, 'w') as outf:
-        for i, line in enumerate(junc_f):
-            chrom, start, end, info = line.split()[:4]
-            if not info.endswith('C:P'):
-                continue
-            reads = info.split(':')[1]
-            start = str(int(start) - 1)
-            outf.write('\t'.join([chrom, start, end,
-                                  'FUSIONJUNC_%d/%s\t+\n' % (i, reads)]))
-            total += int(reads)
+    with open(out, 'w') as outf:
+        for index, cols in read_chunks(fusion, 4, int_cols=(1,)):
+            chrom, start, end, info = cols
+            keep = np.char.endswith(info, 'C:P')
+            reads = np.char.partition(info[keep], ':')[:, 2]
+            reads = np.char.partition(reads, ':')[:, 0]
+            start = start[keep] - 1
+            for i, c, s, e, r in zip(index[keep].tolist(),
+                                     chrom[keep].tolist(), start.tolist(),
+                                     end[keep].tolist(), reads.tolist()):
+                outf.write('%s\t%d\t%s\tFUSIONJUNC_%d/%s\t+\n' % (c, s, e, i,
+                                                                 r))
+            total += int(reads.astype(np.int64).sum())
     print('Converted %d fusion reads!' % total)
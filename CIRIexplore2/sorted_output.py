@@ -0,0 +1,56 @@
+'''
+sorted_output.py
+Coordinate-sorted, BGZF-compressed and tabix-indexed BED-like outputs
+'''
+
+import os
+import heapq
+import tempfile
+from itertools import islice
+import pysam
+
+__all__ = ['sort_bed', 'index_bed']
+
+
+def bed_key(line):
+    chrom, start, end = line.split('\t', 3)[:3]
+    return (chrom, int(start), int(end))
+
+
+def sort_bed(in_file, out_file, buffer_lines=1000000):
+    '''
+    Sort BED-like file by (chrom, start, end). Every buffer_lines lines are
+    sorted in memory and spilled into a temporary file, then all the sorted
+    runs are merged.
+    '''
+    runs = []
+    with open(in_file, 'r') as f:
+        while True:
+            lines = list(islice(f, buffer_lines))
+            if not lines:
+                break
+            if not lines[-1].endswith('\n'):
+                lines[-1] += '\n'
+            lines.sort(key=bed_key)
+            run = tempfile.TemporaryFile(mode='w+')
+            run.writelines(lines)
+            run.seek(0)
+            runs.append(run)
+    with open(out_file, 'w') as outf:
+        outf.writelines(heapq.merge(*runs, key=bed_key))
+    for run in runs:
+        run.close()
+
+
+def index_bed(in_file, buffer_lines=1000000):
+    '''
+    Write in_file.gz sorted by coordinates with tabix index in_file.gz.tbi
+    Return path of in_file.gz
+    '''
+    sorted_f = '%s.sorted%d' % (in_file, os.getpid())
+    sort_bed(in_file, sorted_f, buffer_lines)
+    gz_f = in_file + '.gz'
+    pysam.tabix_compress(sorted_f, gz_f, force=True)
+    os.remove(sorted_f)
+    pysam.tabix_index(gz_f, preset='bed', force=True)
+    return gz_f
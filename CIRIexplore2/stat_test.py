@@ -0,0 +1,47 @@
+'''
+stat_test.py
+Batch one-sided Fisher exact and binomial tests for denovo AS outputs
+'''
+
+import numpy as np
+from scipy.stats import hypergeom, binom
+
+__all__ = ['fisher_exact_batch', 'binom_cdf_batch']
+
+
+def fisher_exact_batch(tables):
+    '''
+    One-sided fisher exact tests for many 2x2 tables at once, same as
+    scipy.stats.fisher_exact with alternative 'greater' and 'less'.
+    tables: [[a, b, c, d], ...] for [[a, b], [c, d]]
+    Return (p_greater, p_less) arrays
+    '''
+    tables = np.asarray(tables, dtype=np.int64).reshape(-1, 4)
+    if not len(tables):
+        return (np.zeros(0), np.zeros(0))
+    # many low-count tables are shared, so test each table only once
+    uniq, inverse = np.unique(tables, axis=0, return_inverse=True)
+    a, b, c, d = uniq.T
+    n1 = a + b
+    n2 = c + d
+    p_greater = hypergeom.cdf(b, n1 + n2, n1, b + d)
+    p_less = hypergeom.cdf(a, n1 + n2, n1, a + c)
+    # the p-value is 1 if both values in a row or column are zero
+    empty = (n1 == 0) | (n2 == 0) | (a + c == 0) | (b + d == 0)
+    p_greater[empty] = 1.0
+    p_less[empty] = 1.0
+    inverse = inverse.reshape(-1)
+    return (p_greater[inverse], p_less[inverse])
+
+
+def binom_cdf_batch(k, n, p):
+    '''
+    binom.cdf(k, n, p) for many (k, n) pairs at once
+    Return p-values array
+    '''
+    pairs = np.column_stack((np.asarray(k, dtype=np.float64),
+                             np.asarray(n, dtype=np.float64)))
+    if not len(pairs):
+        return np.zeros(0)
+    uniq, inverse = np.unique(pairs, axis=0, return_inverse=True)
+    return binom.cdf(uniq[:, 0], uniq[:, 1], p)[inverse.reshape(-1)]
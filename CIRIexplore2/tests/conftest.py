@@ -0,0 +1,13 @@
+'''
+conftest.py
+Make CIRIexplore2 modules importable as the command line does
+'''
+
+import os.path
+import sys
+import importlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+# YHparser is imported as parser by the other modules
+sys.modules['parser'] = importlib.import_module('YHparser')
@@ -0,0 +1,260 @@
+'''
+Annotation and realignment of fusion junctions
+'''
+
+import random
+import annotate
+
+GENOME = ('ACGTTGCAAGCTTGACCATGGTACGATCGGATCCTAGCTAGGCTTAACGTACGGTCAAGT'
+          * 17)[:1000]
+
+
+def write_fixture(tmp_path, ref_lines, bsj_lines, chroms=('chr1',)):
+    tmp_path.mkdir(exist_ok=True)
+    (tmp_path / 'genome.fa').write_text(''.join('>%s\n%s\n' % (x, GENOME)
+                                                for x in chroms))
+    (tmp_path / 'ref.txt').write_text(''.join(x + '\n' for x in ref_lines))
+    (tmp_path / 'bsj.bed').write_text(''.join(x + '\n' for x in bsj_lines))
+    return [str(tmp_path / x) for x in ('ref.txt', 'genome.fa', 'bsj.bed')]
+
+
+def random_fixture(seed):
+    '''
+    Known and CUFF isoforms (partly sharing exons) of two chromosomes with
+    back-spliced junctions near their exon boundaries
+    '''
+    rand = random.Random(seed)
+    ref_lines, bsj_lines = [], []
+    for chrom in ('chr1', 'chr2'):
+        pos, gene = 20, 0
+        while pos < 800:
+            gene += 1
+            starts, ends = [], []
+            sta = pos
+            for _ in range(rand.randint(1, 4)):
+                starts.append(sta)
+                ends.append(sta + rand.randint(20, 60))
+                sta = ends[-1] + rand.randint(10, 40)
+            isoforms = [('G%d' % gene, 'NM_%s_%d' % (chrom, gene), starts,
+                         ends)]
+            if rand.random() < 0.6:  # novel isoform extending known one
+                isoforms.append(('CUFF.%d' % gene,
+                                 'CUFF.%s.%d' % (chrom, gene),
+                                 [starts[0] - 15] + starts,
+                                 [starts[0] - 5] + ends))
+            strand = rand.choice('+-')
+            for g, iso, iso_starts, iso_ends in isoforms:
+                ref_lines.append('\t'.join([
+                    g, iso, chrom, strand, str(iso_starts[0]),
+                    str(iso_ends[-1]), str(iso_starts[0]), str(iso_ends[-1]),
+                    str(len(iso_starts)),
+                    ''.join('%d,' % x for x in iso_starts),
+                    ''.join('%d,' % x for x in iso_ends)]))
+                for _ in range(2):
+                    i = rand.randrange(len(iso_starts))
+                    j = rand.randrange(i, len(iso_starts))
+                    shift = rand.choice([0, 0, rand.randint(-3, 3)])
+                    bsj_lines.append('%s\t%d\t%d\tFUSIONJUNC_%d/%d\t0\t+' %
+                                     (chrom, iso_starts[i] + shift,
+                                      iso_ends[j], len(bsj_lines),
+                                      rand.randint(1, 9)))
+            pos = ends[-1] + rand.randint(5, 40)
+    return (ref_lines, bsj_lines)
+
+
+def run_annotate(tmp_path, monkeypatch, ref_lines, bsj_lines, thread=1):
+    ref_f, genome_fa, bsj_f = write_fixture(tmp_path, ref_lines, bsj_lines,
+                                            ('chr1', 'chr2'))
+    monkeypatch.chdir(tmp_path)
+    candidates = annotate.annotate_fusion(ref_f, bsj_f, denovo_flag=1,
+                                          thread=thread)
+    annotate.fix_fusion(ref_f, genome_fa, 'out.txt', False, candidates,
+                        denovo_flag=1, thread=thread)
+    return [x.split('\t') for x in (tmp_path / 'out.txt').read_text()
+            .splitlines()]
+
+
+# known isoform and CUFF isoform sharing the back-spliced exons
+SHARED_REF = [
+    'GK\tNM_1\tchr1\t+\t100\t400\t100\t400\t2\t100,300,\t200,400,',
+    'CUFF.1\tCUFF.1.1\tchr1\t+\t50\t600\t50\t600\t4\t50,100,300,500,\t'
+    '80,200,400,600,'
+]
+
+
+def test_denovo_prefers_known_isoform(tmp_path, monkeypatch):
+    out = run_annotate(tmp_path, monkeypatch, SHARED_REF,
+                       ['chr1\t100\t400\tFUSIONJUNC_1/5\t0\t+'])
+    assert len(out) == 1
+    assert out[0][:3] == ['chr1', '100', '400']
+    assert out[0][14:] == ['GK', 'NM_1', '1,2', 'None|None']
+
+
+def test_denovo_prefers_known_isoform_cached(tmp_path, monkeypatch):
+    ref_f, genome_fa, bsj_f = write_fixture(
+        tmp_path, SHARED_REF, ['chr1\t100\t400\tFUSIONJUNC_1/5\t0\t+'])
+    monkeypatch.chdir(tmp_path)
+    for _ in range(2):  # fill and reuse the cache
+        annotate.cached_fusion(ref_f, genome_fa, bsj_f, 'out.txt', False,
+                               str(tmp_path / 'cache'), denovo_flag=1)
+        out = (tmp_path / 'out.txt').read_text().split('\t')
+        assert out[14:16] == ['GK', 'NM_1']
+
+
+def test_threads_match_serial(tmp_path, monkeypatch):
+    ref_lines, bsj_lines = random_fixture(1)
+    serial = run_annotate(tmp_path / 'serial', monkeypatch, ref_lines,
+                          bsj_lines)
+    assert serial
+    parallel = run_annotate(tmp_path / 'parallel', monkeypatch, ref_lines,
+                            bsj_lines, thread=2)
+    assert parallel == serial
+
+
+def test_cache_matches_uncached(tmp_path, monkeypatch):
+    ref_lines, bsj_lines = random_fixture(2)
+    expected = run_annotate(tmp_path / 'plain', monkeypatch, ref_lines,
+                            bsj_lines)
+    ref_f, genome_fa, bsj_f = write_fixture(tmp_path / 'cached', ref_lines,
+                                            bsj_lines, ('chr1', 'chr2'))
+    half_f = str(tmp_path / 'cached' / 'half.bed')
+    with open(half_f, 'w') as f:
+        f.write(''.join(x + '\n' for x in bsj_lines[::2]))
+    cache_dir = str(tmp_path / 'cache')
+    monkeypatch.chdir(tmp_path / 'cached')
+    # empty, partly filled and filled cache
+    for bed_f, thread in ((half_f, 1), (bsj_f, 1), (bsj_f, 2)):
+        annotate.cached_fusion(ref_f, genome_fa, bed_f, 'out.txt', False,
+                               cache_dir, denovo_flag=1, thread=thread)
+    out = [x.split('\t') for x in (tmp_path / 'cached' / 'out.txt')
+           .read_text().splitlines()]
+    assert out == expected
+
+
+# gene blocks 20bp apart, so that their padded blocks overlap
+EDGE_REF = [
+    'GA\tNM_A\tchr1\t+\t100\t300\t100\t300\t2\t100,250,\t200,300,',
+    'GB\tNM_B\tchr1\t+\t320\t500\t320\t500\t2\t320,450,\t400,500,',
+    'CUFF.6\tCUFF.6.1\tchr1\t+\t539\t700\t539\t700\t2\t539,650,\t600,700,',
+    'GC\tNM_C\tchr1\t-\t800\t900\t800\t900\t1\t800,\t900,',
+    'CUFF.7\tCUFF.7.1\tchr1\t-\t750\t900\t750\t900\t2\t750,800,\t790,900,'
+]
+EDGE_BSJ = [(250, 400), (305, 330), (518, 528), (100, 300), (320, 500),
+            (290, 318), (250, 300), (450, 511), (100, 500), (528, 600),
+            (539, 711), (745, 790), (789, 900), (100, 200), (311, 400),
+            (529, 600), (539, 710), (538, 711), (309, 500), (310, 489),
+            (539, 600), (539, 700), (650, 700), (750, 900), (800, 900)]
+# output of the baseline annotate (junctions in merged gene blocks padded by
+# 11bp) as start, end, gene, isoform, exon index and flank
+EDGE_KNOWN = [
+    ('100', '200', 'GA', 'NM_A', '1', 'None|chr1:200-250'),
+    ('100', '300', 'GA', 'NM_A', '1,2', 'None|None'),
+    ('250', '300', 'GA', 'NM_A', '2', 'chr1:200-250|None'),
+    ('320', '500', 'GB', 'NM_B', '1,2', 'None|None'),
+    ('800', '900', 'GC', 'NM_C', '1', 'None|None')
+]
+EDGE_NOVEL = [
+    ('539', '600', 'CUFF.6', 'CUFF.6.1', '1', 'None|chr1:600-650'),
+    ('539', '700', 'CUFF.6', 'CUFF.6.1', '1,2', 'None|None'),
+    ('650', '700', 'CUFF.6', 'CUFF.6.1', '2', 'chr1:600-650|None'),
+    ('750', '900', 'CUFF.7', 'CUFF.7.1', '2,1', 'None|None')
+]
+
+
+def test_block_edges_match_baseline(tmp_path, monkeypatch):
+    bsj_lines = ['chr1\t%d\t%d\tFUSIONJUNC_%d/%d\t0\t+' % (sta, end, n, n + 1)
+                 for n, (sta, end) in enumerate(EDGE_BSJ)]
+    ref_f, genome_fa, bsj_f = write_fixture(tmp_path, EDGE_REF, bsj_lines)
+    monkeypatch.chdir(tmp_path)
+    for flags, expected in (({'denovo_flag': 1}, EDGE_KNOWN + EDGE_NOVEL),
+                            ({'secondary_flag': 1}, EDGE_KNOWN),
+                            ({}, EDGE_KNOWN)):
+        candidates = annotate.annotate_fusion(ref_f, bsj_f, **flags)
+        annotate.fix_fusion(ref_f, genome_fa, 'out.txt', False, candidates,
+                            **flags)
+        out = [x.split('\t') for x in (tmp_path / 'out.txt').read_text()
+               .splitlines()]
+        assert sorted(tuple(x[1:3] + x[14:18]) for x in out) == \
+            sorted(expected)
+
+
+def write_baseline_tmp(candidates, tmp_f):
+    '''
+    Write candidates as the lines of annotated_fusion.txt.tmp written by
+    the file-based annotate_fusion (exon blocks are not read back)
+    '''
+    with open(tmp_f, 'w') as outf:
+        for n, x in enumerate(candidates):
+            fus_loc = '%s\t%d\t%d\tFUSIONJUNC_%d/%d' % (x.chrom, x.start,
+                                                        x.end, n, x.reads)
+            if x.flag == 'secondary':
+                outf.write('%s\t0\t%s\t%s\t%s\n' % (fus_loc, x.strand,
+                                                    x.gene, x.iso))
+            else:
+                outf.write('\t'.join([fus_loc, '0', x.strand, str(x.start),
+                                      str(x.start), '0,0,0', '1', '0', '0',
+                                      x.flag, x.gene, x.iso, x.index]) +
+                           '\n')
+
+
+def read_baseline_tmp(tmp_f):
+    '''
+    Candidates parsed from annotated_fusion.txt.tmp as the file-based
+    fix_bed does
+    '''
+    candidates = []
+    with open(tmp_f, 'r') as f:
+        for line in f:
+            chrom = line.split()[0]
+            strand = line.split()[5]
+            start, end = [int(x) for x in line.split()[1:3]]
+            reads = int(line.split()[3].split('/')[1])
+            if len(line.split()) == 8:
+                left_info, right_info = line.split()[6:8]
+                candidates.append(annotate.Candidate(
+                    chrom, start, end, reads, strand, 'secondary', left_info,
+                    right_info, ''))
+            else:
+                flag, gene, iso, index = line.split()[-4:]
+                candidates.append(annotate.Candidate(
+                    chrom, start, end, reads, strand, flag, gene, iso, index))
+    return candidates
+
+
+# isoforms of one gene for secondary candidates and ciRNAs
+HAND_OFF_REF = [
+    'GS\tNM_S1\tchr3\t+\t100\t400\t100\t400\t2\t100,300,\t200,400,',
+    'GS\tNM_S2\tchr3\t+\t150\t600\t150\t600\t2\t150,500,\t250,600,'
+]
+HAND_OFF_BSJ = ['chr3\t100\t600\tFUSIONJUNC_100/3\t0\t+',
+                'chr3\t200\t260\tFUSIONJUNC_101/2\t0\t+',
+                'chr3\t203\t262\tFUSIONJUNC_102/1\t0\t+',
+                'chr3\t302\t400\tFUSIONJUNC_103/4\t0\t+']
+
+
+def test_in_memory_matches_file_hand_off(tmp_path, monkeypatch):
+    ref_lines, bsj_lines = random_fixture(3)
+    ref_f, genome_fa, bsj_f = write_fixture(
+        tmp_path, ref_lines + HAND_OFF_REF, bsj_lines + HAND_OFF_BSJ,
+        ('chr1', 'chr2', 'chr3'))
+    monkeypatch.chdir(tmp_path)
+    for flags in ({'denovo_flag': 1}, {'secondary_flag': 1}):
+        outputs = []
+        for spill_flag in (False, True, None):
+            candidates = annotate.annotate_fusion(
+                ref_f, bsj_f, spill_flag=bool(spill_flag), **flags)
+            if spill_flag is None:  # through annotated_fusion.txt.tmp
+                write_baseline_tmp(candidates, 'annotated_fusion.txt.tmp')
+                candidates.close()
+                candidates = annotate.CandidateStore()
+                for candidate in read_baseline_tmp(
+                        'annotated_fusion.txt.tmp'):
+                    candidates.add(candidate)
+            annotate.fix_fusion(ref_f, genome_fa, 'out.txt', False,
+                                candidates, **flags)
+            outputs.append([(tmp_path / x).read_text() for x in
+                            ('out.txt', 'low_conf_out.txt')
+                            if x == 'out.txt' or 'secondary_flag' in flags])
+        assert 'ciRNA' in outputs[0][0] and outputs[0][-1]
+        assert outputs[1] == outputs[0]
+        assert outputs[2] == outputs[0]
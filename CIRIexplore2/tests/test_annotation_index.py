@@ -0,0 +1,111 @@
+'''
+Annotation index and the denovo annotation overlay
+'''
+
+import os
+import random
+import numpy as np
+import annotation_index
+from annotation_index import AnnotationIndex, load_index, load_overlay
+
+
+def random_ref(seed, num=60):
+    '''
+    refFlat lines of known and CUFF isoforms with duplicated lines
+    '''
+    rand = random.Random(seed)
+    lines = []
+    for n in range(num):
+        chrom = rand.choice(['chr1', 'chr2', 'chrX'])
+        sta = rand.randint(0, 5000)
+        starts, ends = [], []
+        for _ in range(rand.randint(1, 5)):
+            starts.append(sta)
+            ends.append(sta + rand.randint(10, 200))
+            sta = ends[-1] + rand.randint(10, 300)
+        if rand.random() < 0.3:
+            gene = iso = 'CUFF.%d.1' % n
+        else:
+            gene, iso = 'G%d' % (n // 3), 'NM_%d' % n
+        lines.append('\t'.join([gene, iso, chrom, rand.choice('+-'),
+                                str(starts[0]), str(ends[-1]),
+                                str(starts[0]), str(ends[-1]),
+                                str(len(starts)),
+                                ''.join('%d,' % x for x in starts),
+                                ''.join('%d,' % x for x in ends)]) + '\n')
+    return lines + rand.sample(lines, 5)
+
+
+def assert_same_index(a, b):
+    for name in annotation_index.ARRAYS:
+        assert np.array_equal(getattr(a, name), getattr(b, name)), name
+    assert a.isoforms == b.isoforms
+    assert a.chroms == b.chroms
+    assert a.blocks == b.blocks
+
+
+def test_merge_matches_concatenated_file(tmp_path):
+    ref_lines = [x for x in random_ref(1) if not x.startswith('CUFF')]
+    delta_lines = random_ref(2)
+    (tmp_path / 'ref.txt').write_text(''.join(ref_lines))
+    (tmp_path / 'delta.txt').write_text(''.join(delta_lines))
+    (tmp_path / 'combined.txt').write_text(''.join(
+        [x for x in delta_lines if x.startswith('CUFF')] + ref_lines))
+    merged = AnnotationIndex.merge(
+        [AnnotationIndex.build(str(tmp_path / 'delta.txt'), 'CUFF'),
+         AnnotationIndex.build(str(tmp_path / 'ref.txt'))], None)
+    assert_same_index(merged,
+                      AnnotationIndex.build(str(tmp_path / 'combined.txt')))
+
+
+def test_overlay_keeps_existing_combined_file(tmp_path):
+    (tmp_path / 'ref.txt').write_text(''.join(
+        x for x in random_ref(3) if not x.startswith('CUFF')))
+    (tmp_path / 'delta.txt').write_text(''.join(random_ref(4)))
+    combined_f = tmp_path / 'combined_ref.txt'
+    combined_f.write_text('user file\n')
+    overlay = load_overlay(str(tmp_path / 'ref.txt'),
+                           str(tmp_path / 'delta.txt'), str(combined_f))
+    assert combined_f.read_text() == 'user file\n'
+    # saved overlay wins over the unrelated file in a fresh process
+    annotation_index._indexes.clear()
+    assert_same_index(load_index(str(combined_f)), overlay)
+    assert combined_f.read_text() == 'user file\n'
+
+
+def test_boundaries(tmp_path):
+    lines = random_ref(5)
+    (tmp_path / 'ref.txt').write_text(''.join(lines))
+    index = AnnotationIndex.build(str(tmp_path / 'ref.txt'))
+    for chrom in ('chr1', 'chr2', 'chrX', 'chrY'):
+        starts, ends = set(), set()
+        for line in lines:
+            line_info = line.split()
+            if line_info[2] == chrom:
+                starts.update(int(x) for x in line_info[9].rstrip(',')
+                              .split(','))
+                ends.update(int(x) for x in line_info[10].rstrip(',')
+                            .split(','))
+        left, right = index.boundaries(chrom)
+        assert left.tolist() == sorted(starts)
+        assert right.tolist() == sorted(ends)
+
+
+def test_edited_reference_rebuilt(tmp_path):
+    ref_f = tmp_path / 'ref.txt'
+    lines = random_ref(6)
+    ref_f.write_text(''.join(lines))
+    mtime = os.stat(str(ref_f)).st_mtime_ns
+    index = load_index(str(ref_f))
+    # same size and modified within the same second
+    strand = lines[0].split('\t')[3]
+    lines[0] = lines[0].replace('\t%s\t' % strand,
+                                '\t%s\t' % '+-'[strand == '+'], 1)
+    ref_f.write_text(''.join(lines))
+    os.utime(str(ref_f), ns=(mtime + 1, mtime + 1))
+    expected = AnnotationIndex.build(str(ref_f))
+    assert_same_index(load_index(str(ref_f)), expected)
+    # saved index of the edited reference in a fresh process
+    annotation_index._indexes.clear()
+    assert_same_index(load_index(str(ref_f)), expected)
+    assert sorted(index.isoforms) != sorted(expected.isoforms)
@@ -0,0 +1,125 @@
+'''
+Contig and region exclusion of BAM files against the read by read filter
+'''
+
+import random
+import shutil
+import pysam
+from bam_filter import read_regions, filter_bam
+
+CONTIGS = (('chr1', 3000), ('chrUn_gl000220', 1000), ('chr2', 2000))
+
+
+def write_bam(tmp_path, seed, num=800):
+    '''
+    Coordinate-sorted BAM of spliced, unspliced and unmapped reads, written
+    with and without index
+    '''
+    rand = random.Random(seed)
+    header = {'HD': {'VN': '1.0', 'SO': 'coordinate'},
+              'SQ': [{'SN': chrom, 'LN': length}
+                     for chrom, length in CONTIGS]}
+    reads = []
+    for n in range(num):
+        read = pysam.AlignedSegment()
+        read.query_name = 'r%d' % n
+        read.reference_id = rand.randrange(len(CONTIGS))
+        length = CONTIGS[read.reference_id][1]
+        read.query_sequence = 'A' * 40
+        if rand.random() < 0.05:  # unmapped read placed at its mate
+            read.flag = 4
+            read.reference_start = rand.randrange(length)
+        else:
+            cigar = [(0, 20), (3, rand.randint(1, 300)), (0, 20)]
+            if rand.random() < 0.5:
+                cigar = [(0, 40)]
+            read.cigartuples = cigar
+            span = sum(x for op, x in cigar)
+            read.reference_start = rand.randint(0, length - span)
+        reads.append(read)
+    reads.sort(key=lambda x: (x.reference_id, x.reference_start))
+    for n in range(5):  # unplaced unmapped reads at the end
+        read = pysam.AlignedSegment()
+        read.query_name = 'u%d' % n
+        read.flag = 4
+        read.reference_id = -1
+        read.reference_start = -1
+        read.query_sequence = 'A' * 40
+        reads.append(read)
+    unindexed = str(tmp_path / 'unindexed.bam')
+    with pysam.AlignmentFile(unindexed, 'wb', header=header) as f:
+        for read in reads:
+            f.write(read)
+    indexed = str(tmp_path / 'indexed.bam')
+    shutil.copy(unindexed, indexed)
+    pysam.index(indexed)
+    return (indexed, unindexed)
+
+
+def read_names(bam_f):
+    with pysam.AlignmentFile(bam_f, 'rb') as bam:
+        return [read.query_name for read in bam.fetch(until_eof=True)]
+
+
+def test_contig_filter_matches_read_loop(tmp_path):
+    for seed in range(3):
+        (tmp_path / str(seed)).mkdir()
+        for bam_f in write_bam(tmp_path / str(seed), seed):
+            # previous --remove-rRNA filter
+            expected = []
+            with pysam.AlignmentFile(bam_f, 'rb') as bam:
+                for read in bam.fetch(until_eof=True):
+                    chrom = bam.get_reference_name(read.reference_id)
+                    if chrom != 'chrUn_gl000220':
+                        expected.append(read.query_name)
+            out_f = bam_f + '.out.bam'
+            assert filter_bam(bam_f, out_f, ['chrUn_gl000220'],
+                              thread=2) == len(expected)
+            assert read_names(out_f) == expected
+
+
+def test_region_filter_matches_read_loop(tmp_path):
+    for seed in range(3):
+        seed_dir = tmp_path / str(seed)
+        seed_dir.mkdir()
+        bam_files = write_bam(seed_dir, seed)
+        rand = random.Random(seed)
+        intervals = []
+        for chrom, length in (CONTIGS[0], CONTIGS[2], ('chrM', 100)):
+            for _ in range(6):
+                sta = rand.randint(0, length - 1)
+                intervals.append((chrom, sta, sta + rand.randint(1, 300)))
+            # overlapped and adjacent regions
+            chrom, sta, end = intervals[-1]
+            intervals.append((chrom, end - 10, end + 40))
+            intervals.append((chrom, end + 40, end + 60))
+        # regions ending at the start or starting at the end of reads
+        with pysam.AlignmentFile(bam_files[0], 'rb') as bam:
+            reads = [x for x in bam.fetch('chr2') if not x.is_unmapped]
+        for read in rand.sample(reads, 4):
+            intervals.append(('chr2', max(read.reference_start - 50, 0),
+                              read.reference_start))
+            intervals.append(('chr2', read.reference_end,
+                              read.reference_end + 50))
+        bed_f = str(seed_dir / 'exclude.bed')
+        with open(bed_f, 'w') as f:
+            f.write('track name=exclude\n')
+            f.write(''.join('%s\t%d\t%d\n' % x for x in intervals))
+        regions = read_regions(bed_f)
+        for bam_f in bam_files:
+            expected = []
+            with pysam.AlignmentFile(bam_f, 'rb') as bam:
+                for read in bam.fetch(until_eof=True):
+                    chrom = bam.get_reference_name(read.reference_id)
+                    if chrom == 'chrUn_gl000220':
+                        continue
+                    sta = read.reference_start
+                    end = read.reference_end or sta + 1
+                    if any(x[0] == chrom and sta < x[2] and end > x[1]
+                           for x in intervals):
+                        continue
+                    expected.append(read.query_name)
+            out_f = bam_f + '.out.bam'
+            assert filter_bam(bam_f, out_f, ['chrUn_gl000220'], regions,
+                              thread=2) == len(expected)
+            assert read_names(out_f) == expected
@@ -0,0 +1,59 @@
+'''
+Chunked column reader against splitting lines one by one
+'''
+
+import gzip
+import random
+import numpy as np
+from chunk_reader import read_chunks
+
+
+def split_lines(lines, ncol, int_cols):
+    '''
+    (line number, columns) of rows split one by one
+    '''
+    rows = []
+    for n, line in enumerate(lines):
+        if line.startswith('#'):
+            continue
+        row = line.split(None, ncol)[:ncol]
+        if len(row) < ncol:
+            continue
+        if not all(row[x].lstrip('-').isdigit() for x in int_cols):
+            continue
+        rows.append((n, [int(x) if i in int_cols else x
+                         for i, x in enumerate(row)]))
+    return rows
+
+
+def test_read_chunks_matches_split(tmp_path):
+    rand = random.Random(0)
+    for seed in range(20):
+        lines = []
+        for _ in range(rand.randint(0, 50)):
+            lines.append(rand.choice([
+                'chr1\t%d\t%d\tFUSIONJUNC_1/2\t0\t+\n' % (
+                    rand.randint(0, 99), rand.randint(-9, 99)),
+                'chr2  %d %d name\n' % (rand.randint(0, 9),
+                                         rand.randint(0, 9)),
+                'chrX\t1\n', '\n', '# comment\n', 'chr\tstart\tend\tname\n']))
+        if seed % 2:  # file without comment, blank or short lines
+            lines = [x for x in lines if len(x.split()) >= 4]
+        text = ''.join(lines)
+        in_file = str(tmp_path / ('%d.bed' % seed))
+        if seed % 3:
+            with open(in_file, 'w') as f:
+                f.write(text)
+        else:
+            with gzip.open(in_file, 'wt') as f:
+                f.write(text)
+        expected = split_lines(lines, 4, (1, 2))
+        for chunk_lines in (1, 3, 1000000):
+            result = []
+            for index, cols in read_chunks(in_file, 4, chunk_lines, (1, 2)):
+                assert cols[1].dtype == np.int64
+                assert cols[2].dtype == np.int64
+                result += zip(index.tolist(),
+                              [list(x) for x in zip(*[c.tolist()
+                                                      for c in cols])])
+            assert result == expected
@@ -0,0 +1,88 @@
+'''
+Base coverage and intron read counts against per-region read loops
+'''
+
+import os
+import random
+import pysam
+import coverage
+from coverage import count_intron_reads
+from helper import Expression, fetch_read
+
+
+def random_cigar(rand):
+    '''
+    CIGAR with soft clips, insertions, deletions and skipped regions
+    '''
+    cigar = [(4, rand.randint(1, 5))] if rand.random() < 0.3 else []
+    cigar.append((0, rand.randint(5, 40)))
+    for _ in range(rand.randint(0, 3)):
+        cigar.append((rand.choice([1, 2, 2, 3]), rand.randint(1, 30)))
+        cigar.append((0, rand.randint(5, 40)))
+    if rand.random() < 0.3:
+        cigar.append((4, rand.randint(1, 5)))
+    return cigar
+
+
+def write_bam(bam_f, seed, num=600):
+    rand = random.Random(seed)
+    header = {'HD': {'VN': '1.0', 'SO': 'coordinate'},
+              'SQ': [{'SN': 'chr1', 'LN': 3000}, {'SN': 'chr2', 'LN': 3000}]}
+    reads = []
+    for n in range(num):
+        read = pysam.AlignedSegment()
+        read.query_name = 'r%d' % n
+        read.reference_id = rand.randint(0, 1)
+        read.reference_start = rand.randint(0, 2500)
+        read.cigartuples = random_cigar(rand)
+        read.query_sequence = 'A' * read.infer_query_length()
+        read.flag = rand.choice([0, 16])
+        reads.append(read)
+    reads.sort(key=lambda x: (x.reference_id, x.reference_start))
+    with pysam.AlignmentFile(bam_f, 'wb', header=header) as f:
+        for read in reads:
+            f.write(read)
+    pysam.index(bam_f)
+
+
+def test_count_intron_reads_matches_fetch_read(tmp_path, monkeypatch):
+    monkeypatch.setattr(coverage, 'BUFFER', 16)  # flush and grow buffers
+    for seed in range(3):
+        bam_f = str(tmp_path / ('%d.bam' % seed))
+        write_bam(bam_f, seed)
+        rand = random.Random(seed)
+        introns = []
+        for _ in range(100):
+            sta = rand.randint(8, 2800)
+            introns.append([rand.choice(['chr1', 'chr2']), sta,
+                            sta + rand.randint(1, 150)])
+        bam = pysam.AlignmentFile(bam_f, 'rb')
+        left, right, body = count_intron_reads(bam, introns)
+        for n, (chrom, sta, end) in enumerate(introns):
+            assert left[n] == fetch_read(bam, chrom, sta - 8, sta + 8)
+            assert right[n] == fetch_read(bam, chrom, end - 8, end + 8)
+            assert abs(body[n] - fetch_read(bam, chrom, sta, end, 0)) < 1e-9
+        bam.close()
+
+
+def test_rpkm_matches_get_overlap(tmp_path):
+    bam_f = str(tmp_path / 'reads.bam')
+    write_bam(bam_f, 3)
+    rand = random.Random(3)
+    regions = []
+    for _ in range(200):
+        sta = rand.randint(0, 2900)
+        regions.append((rand.choice(['chr1', 'chr2']), sta,
+                        sta + rand.randint(1, 200)))
+    expected = Expression(bam_f)
+    for _ in range(2):  # build and load saved coverage
+        expression = Expression(bam_f, coverage_flag=True)
+        for chrom, sta, end in regions:
+            assert abs(expression.rpkm(chrom, sta, end) -
+                       expected.rpkm(chrom, sta, end)) < 1e-6
+    # rebuild broken coverage
+    os.remove(bam_f + '.split.cov/cum.npy')
+    expression = Expression(bam_f, coverage_flag=True)
+    for chrom, sta, end in regions:
+        assert abs(expression.rpkm(chrom, sta, end) -
+                   expected.rpkm(chrom, sta, end)) < 1e-6
@@ -0,0 +1,324 @@
+'''
+Denovo stages on the columnar circRNA table against per-line parsing
+'''
+
+import random
+from collections import defaultdict
+import pysam
+import denovo
+from annotate import pool_map
+from circ_table import load_circ
+from junction_graph import load_junctions
+
+CHROMS = (('chr1', 3000), ('chr2', 2000), ('chr3', 1000))
+# introns of known circRNAs retained in CUFF circRNAs of chr3
+RETAINED = [
+    ['chr3', 100, 400, 'G_RI1', '+', [[100, 150], [300, 400]]],
+    ['chr3', 120, 350, 'CUFF.RI1', '+', [[120, 140], [160, 290]]],
+    ['chr3', 500, 900, 'G_RI2', '-', [[500, 600], [800, 900]]],
+    ['chr3', 550, 850, 'CUFF.RI2', '-', [[550, 850]]]]
+
+
+def write_fixture(tmp_path, seed, num=300):
+    '''
+    circularRNA_full.txt with known and CUFF isoforms of circRNAs sharing
+    back-spliced sites, ciRNAs and duplicated circRNAs, a gene annotation
+    partly sharing their exon boundaries and a genome for strand inference
+    '''
+    rand = random.Random(seed)
+    genome_fa = str(tmp_path / 'genome.fa')
+    with open(genome_fa, 'w') as f:
+        for chrom, length in CHROMS:
+            seq = ''.join(rand.choice('ACGTACGTAGGTACCTacgtN')
+                          for _ in range(length))
+            f.write('>%s\n' % chrom)
+            for i in range(0, length, 60):
+                f.write(seq[i:(i + 60)] + '\n')
+    sites = dict((chrom, sorted(rand.sample(range(2, length - 1), 40)))
+                 for chrom, length in CHROMS[:2])
+    lines = []
+    for n in range(num):
+        if lines and rand.random() < 0.2:  # same circRNA, other isoform
+            info = rand.choice(lines).split('\t')
+            info[14] = rand.choice(['G%d' % n, 'CUFF.%d' % n])
+            info[15] = info[14] + '.1'
+            lines.append('\t'.join(info))
+            continue
+        chrom = rand.choice(CHROMS[:2])[0]
+        start, end = sorted(rand.sample(sites[chrom], 2))
+        starts, ends = [start], []
+        while True:
+            sta = starts[-1]
+            if end - sta < 20 or rand.random() < 0.4:
+                ends.append(end)
+                break
+            ends.append(rand.randint(sta + 1, (sta + end) // 2))
+            starts.append(rand.randint(ends[-1], end - 1))
+        read = rand.randint(1, 9)
+        gene = rand.choice(['G%d' % n, 'CUFF.%d' % n])
+        lines.append('\t'.join([
+            chrom, str(start), str(end),
+            'FUSIONJUNC_%d/%d' % (n, read), str(rand.randint(0, 5)),
+            rand.choice('+-'), str(start), str(start), '0,0,0',
+            str(len(starts)),
+            ','.join(str(e - s) for s, e in zip(starts, ends)),
+            ','.join(str(s - start) for s in starts),
+            str(rand.choice([0, read])),
+            rand.choice(['circRNA', 'circRNA', 'ciRNA']),
+            gene, gene + '.1', '%d,%d' % (n, n), 'GT-AG']))
+    for n, (chrom, start, end, gene, strand, exons) in enumerate(RETAINED):
+        lines.append('\t'.join([
+            chrom, str(start), str(end), 'FUSIONJUNC_RI%d/5' % n, '0',
+            strand, str(start), str(start), '0,0,0', str(len(exons)),
+            ','.join(str(e - s) for s, e in exons),
+            ','.join(str(s - start) for s, _ in exons), '5', 'circRNA',
+            gene, gene + '.1', '0,0', 'GT-AG']))
+    circ_f = str(tmp_path / 'circularRNA_full.txt')
+    with open(circ_f, 'w') as f:
+        f.write(''.join(x + '\n' for x in lines))
+    ref_f = str(tmp_path / 'ref.txt')
+    with open(ref_f, 'w') as f:
+        for chrom, _ in CHROMS[:2]:
+            for n in range(10):
+                exon_starts = sorted(rand.sample(sites[chrom], 3))
+                exon_ends = [x + rand.choice([0, 1, 5]) for x in
+                             exon_starts[1:]] + [exon_starts[-1] + 30]
+                f.write('\t'.join([
+                    'G%d' % n, 'NM_%s_%d' % (chrom, n), chrom, '+',
+                    str(exon_starts[0]), str(exon_ends[-1]),
+                    str(exon_starts[0]), str(exon_ends[-1]), '3',
+                    ''.join('%d,' % x for x in exon_starts),
+                    ''.join('%d,' % x for x in exon_ends)]) + '\n')
+    return (circ_f, ref_f, genome_fa)
+
+
+def write_mapping(map_dir, circ_f, seed, num=800):
+    '''
+    TopHat folder with junctions between exons of circRNAs (and random
+    ones sharing their splice sites) and spliced reads around them
+    '''
+    rand = random.Random(seed)
+    map_dir.mkdir()
+    circ = load_circ(circ_f)
+    introns = []
+    for n in range(len(circ)):
+        exons = circ.exons(n)
+        for i in range(len(exons) - 1):
+            if exons[i + 1][0] > exons[i][1] and rand.random() < 0.8:
+                introns.append((circ.chrom[n], exons[i][1], exons[i + 1][0]))
+    for chrom, sta, end in list(introns):
+        if rand.random() < 0.3:  # alternative splice sites
+            introns.append((chrom, sta, end + rand.randint(1, 50)))
+    with open(str(map_dir / 'junctions.bed'), 'w') as f:
+        f.write('track name=junctions\n')
+        for n, (chrom, sta, end) in enumerate(introns):
+            f.write('%s\t%d\t%d\tJUNC%d\t%d\t+\t%d\t%d\t255,0,0\t2\t'
+                    '10,10\t0,%d\n' % (chrom, sta - 10, end + 10, n,
+                                       rand.randint(1, 20), sta - 10,
+                                       end + 10, end - sta + 10))
+    header = {'HD': {'VN': '1.0', 'SO': 'coordinate'},
+              'SQ': [{'SN': chrom, 'LN': length}
+                     for chrom, length in CHROMS]}
+    reads = []
+    for n in range(num):
+        read = pysam.AlignedSegment()
+        read.query_name = 'r%d' % n
+        read.reference_id = rand.randint(0, len(CHROMS) - 1)
+        read.reference_start = rand.randint(0, CHROMS[-1][1] - 200)
+        if rand.random() < 0.5:
+            read.cigartuples = [(0, 25), (3, rand.randint(1, 100)), (0, 25)]
+        else:
+            read.cigartuples = [(0, 50)]
+        read.query_sequence = 'A' * 50
+        reads.append(read)
+    reads.sort(key=lambda x: (x.reference_id, x.reference_start))
+    bam_f = str(map_dir / 'accepted_hits.bam')
+    with pysam.AlignmentFile(bam_f, 'wb', header=header) as f:
+        for read in reads:
+            f.write(read)
+    pysam.index(bam_f)
+    return str(map_dir)
+
+
+def run_analyses(out_dir, denovo_dir, genome_fa, tophat_dir, pAplus_dir,
+                 thread):
+    '''
+    AS and ABS analyses scheduled as denovo does
+    '''
+    as_dir, abs_dir = out_dir / 'as', out_dir / 'abs'
+    as_dir.mkdir(parents=True)
+    abs_dir.mkdir()
+    analyses = [
+        ('CE', denovo.extract_cassette_exon,
+         (denovo_dir, tophat_dir, pAplus_dir, str(as_dir), True)),
+        ('RI', denovo.extract_retained_intron,
+         (denovo_dir, tophat_dir, pAplus_dir, str(as_dir))),
+        ('ASS', denovo.parse_splice_site,
+         (denovo_dir, tophat_dir, pAplus_dir, str(as_dir))),
+        ('ABS', denovo.analyze_abs, (denovo_dir, genome_fa, str(abs_dir)))]
+    load_junctions(tophat_dir + '/junctions.bed')
+    load_junctions(pAplus_dir + '/junctions.bed')
+    load_circ(denovo_dir + '/circularRNA_full.txt')
+    names = [name for name, _ in pool_map(denovo.run_analysis, analyses,
+                                          min(thread, len(analyses)))]
+    assert names == ['CE', 'RI', 'ASS', 'ABS']
+    outputs = {}
+    for name in ('all_exon_info.txt', 'all_intron_info.txt',
+                 'all_A5SS_info.txt', 'all_A3SS_info.txt'):
+        outputs[name] = (as_dir / name).read_text()
+    for name in ('a5bs.txt', 'a3bs.txt'):
+        outputs[name] = (abs_dir / name).read_text()
+    return outputs
+
+
+def baseline_novel_circ(circ_f, ref_path):
+    '''
+    extract_novel_circ with circularRNA_full.txt parsed line by line
+    '''
+    all_circ = {}
+    with open(circ_f, 'r') as f:
+        for line in f:
+            if line.split()[13] == 'ciRNA':
+                continue
+            circ_id = '\t'.join(line.split()[:6])
+            iso = line.split()[14]
+            if circ_id not in all_circ or \
+               all_circ[circ_id].startswith('CUFF'):
+                all_circ[circ_id] = iso
+    ref_left, ref_right = set(), set()
+    with open(ref_path, 'r') as ref_f:
+        for line in ref_f:
+            chrom = line.split()[2]
+            for x in line.split()[9].rstrip(',').split(','):
+                ref_left.add('\t'.join([chrom, x]))
+            for x in line.split()[10].rstrip(',').split(','):
+                ref_right.add('\t'.join([chrom, x]))
+    novel, annotated = [], []
+    for circ_id in all_circ:
+        if all_circ[circ_id].startswith('CUFF'):
+            chrom, start, end = circ_id.split()[:3]
+            flags = ['Annotated' if '\t'.join([chrom, x]) in ref else 'Novel'
+                     for x, ref in ((start, ref_left), (end, ref_right))]
+            novel.append('\t'.join([circ_id] + flags) + '\n')
+        else:
+            annotated.append('\t'.join([circ_id, all_circ[circ_id]]) + '\n')
+    return (''.join(novel), ''.join(annotated))
+
+
+def baseline_abs(circ_f, genome_fa):
+    '''
+    analyze_abs with circularRNA_full.txt parsed line by line, strands
+    fetched per circRNA and sites keyed by strings
+    '''
+    fa = pysam.FastaFile(genome_fa)
+    main_circ, all_circ = set(), set()
+    site5, site3 = defaultdict(int), defaultdict(int)
+    with open(circ_f, 'r') as f:
+        for line in f:
+            chrom, start, end, name, _, strand = line.split()[:6]
+            read = name.split('/')[1]
+            if line.split()[14].startswith('CUFF'):
+                left = fa.fetch(chrom, int(start) - 2, int(start)).upper()
+                right = fa.fetch(chrom, int(end), int(end) + 2).upper()
+                if left == 'AG' or right == 'GT':
+                    strand = '+'
+                elif left == 'AC' or right == 'CT':
+                    strand = '-'
+            circ_id = '\t'.join([chrom, start, end, read, strand])
+            if circ_id in all_circ:
+                continue
+            all_circ.add(circ_id)
+            if float(line.split()[12]) >= 0.1:
+                main_circ.add(circ_id)
+            left_id, right_id = chrom + '\t' + start, chrom + '\t' + end
+            if strand == '+':
+                site3[left_id] += int(read)
+                site5[right_id] += int(read)
+            else:
+                site3[right_id] += int(read)
+                site5[left_id] += int(read)
+    fa.close()
+    a5bs, a3bs = [], []
+    site3_set, site5_set = set(), set()
+    for main in (True, False):
+        for circ in all_circ:
+            if (circ in main_circ) != main:
+                continue
+            chrom, start, end, read, strand = circ.split()
+            left_id, right_id = chrom + '\t' + start, chrom + '\t' + end
+            if strand == '+':
+                site3_id, site5_id = left_id, right_id
+            else:
+                site3_id, site5_id = right_id, left_id
+            if main:
+                site3_set.add(site3_id)
+                site5_set.add(site5_id)
+            site3_pci = int(read) * 1.0 / site3[site3_id]
+            site5_pci = int(read) * 1.0 / site5[site5_id]
+            info = '%s\t%s\t%s\t%s\t' % (chrom, start, end, strand)
+            if (main or site3_id in site3_set) and site3_pci < 1.0:
+                a5bs.append(info + '%s\t%d\t%f\n' % (site3_id,
+                                                     site3[site3_id],
+                                                     site3_pci))
+            if (main or site5_id in site5_set) and site5_pci < 1.0:
+                a3bs.append(info + '%s\t%d\t%f\n' % (site5_id,
+                                                     site5[site5_id],
+                                                     site5_pci))
+    return (a5bs, a3bs)
+
+
+def test_circ_table_matches_lines(tmp_path):
+    circ_f = write_fixture(tmp_path, 0)[0]
+    circ = load_circ(circ_f)
+    with open(circ_f, 'r') as f:
+        lines = [line.split() for line in f]
+    assert len(circ) == len(lines)
+    for n, info in enumerate(lines):
+        assert [circ.chrom[n], circ.start[n], circ.end[n], circ.name[n],
+                circ.score[n], circ.strand[n], circ.reads[n], circ.type[n],
+                circ.gene[n], circ.iso[n]] == \
+            [info[0], int(info[1]), int(info[2]), info[3], int(info[4]),
+             info[5], int(info[12])] + info[13:16]
+        assert [circ.start_list[n], circ.end_list[n], circ.score_list[n],
+                circ.reads_list[n]] == [int(x) for x in info[1:3] +
+                                        info[4:5] + info[12:13]]
+        starts = [int(info[1]) + int(x) for x in info[11].split(',')]
+        sizes = [int(x) for x in info[10].split(',')]
+        assert circ.exons(n) == [[s, s + x] for s, x in zip(starts, sizes)]
+
+
+def test_novel_circ_matches_baseline(tmp_path):
+    for seed in range(3):
+        (tmp_path / str(seed)).mkdir()
+        circ_f, ref_f, _ = write_fixture(tmp_path / str(seed), seed)
+        novel, annotated = baseline_novel_circ(circ_f, ref_f)
+        assert novel and annotated
+        denovo.extract_novel_circ(str(tmp_path / str(seed)), ref_f)
+        assert (tmp_path / str(seed) / 'novel_circ.txt').read_text() == novel
+        assert (tmp_path / str(seed) / 'annotated_circ.txt').read_text() == \
+            annotated
+
+
+def test_abs_matches_baseline(tmp_path):
+    for seed in range(3):
+        denovo_dir = tmp_path / str(seed)
+        denovo_dir.mkdir()
+        circ_f, _, genome_fa = write_fixture(denovo_dir, seed)
+        a5bs, a3bs = baseline_abs(circ_f, genome_fa)
+        assert a5bs and a3bs
+        denovo.analyze_abs(str(denovo_dir), genome_fa, str(denovo_dir))
+        # baseline writes circRNAs of each expression class in set order
+        for name, expected in (('a5bs.txt', a5bs), ('a3bs.txt', a3bs)):
+            out = (denovo_dir / name).read_text().splitlines(True)
+            assert sorted(out) == sorted(expected)
+
+
+def test_analyses_threads_match_serial(tmp_path):
+    circ_f, _, genome_fa = write_fixture(tmp_path, 1)
+    tophat_dir = write_mapping(tmp_path / 'tophat', circ_f, 1)
+    pAplus_dir = write_mapping(tmp_path / 'pAplus', circ_f, 2)
+    serial = run_analyses(tmp_path / 'serial', str(tmp_path), genome_fa,
+                          tophat_dir, pAplus_dir, 1)
+    assert all(serial.values())
+    assert run_analyses(tmp_path / 'pool', str(tmp_path), genome_fa,
+                        tophat_dir, pAplus_dir, 4) == serial
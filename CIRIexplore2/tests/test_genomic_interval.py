@@ -0,0 +1,73 @@
+'''
+Overlap of padded gene blocks with junctions
+'''
+
+import copy
+import random
+from genomic_interval import Interval
+from interval_array import IntervalArray
+
+
+def pop_map(index, interval):
+    '''
+    Fragments attached to index by popping and re-inserting list heads
+    '''
+    tmp_fragment = []
+    if not interval:
+        return index
+    for dex in index:
+        while True:
+            try:
+                fragment = interval.pop(0)
+            except IndexError:
+                if tmp_fragment:
+                    interval.extend(tmp_fragment)
+                    tmp_fragment = []
+                    break
+                else:
+                    return index
+            if fragment[0] < dex[0]:
+                continue
+            elif fragment[0] >= dex[1]:
+                interval.insert(0, fragment)
+                interval[0:0] = tmp_fragment
+                tmp_fragment = []
+                break
+            elif fragment[1] > dex[1]:
+                tmp_fragment.append(fragment)
+                continue
+            else:
+                dex += fragment[2:]
+    return index
+
+
+def pop_overlapwith(index, interval):
+    tmp1 = sorted([int(i[0]) - 11, int(i[1]) + 11] + i[2:] for i in index)
+    tmp2 = sorted([int(i[0]), int(i[1])] + i[2:] for i in interval)
+    return pop_map(tmp1, tmp2)
+
+
+def random_case(rand):
+    blocks = []
+    for n in range(rand.randint(0, 12)):
+        sta = rand.randint(0, 2000)
+        blocks.append([sta, sta + rand.randint(1, 300), 'gene%d' % n])
+    blocks = Interval(blocks).interval
+    fusions = []
+    for n in range(rand.randint(0, 40)):
+        sta = rand.randint(-20, 2100)
+        fusions.append([sta, sta + rand.randint(1, 400), 'fusion%d' % n])
+    return blocks, fusions
+
+
+def test_overlapwith_matches_pop_map():
+    rand = random.Random(0)
+    for _ in range(500):
+        blocks, fusions = random_case(rand)
+        expected = pop_overlapwith(copy.deepcopy(blocks),
+                                   copy.deepcopy(fusions))
+        # fragments keep their sorted order within each gene block
+        assert Interval.overlapwith(copy.deepcopy(blocks),
+                                    copy.deepcopy(fusions)) == expected
+        assert IntervalArray.overlapwith(IntervalArray(blocks),
+                                         copy.deepcopy(fusions)) == expected
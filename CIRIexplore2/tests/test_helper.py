@@ -0,0 +1,88 @@
+'''
+Junction to isoform mapping
+'''
+
+import random
+from helper import map_fusion_to_iso, map_block, convert_to_bed
+
+
+def scan_fusion_to_iso(start, end, strand, iso_info):
+    '''
+    Exon boundaries matched by scanning the +/-10bp windows
+    '''
+    starts, ends = iso_info
+    start_points = list(range(start - 10, start + 11))
+    end_points = list(range(end - 10, end + 11))
+    start_index, end_index = None, None
+    start_intron_flag, end_intron_flag = False, False
+    for i, s in enumerate(starts):
+        if s in start_points:
+            start_index = i
+            break
+    else:
+        for j, e in enumerate(ends):
+            if e in start_points and j != len(ends) - 1:
+                start_index = j
+                start_intron_flag = True
+                break
+    for j, e in enumerate(ends):
+        if e in end_points:
+            end_index = j
+            break
+    else:
+        for i, s in enumerate(starts):
+            if s in end_points and i != 0:
+                end_index = i - 1
+                end_intron_flag = True
+                break
+    if start_intron_flag and strand == '+' and end < starts[start_index + 1]:
+        return ('\t'.join(['1', str(end - start), '0', 'ciRNA']),
+                str(start_index), False, None)
+    elif end_intron_flag and strand == '-' and start > ends[end_index]:
+        return ('\t'.join(['1', str(end - start), '0', 'ciRNA']),
+                str(end_index), False, None)
+    elif (start_index is not None and end_index is not None and
+          not start_intron_flag and not end_intron_flag):
+        edge_flag = start_index == 0 or end_index == len(ends) - 1
+        return (convert_to_bed(start, end, starts[start_index:end_index + 1],
+                               ends[start_index:end_index + 1]),
+                '%d,%d' % (start_index, end_index), edge_flag, None)
+    elif start_index is not None or end_index is not None:
+        return (None, None, False, [start_index, end_index])
+    else:
+        return (None, None, False, None)
+
+
+def test_map_fusion_to_iso_matches_scan():
+    rand = random.Random(0)
+    for _ in range(300):
+        starts, ends = [], []
+        pos = rand.randint(0, 50)
+        for _ in range(rand.randint(1, 6)):
+            starts.append(pos)
+            ends.append(pos + rand.randint(1, 40))
+            pos = ends[-1] + rand.randint(1, 40)
+        strand = rand.choice('+-')
+        for _ in range(30):
+            start = rand.randint(0, pos)
+            end = rand.randint(start + 1, pos + 20)
+            assert (map_fusion_to_iso(start, end, strand, [starts, ends]) ==
+                    scan_fusion_to_iso(start, end, strand, [starts, ends]))
+
+
+def test_map_block_matches_map_fusion_to_iso():
+    rand = random.Random(1)
+    for _ in range(300):
+        starts, ends = [], []
+        pos = rand.randint(0, 50)
+        for _ in range(rand.randint(1, 6)):
+            starts.append(pos)
+            ends.append(pos + rand.randint(1, 40))
+            pos = ends[-1] + rand.randint(1, 40)
+        strand = rand.choice('+-')
+        fus_starts = [rand.randint(0, pos) for _ in range(30)]
+        fus_ends = [rand.randint(x + 1, pos + 20) for x in fus_starts]
+        expected = [map_fusion_to_iso(x, y, strand, [starts, ends])
+                    for x, y in zip(fus_starts, fus_ends)]
+        assert map_block(fus_starts, fus_ends, strand,
+                         [starts, ends]) == expected
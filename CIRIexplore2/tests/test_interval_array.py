@@ -0,0 +1,65 @@
+'''
+IntervalArray against the list-based Interval
+'''
+
+import copy
+import random
+from genomic_interval import Interval
+from interval_array import IntervalArray
+
+
+def random_intervals(rand, num, name):
+    tmp = []
+    for n in range(rand.randint(0, num)):
+        sta = rand.randint(0, 300)
+        # zero-length intervals included
+        tmp.append([sta, sta + rand.choice([0, 0, 1, 5, 20, 60]),
+                    '%s%d' % (name, n)])
+    return tmp
+
+
+def test_mul_matches_interval():
+    rand = random.Random(0)
+    for _ in range(1000):
+        a = random_intervals(rand, 10, 'a')
+        b = random_intervals(rand, 10, 'b')
+        for real_flag in (1, 0):
+            expected = Interval.__mul__(Interval(copy.deepcopy(a)),
+                                        copy.deepcopy(b), real_flag)
+            result = IntervalArray(a).__mul__(b, real_flag)
+            assert result.interval == expected.interval
+        if not a or not b:
+            continue
+        expected = Interval(copy.deepcopy(a)) - copy.deepcopy(b)
+        assert (IntervalArray(a) - b).interval == expected.interval
+
+
+def test_overlapwith_matches_interval():
+    rand = random.Random(1)
+    for _ in range(1000):
+        index = random_intervals(rand, 8, 'gene')
+        fusions = random_intervals(rand, 20, 'fusion')
+        expected = Interval.overlapwith(Interval(copy.deepcopy(index))
+                                        .interval, copy.deepcopy(fusions))
+        assert IntervalArray.overlapwith(IntervalArray(index),
+                                         fusions) == expected
+
+
+def test_overlapjoin_matches_overlapwith():
+    rand = random.Random(2)
+    for _ in range(1000):
+        index = random_intervals(rand, 8, 'gene')
+        fusions = random_intervals(rand, 20, 'fusion')
+        merged = Interval(copy.deepcopy(index)).interval
+        expected = Interval.overlapwith(copy.deepcopy(merged),
+                                        copy.deepcopy(fusions))
+        pairs = list(IntervalArray.overlapjoin(IntervalArray(index),
+                                               fusions))
+        assert pairs == list(Interval.overlapjoin(copy.deepcopy(merged),
+                                                  copy.deepcopy(fusions)))
+        # fusions joined with each index in the order of overlapwith
+        padded = [[i[0] - 11, i[1] + 11] + i[2:] for i in merged]
+        result = copy.deepcopy(padded)
+        for block, fusion in pairs:
+            result[padded.index(block)] += fusion[2:]
+        assert result == expected
@@ -0,0 +1,87 @@
+'''
+Integer junction graph against string-keyed junction dicts
+'''
+
+import random
+from collections import defaultdict
+from junction_graph import JunctionGraph
+from helper import fetch_psi
+
+
+def string_junc(junc_f, flag=0):
+    '''
+    Junction dicts keyed by tab-joined strings, one pass per flag
+    '''
+    junc = defaultdict(int)
+    if flag == 1:
+        left_junc = defaultdict(list)
+        right_junc = defaultdict(list)
+    elif flag == 2:
+        left_junc = defaultdict(int)
+        right_junc = defaultdict(int)
+    with open(junc_f, 'r') as f:
+        f.readline()  # skip header
+        for line in f:
+            line_info = line.split()
+            chrom = line_info[0]
+            start = int(line_info[1])
+            reads = int(line_info[4])
+            left = str(start + int(line_info[10].split(',')[0]))
+            right = str(start + int(line_info[11].split(',')[1]))
+            junc['\t'.join([chrom, left, right])] += reads
+            if flag == 1:
+                left_junc['\t'.join([chrom, left])].append([right, reads])
+                right_junc['\t'.join([chrom, right])].append([left, reads])
+            elif flag == 2:
+                left_junc['\t'.join([chrom, left])] += reads
+                right_junc['\t'.join([chrom, right])] += reads
+    if flag:
+        return (junc, left_junc, right_junc)
+    return junc
+
+
+def write_junctions(junc_f, seed):
+    rand = random.Random(seed)
+    sites = sorted(rand.sample(range(100, 3000), 40))
+    lines = ['track name=junctions description="TopHat junctions"\n']
+    for n in range(300):
+        chrom = rand.choice(['chr1', 'chr2'])
+        left, right = sorted(rand.sample(sites, 2))
+        size1, size2 = rand.randint(1, 50), rand.randint(1, 50)
+        start = left - size1
+        lines.append('\t'.join([chrom, str(start), str(right + size2),
+                                'JUNC%08d' % n, str(rand.randint(1, 30)),
+                                rand.choice('+-'), str(start),
+                                str(right + size2), '255,0,0', '2',
+                                '%d,%d' % (size1, size2),
+                                '0,%d' % (right - start)]) + '\n')
+    with open(junc_f, 'w') as f:
+        f.write(''.join(lines))
+    return sites
+
+
+def test_graph_matches_string_junctions(tmp_path):
+    junc_f = str(tmp_path / 'junctions.bed')
+    for seed in range(3):
+        sites = write_junctions(junc_f, seed)
+        graph = JunctionGraph(junc_f)
+        for flag in (0, 1, 2):
+            assert graph.as_flag(flag) == string_junc(junc_f, flag)
+        junc, left_junc, right_junc = string_junc(junc_f, 1)
+        rand = random.Random(seed)
+        for _ in range(300):
+            chrom = rand.choice(['chr1', 'chr2', 'chr3'])
+            start, end = sorted(rand.sample(sites, 2))
+            exon = '%s\t%d\t%d' % (chrom, start, end)
+            psi = graph.psi(chrom, start, end)
+            max_left, max_right = psi[3:]
+            assert psi[:3] + tuple('None' if x is None else str(x)
+                                   for x in psi[3:]) == \
+                fetch_psi(exon, junc, left_junc, right_junc)
+            if max_left is None:
+                continue
+            for left, right in ((max_left, max_right),
+                                tuple(sorted(rand.sample(sites, 2)))):
+                assert graph.psi(chrom, start, end, [left, right]) == \
+                    fetch_psi(exon, junc, left_junc, right_junc,
+                              [str(left), str(right)])
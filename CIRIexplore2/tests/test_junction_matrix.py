@@ -0,0 +1,42 @@
+'''
+Junction count matrix against summing the BED files
+'''
+
+import random
+from collections import defaultdict
+from junction_matrix import JunctionMatrix
+
+
+def test_matrix_matches_summed_beds(tmp_path):
+    rand = random.Random(0)
+    samples = ['s%d' % n for n in range(5)]
+    beds, expected = [], defaultdict(lambda: [0] * len(samples))
+    for n, sample in enumerate(samples):
+        bed = str(tmp_path / ('%s.bed' % sample))
+        with open(bed, 'w') as f:
+            # the last sample without junctions
+            for i in range(rand.randint(0, 200) if n < 4 else 0):
+                chrom = rand.choice(['chr1', 'chr2', 'chr10', 'chrX'])
+                sta = rand.randint(0, 100)
+                end = sta + rand.randint(1, 50)
+                reads = rand.randint(1, 20)
+                # duplicated junctions of one sample are summed
+                f.write('%s\t%d\t%d\tFUSIONJUNC_%d/%d\t0\t+\n' % (
+                    chrom, sta, end, i, reads))
+                expected[(chrom, sta, end)][n] += reads
+        beds.append(bed)
+    matrix = JunctionMatrix.from_beds(beds, samples)
+    npz_file = str(tmp_path / 'matrix.npz')
+    matrix.save(npz_file)
+    tsv_file = str(tmp_path / 'matrix.tsv')
+    JunctionMatrix.load(npz_file).to_tsv(tsv_file)
+    with open(tsv_file) as f:
+        lines = [x.rstrip('\n').split('\t') for x in f]
+    assert lines[0] == ['chrom', 'start', 'end'] + samples
+    result = {(x[0], int(x[1]), int(x[2])): [int(y) for y in x[3:]]
+              for x in lines[1:]}
+    assert len(result) == len(lines) - 1
+    assert result == dict(expected)
+    # shared junction index sorted by (chrom, start, end)
+    keys = [(x[0], int(x[1]), int(x[2])) for x in lines[1:]]
+    assert keys == sorted(keys)
@@ -0,0 +1,213 @@
+'''
+Junction parsing of aligner outputs
+'''
+
+import random
+from collections import defaultdict
+import pysam
+import chunk_reader
+import parse
+from parser import Segment
+
+HEADER = ('chr_donorA\tbrkpt_donorA\tstrand_donorA\tchr_acceptorB\t'
+          'brkpt_acceptorB\tstrand_acceptorB\tjunction_type\n')
+ROWS = ['chr1\t200\t+\tchr1\t100\t+\t1\n',
+        'chr1\t100\t-\tchr1\t200\t-\t0\n',
+        'chr1\t200\t+\tchr1\t100\t+\t-1\n',
+        'chr1\t200\t+\tchr2\t100\t+\t1\n',
+        'chr2\t300\t+\tchr2\t150\t+\t2\n']
+
+
+def test_star_parse_skips_headers_inside_chunks(tmp_path, monkeypatch):
+    # headers of concatenated samples and trailing comments
+    lines = [HEADER] + ROWS + [HEADER] + ROWS + ['# STAR --chimOutType\n']
+    (tmp_path / 'Chimeric.out.junction').write_text(''.join(lines))
+    (tmp_path / 'plain.junction').write_text(''.join(ROWS + ROWS))
+    parse.star_parse(str(tmp_path / 'plain.junction'),
+                     str(tmp_path / 'plain.bed'))
+    expected = (tmp_path / 'plain.bed').read_text()
+    assert expected.splitlines() == ['chr1\t100\t199\tFUSIONJUNC_0/4\t0\t+',
+                                     'chr2\t150\t299\tFUSIONJUNC_1/2\t0\t+']
+    for chunk_lines in (1, 3, 1000000):
+        monkeypatch.setattr(parse, 'read_chunks',
+                            lambda f, n, **kwargs: chunk_reader.read_chunks(
+                                f, n, chunk_lines, **kwargs))
+        parse.star_parse(str(tmp_path / 'Chimeric.out.junction'),
+                         str(tmp_path / 'out.bed'))
+        assert (tmp_path / 'out.bed').read_text() == expected
+
+
+def serial_bwa_junctions(fusion):
+    '''
+    BWA junction counts of one read loop building Segment for every SA
+    '''
+    fusions = defaultdict(int)
+    sam = pysam.AlignmentFile(fusion, 'r')
+    for read in sam:
+        if read.is_unmapped or read.is_supplementary:
+            continue
+        if not read.has_tag('SA'):
+            continue
+        chr1 = sam.get_reference_name(read.reference_id)
+        strand1 = '+' if not read.is_reverse else '-'
+        segments = [[read.query_alignment_start, read.query_alignment_end,
+                     read.reference_start, read.reference_end]]
+        for sa in read.get_tag('SA').split(';')[:-1]:
+            chr2, pos, strand2, cigar = sa.split(',')[:4]
+            if chr1 != chr2 or strand1 != strand2:
+                continue
+            segment = Segment(pos=pos, cigar=cigar)
+            segments.append([segment.read_start, segment.read_end,
+                             segment.ref_start, segment.ref_end])
+        segments.sort()
+        cov_loc, ref_loc = segments[0][1], segments[0][3]
+        bflag = 0
+        for seg in segments[1:]:
+            if seg[2] < ref_loc and seg[0] <= cov_loc:
+                bflag += 1
+                cigar_l, cigar_r, ref_l, ref_r = (seg[0], cov_loc, seg[2],
+                                                  ref_loc)
+            cov_loc, ref_loc = seg[1], seg[3]
+        if bflag == 1:
+            fusions['%s\t%d\t%d' % (chr1, ref_l,
+                                     ref_r - (cigar_r - cigar_l))] += 1
+    sam.close()
+    return ''.join('%s\tFUSIONJUNC_%d/%d\t0\t+\n' % (pos, i, fusions[pos])
+                   for i, pos in enumerate(fusions))
+
+
+def write_bwa_sam(sam_f, seed):
+    rand = random.Random(seed)
+    chroms = ['chr1', 'chr2']
+    lines = ['@HD\tVN:1.0\tSO:coordinate'] + \
+        ['@SQ\tSN:%s\tLN:1000000' % c for c in chroms]
+    records = []
+    for n in range(2000):
+        chrom = rand.choice(chroms)
+        pos, split = rand.randint(1000, 900000), rand.randint(20, 80)
+        reverse = rand.random() < 0.5
+        flag = (16 if reverse else 0) | (4 if rand.random() < 0.02 else 0)
+        cigar = '%s%dS%dM%s2M' % (rand.choice(['', '3H']), split,
+                                  98 - split, rand.choice(['', '2I', '2D']))
+        if rand.random() < 0.1:
+            cigar = '100M'
+        tags = []
+        if rand.random() < 0.7:
+            sa = ''
+            for _ in range(rand.choice([1, 1, 2])):
+                sa_chrom = chrom if rand.random() < 0.9 else rand.choice(
+                    chroms)
+                sa_strand = '-+'[(rand.random() < 0.9) != reverse]
+                sa += '%s,%d,%s,%s%dM%s%dS,60,0;' % (
+                    sa_chrom, pos + rand.randint(200, 20000) *
+                    rand.choice([1, -1]), sa_strand,
+                    rand.choice(['', '5H', '%dS' % split]), split,
+                    rand.choice(['', '3I']), 100 - split)
+            tags.append('SA:Z:' + sa)
+        records.append((chroms.index(chrom), pos, '\t'.join(
+            ['r%d' % n, str(flag), chrom, str(pos), '60', cigar, '*', '0',
+             '0', '*', '*'] + tags)))
+        if rand.random() < 0.3:  # supplementary alignment
+            records.append((chroms.index(chrom), pos + 5, '\t'.join(
+                ['r%ds' % n, str(2048 | flag), chrom, str(pos + 5), '60',
+                 '50M50S', '*', '0', '0', '*', '*',
+                 'SA:Z:%s,%d,+,50M,60,0;' % (chrom, pos)])))
+    records.sort()
+    with open(sam_f, 'w') as f:
+        f.write('\n'.join(lines + [x[2] for x in records]) + '\n')
+
+
+def test_bwa_parse_matches_serial(tmp_path):
+    sam_f = str(tmp_path / 'bwa.sam')
+    bam_f = str(tmp_path / 'bwa.bam')
+    write_bwa_sam(sam_f, 0)
+    pysam.view('-b', '-o', bam_f, sam_f, catch_stdout=False)
+    pysam.index(bam_f)
+    expected = serial_bwa_junctions(sam_f)
+    assert expected
+    for fusion in (sam_f, bam_f):
+        for thread in (1, 3):
+            parse.bwa_parse(fusion, str(tmp_path / 'out.bed'), thread)
+            assert (tmp_path / 'out.bed').read_text() == expected
+
+
+def write_fusion_bam(bam_f, seed, plain_flag, no_xp_flag):
+    '''
+    TopHat-Fusion style BAM, plus ordinary reads without XF tag when
+    plain_flag is set and fusion reads without XP tag when no_xp_flag is set
+    '''
+    rand = random.Random(seed)
+    extra = random.Random(seed + 1)
+    header = {'HD': {'VN': '1.0', 'SO': 'coordinate'},
+              'SQ': [{'SN': 'chr%d' % i, 'LN': 200000} for i in (1, 2, 3)]}
+    reads = []
+
+    def add_read(name, chrom_id, pos, flag, tags):
+        read = pysam.AlignedSegment()
+        read.query_name = name
+        read.reference_id = chrom_id
+        read.reference_start = pos
+        read.cigarstring = '30M'
+        read.query_sequence = 'A' * 30
+        read.flag = flag
+        for tag, value in tags:
+            read.set_tag(tag, value)
+        reads.append(read)
+
+    for n in range(1000):
+        chrom_id = rand.randint(0, 2)
+        chrom = 'chr%d' % (chrom_id + 1)
+        other = chrom if rand.random() < 0.9 else 'chr%d' % (
+            (chrom_id + 1) % 3 + 1)
+        sta, length = rand.randint(0, 190000), rand.randint(100, 5000)
+        reverse = rand.random() < 0.5
+        for pos in (sta, sta + length):
+            flag = 16 if reverse != (rand.random() < 0.05) else 0
+            flag |= 256 if rand.random() < 0.03 else 0
+            add_read('r%d' % n, chrom_id, pos, flag,
+                     [('XF', '1 %s-%s 1 2 A' % (chrom, other)),
+                      ('XP', '%s %d 20M' % (chrom, pos +
+                                            rand.randint(-100, 100)))])
+        pos = extra.randint(0, 190000)
+        if plain_flag:
+            add_read('p%d' % n, chrom_id, pos, 16 if pos % 2 else 0, [])
+        if no_xp_flag and pos % 3 == 0:
+            for k in range(2):
+                add_read('x%d' % n, chrom_id, pos + 500 * k, 0,
+                         [('XF', '1 %s-%s 1 2 A' % (chrom, chrom))])
+    reads.sort(key=lambda x: (x.reference_id, x.reference_start))
+    with pysam.AlignmentFile(bam_f, 'wb', header=header) as f:
+        for read in reads:
+            f.write(read)
+    pysam.index(bam_f)
+
+
+def test_tophat_fusion_parse_skips_plain_reads(tmp_path):
+    mixed_f = str(tmp_path / 'mixed.bam')
+    write_fusion_bam(mixed_f, 0, True, True)
+    for pair_flag in (False, True):
+        # reads without XP tag are fusion reads of single-end data
+        fusion_f = str(tmp_path / ('fusion%d.bam' % pair_flag))
+        write_fusion_bam(fusion_f, 0, False, not pair_flag)
+        parse.tophat_fusion_parse(fusion_f, str(tmp_path / 'fusion.bed'),
+                                  pair_flag, 1, None)
+        expected = (tmp_path / 'fusion.bed').read_text()
+        assert expected
+        # bounded window and whole chromosomes
+        for window in (parse.WINDOW, None):
+            parse.tophat_fusion_parse(mixed_f, str(tmp_path / 'out.bed'),
+                                      pair_flag, 1, window)
+            assert (tmp_path / 'out.bed').read_text() == expected
+
+
+def test_tophat_fusion_threads_match_serial(tmp_path):
+    mixed_f = str(tmp_path / 'mixed.bam')
+    write_fusion_bam(mixed_f, 1, True, True)
+    for pair_flag in (False, True):
+        parse.tophat_fusion_parse(mixed_f, str(tmp_path / 'serial.bed'),
+                                  pair_flag, 1)
+        expected = (tmp_path / 'serial.bed').read_text()
+        assert expected
+        parse.tophat_fusion_parse(mixed_f, str(tmp_path / 'out.bed'),
+                                  pair_flag, 3)
+        assert (tmp_path / 'out.bed').read_text() == expected
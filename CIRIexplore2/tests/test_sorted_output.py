@@ -0,0 +1,48 @@
+'''
+External merge sort of BED-like outputs against sort
+'''
+
+import os
+import random
+import subprocess
+import pysam
+from sorted_output import sort_bed, index_bed
+
+
+def write_bed(bed_f, seed, num=500):
+    rand = random.Random(seed)
+    with open(bed_f, 'w') as f:
+        for n in range(num):
+            chrom = rand.choice(['chr1', 'chr2', 'chr10', 'chrX', 'chr1_gl'])
+            sta = rand.choice([rand.randint(0, 30), rand.randint(0, 100000)])
+            end = sta + rand.choice([1, 2, rand.randint(1, 5000)])
+            f.write('%s\t%d\t%d\tFUSIONJUNC_%d/%d\t0\t+\n' % (
+                chrom, sta, end, n, rand.randint(1, 9)))
+
+
+def test_sort_bed_matches_sort(tmp_path):
+    bed_f = str(tmp_path / 'junction.bed')
+    write_bed(bed_f, 0)
+    # stable sort keeps lines with the same coordinates in input order
+    expected = subprocess.check_output(
+        ['sort', '-s', '-k1,1', '-k2,2n', '-k3,3n', bed_f],
+        env=dict(os.environ, LC_ALL='C')).decode()
+    for buffer_lines in (7, 100, 1000000):  # several runs and one run
+        out_f = str(tmp_path / ('sorted%d.bed' % buffer_lines))
+        sort_bed(bed_f, out_f, buffer_lines)
+        with open(out_f) as f:
+            assert f.read() == expected
+
+
+def test_index_bed_fetches_regions(tmp_path):
+    bed_f = str(tmp_path / 'junction.bed')
+    write_bed(bed_f, 1)
+    with open(bed_f) as f:
+        lines = [x.rstrip('\n').split('\t') for x in f]
+    tabix = pysam.TabixFile(index_bed(bed_f, buffer_lines=50))
+    for chrom, sta, end in (('chr1', 0, 50), ('chr2', 1000, 60000),
+                            ('chrX', 0, 200000)):
+        expected = sorted('\t'.join(x) for x in lines if x[0] == chrom and
+                          int(x[1]) < end and int(x[2]) > sta)
+        assert sorted(tabix.fetch(chrom, sta, end)) == expected
+    tabix.close()
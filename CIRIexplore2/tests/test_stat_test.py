@@ -0,0 +1,37 @@
+'''
+Batch statistical tests against scipy one table at a time
+'''
+
+import random
+import numpy as np
+from scipy.stats import fisher_exact, binom
+from stat_test import fisher_exact_batch, binom_cdf_batch
+
+
+def test_fisher_exact_batch_matches_scipy():
+    rand = random.Random(0)
+    # low counts with shared and empty rows or columns
+    tables = [[rand.choice([0, 0, 1, 2, 5, rand.randint(0, 300)])
+               for _ in range(4)] for _ in range(500)]
+    p_greater, p_less = fisher_exact_batch(tables)
+    for n, (a, b, c, d) in enumerate(tables):
+        for p, alternative in ((p_greater, 'greater'), (p_less, 'less')):
+            expected = fisher_exact([[a, b], [c, d]], alternative)[1]
+            assert np.isclose(p[n], expected, rtol=1e-9, atol=1e-12)
+    p_greater, p_less = fisher_exact_batch([])
+    assert len(p_greater) == len(p_less) == 0
+
+
+def test_binom_cdf_batch_matches_scipy():
+    rand = random.Random(1)
+    k, n = [], []
+    for _ in range(500):
+        n.append(rand.choice([0, 1, 3, rand.randint(0, 500)]) +
+                 rand.choice([0, 0, 0.5]))  # mean coverage is a float
+        k.append(rand.choice([0, n[-1], rand.uniform(0, n[-1])]))
+    p = 1 / 3.5
+    result = binom_cdf_batch(k, n, p)
+    for x, y, z in zip(k, n, result):
+        assert np.isclose(z, binom.cdf(x, y, p), rtol=1e-9, atol=1e-12,
+                          equal_nan=True)
+    assert len(binom_cdf_batch([], [], p)) == 0
@@ -0,0 +1,78 @@
+'''
+2-bit genome store against pysam FastaFile
+'''
+
+import random
+import numpy as np
+import pysam
+import twobit
+from twobit import load_genome
+from helper import check_seq, fetch_anchor
+
+
+def write_genome(tmp_path, seed):
+    rand = random.Random(seed)
+    fa_file = str(tmp_path / 'genome.fa')
+    with open(fa_file, 'w') as f:
+        for chrom in ('chr1', 'chr2', 'chrM'):
+            length = rand.randint(1, 500)
+            seq = ''.join(rand.choice('ACGTACGTacgtNNnRYrykMSWBDHV')
+                          for _ in range(length))
+            f.write('>%s description\n' % chrom)
+            for i in range(0, length, 60):
+                f.write(seq[i:(i + 60)] + '\n')
+    return fa_file
+
+
+def test_fetch_matches_fasta(tmp_path):
+    for seed in range(5):
+        (tmp_path / str(seed)).mkdir()
+        fa_file = write_genome(tmp_path / str(seed), seed)
+        fa = pysam.FastaFile(fa_file)
+        genome = load_genome(fa_file)
+        rand = random.Random(seed)
+        for chrom, length in zip(fa.references, fa.lengths):
+            assert genome.get_reference_length(chrom) == length
+            assert genome.fetch(chrom) == fa.fetch(chrom).upper()
+            for _ in range(200):
+                start = rand.randint(0, length)
+                end = rand.randint(start, length)
+                assert (genome.fetch(chrom, start, end) ==
+                        fa.fetch(chrom, start, end).upper())
+                for strand in '+-':
+                    assert (fetch_anchor(genome, chrom, start, end, strand) ==
+                            fetch_anchor(fa, chrom, start, end, strand))
+            positions = np.arange(-3, length + 3)
+            expected = [fa.fetch(chrom, x, x + 1).upper() or 'N'
+                        if x >= 0 else 'N' for x in positions.tolist()]
+            assert genome.bases(chrom, positions).tobytes().decode() == \
+                ''.join(expected)
+        fa.close()
+
+
+def test_check_seq_keeps_iupac_codes(tmp_path):
+    fa_file = str(tmp_path / 'genome.fa')
+    with open(fa_file, 'w') as f:
+        f.write('>chr1\nACGTRRACGTYYACGTnnACGTNN\n')
+    fa = pysam.FastaFile(fa_file)
+    genome = load_genome(fa_file)
+    for pos in ([4, 6, 10, 12], [4, 6, 16, 18], [16, 18, 22, 24],
+                [0, 4, 6, 10]):
+        assert check_seq('chr1', pos, genome) == check_seq('chr1', pos, fa)
+    assert not check_seq('chr1', [4, 6, 10, 12], genome)
+    assert check_seq('chr1', [16, 18, 22, 24], genome)
+
+
+def test_blocks_match_whole_chromosome(tmp_path, monkeypatch):
+    fa_file = write_genome(tmp_path, 5)
+    expected = load_genome(fa_file)
+    for block in (4, 8, 60, 64):
+        monkeypatch.setattr(twobit, 'BLOCK', block)
+        store_dir = str(tmp_path / ('store%d' % block))
+        twobit.TwoBitGenome.build(fa_file, store_dir)
+        genome = twobit.TwoBitGenome(store_dir)
+        for name in ('packed', 'n_start', 'n_end', 'n_base'):
+            assert np.array_equal(getattr(genome, name),
+                                  getattr(expected, name))
+        for chrom in expected.references:
+            assert genome.fetch(chrom) == expected.fetch(chrom)
@@ -0,0 +1,73 @@
+'''
+Cached CIGAR decoding against per-string decoding
+'''
+
+import random
+from itertools import groupby
+import pysam
+from parser import Segment, decode_cigar, decode_cigars, decode_alignment
+
+
+def uncached_segment(pos, cigar):
+    '''
+    (read_start, read_end, ref_start, ref_end) of Segment decoding CIGAR
+    with groupby for every call
+    '''
+    ref_start = ref_end = int(pos) - 1
+    read_start, read_end = 0, 0
+    cig_iter = groupby(cigar, lambda c: c.isdigit())
+    for i, (g, n) in enumerate(cig_iter):
+        counts, tag = int(''.join(n)), ''.join(next(cig_iter)[1])
+        if i == 0 and tag == 'S':
+            read_start += counts
+            read_end += counts
+        if tag in ('M', 'I'):
+            read_end += counts
+        if tag in ('M', 'D'):
+            ref_end += counts
+    return (read_start, read_end, ref_start, ref_end)
+
+
+def random_cigar(rand):
+    cigar = []
+    if rand.random() < 0.3:
+        cigar.append('%dH' % rand.randint(1, 20))
+    if rand.random() < 0.5:
+        cigar.append('%dS' % rand.randint(1, 50))
+    cigar.append('%dM' % rand.randint(1, 100))
+    for _ in range(rand.randint(0, 3)):
+        cigar.append('%d%s' % (rand.randint(1, 500), rand.choice('IDN')))
+        cigar.append('%dM' % rand.randint(1, 100))
+    if rand.random() < 0.5:
+        cigar.append('%dS' % rand.randint(1, 50))
+    return ''.join(cigar)
+
+
+def test_decode_cigar_matches_uncached():
+    rand = random.Random(0)
+    # recurrent CIGAR strings are served from the cache
+    cigars = [random_cigar(rand) for _ in range(300)] * 3
+    rand.shuffle(cigars)
+    for cigar in cigars:
+        pos = rand.randint(1, 100000)
+        segment = Segment(pos=str(pos), cigar=cigar)
+        assert (segment.read_start, segment.read_end, segment.ref_start,
+                segment.ref_end) == uncached_segment(pos, cigar)
+    assert decode_cigar.cache_info().hits > 0
+    read_start, read_end, ref_span = decode_cigars(cigars)
+    assert list(zip(read_start.tolist(), read_end.tolist(),
+                    ref_span.tolist())) == [decode_cigar(x) for x in cigars]
+    assert [len(x) for x in decode_cigars([])] == [0, 0, 0]
+
+
+def test_decode_alignment_matches_pysam():
+    rand = random.Random(1)
+    for _ in range(500):
+        read = pysam.AlignedSegment()
+        read.reference_start = rand.randint(0, 100000)
+        read.cigarstring = random_cigar(rand)
+        read.query_sequence = 'A' * read.infer_query_length()
+        read_start, read_end, ref_span = decode_alignment(read.cigarstring)
+        assert read_start == read.query_alignment_start
+        assert read_end == read.query_alignment_end
+        assert read.reference_start + ref_span == read.reference_end
@@ -0,0 +1,225 @@
+'''
+twobit.py
+Memory-mapped 2-bit genome store with the FastaFile fetch interface
+'''
+
+import os
+import os.path
+import json
+import shutil
+import numpy as np
+from file_func import fingerprint
+
+__all__ = ['TwoBitGenome', 'load_genome']
+
+# A/C/G/T -> 0/1/2/3, the other bases are saved as A and masked with their
+# uppercased codes (N, R, Y, ...)
+ENCODE = np.zeros(256, np.uint8)
+NMASK = np.ones(256, np.bool_)
+for code, base in enumerate('ACGT'):
+    for b in (base, base.lower()):
+        ENCODE[ord(b)] = code
+        NMASK[ord(b)] = False
+UPPER = np.arange(256, dtype=np.uint8)
+UPPER[ord('a'):(ord('z') + 1)] -= 32
+# each byte -> its four uppercased bases
+DECODE = np.array([[ord('ACGT'[(x >> s) & 3]) for s in (6, 4, 2, 0)]
+                   for x in range(256)], np.uint8)
+# only A/C/G/T are complemented, just as fetch_anchor does
+COMPLEMENT = np.arange(256, dtype=np.uint8)
+for a, b in zip('ACGT', 'TGCA'):
+    COMPLEMENT[ord(a)] = ord(b)
+# bases packed at a time, a multiple of 4 to start blocks at byte boundaries
+BLOCK = 1 << 22
+
+
+class TwoBitGenome(object):
+    '''
+    Class: TwoBitGenome
+
+    Usage: fa = load_genome(fa_file)
+           fa.fetch(chrom, start, end) -> uppercased sequence
+           fa.fetch(chrom, start, end, '-') -> reverse complement
+    Notes: every chromosome is packed 4 bases per byte from a byte
+           boundary into one file, and runs of the same non-ACGT base are
+           kept as mask intervals with the base. All are memory-mapped, so
+           that a fetch is a memory read instead of a faidx seek.
+    '''
+    def __init__(self, store_dir):
+        with open('%s/meta.json' % store_dir, 'r') as f:
+            meta = json.load(f)
+        self.chroms = meta['chroms']
+        self.fingerprint = meta['fingerprint']
+        self.references = meta['references']
+        self.lengths = [self.chroms[c][1] for c in self.references]
+        self.packed = np.memmap('%s/packed.bin' % store_dir, np.uint8, 'r')
+        self.n_start = np.load('%s/n_start.npy' % store_dir, mmap_mode='r')
+        self.n_end = np.load('%s/n_end.npy' % store_dir, mmap_mode='r')
+        self.n_base = np.load('%s/n_base.npy' % store_dir, mmap_mode='r')
+
+    @staticmethod
+    def build(fa_file, store_dir):
+        '''
+        Usage: TwoBitGenome.build(fa_file, store_dir)
+        pack FASTA file into store_dir.
+        '''
+        tmp_dir = store_dir + '.tmp%d' % os.getpid()
+        os.mkdir(tmp_dir)
+        chroms = {}
+        references = []
+        n_start, n_end, n_base = [], [], []
+        with open('%s/packed.bin' % tmp_dir, 'wb') as packed_f:
+            for chrom, blocks in read_fasta(fa_file, BLOCK):
+                offset = packed_f.tell()
+                length, last = 0, np.uint8(0)
+                edges, values = [], []
+                for seq in blocks:
+                    seq = np.frombuffer(seq, np.uint8)
+                    # uppercased non-ACGT bases, 0 for A/C/G/T
+                    mask = np.where(NMASK[seq], UPPER[seq], np.uint8(0))
+                    # a run of the same mask starts wherever it changes
+                    edge = np.flatnonzero(np.diff(mask, prepend=last))
+                    edges.append(edge + length)
+                    values.append(mask[edge])
+                    last = mask[-1]
+                    # 2-bit packing, only the last block is padded
+                    code = ENCODE[seq]
+                    if len(code) % 4:
+                        code = np.append(code, np.zeros(4 - len(code) % 4,
+                                                        np.uint8))
+                    code = code.reshape(-1, 4)
+                    packed = (code[:, 0] << 6) | (code[:, 1] << 4) | \
+                        (code[:, 2] << 2) | code[:, 3]
+                    packed_f.write(packed.astype(np.uint8).tobytes())
+                    length += len(seq)
+                # mask intervals of the same non-ACGT base
+                edge = np.concatenate(edges or [np.zeros(0, np.int64)])
+                value = np.concatenate(values or [np.zeros(0, np.uint8)])
+                run = value != 0
+                n_lo = sum(len(x) for x in n_start)
+                n_start.append(edge[run])
+                n_end.append(np.append(edge[1:], length)[run])
+                n_base.append(value[run])
+                chroms[chrom] = [offset, length, n_lo,
+                                 n_lo + len(n_start[-1])]
+                references.append(chrom)
+        np.save('%s/n_start.npy' % tmp_dir,
+                np.concatenate(n_start or [[]]).astype(np.int64))
+        np.save('%s/n_end.npy' % tmp_dir,
+                np.concatenate(n_end or [[]]).astype(np.int64))
+        np.save('%s/n_base.npy' % tmp_dir,
+                np.concatenate(n_base or [[]]).astype(np.uint8))
+        # meta.json is written last to mark a complete store
+        with open('%s/meta.json' % tmp_dir, 'w') as f:
+            json.dump({'chroms': chroms, 'references': references,
+                       'fingerprint': fingerprint(fa_file)}, f)
+        if os.path.isdir(store_dir):
+            shutil.rmtree(store_dir)
+        os.rename(tmp_dir, store_dir)
+
+    def fetch(self, reference, start=None, end=None, strand='+'):
+        '''
+        Usage: fa.fetch(chrom, start, end, strand) -> sequence
+        fetch uppercased sequence, reverse complement on '-' strand.
+        '''
+        offset, length, n_lo, n_hi = self.chroms[reference]
+        start = 0 if start is None else max(start, 0)
+        end = length if end is None else min(end, length)
+        if start >= end:
+            return ''
+        sta = start >> 2
+        seq = DECODE[self.packed[(offset + sta):
+                                 (offset + ((end + 3) >> 2))]].ravel()
+        seq = seq[(start - 4 * sta):(end - 4 * sta)]
+        n_start = self.n_start[n_lo:n_hi]
+        i = np.searchsorted(self.n_end[n_lo:n_hi], start, 'right')
+        j = np.searchsorted(n_start, end, 'left')
+        for s, e, b in zip(n_start[i:j].tolist(),
+                           self.n_end[(n_lo + i):(n_lo + j)].tolist(),
+                           self.n_base[(n_lo + i):(n_lo + j)].tolist()):
+            seq[max(s - start, 0):(min(e, end) - start)] = b
+        if strand == '-':
+            seq = COMPLEMENT[seq[::-1]]
+        return seq.tobytes().decode('ascii')
+
+    def bases(self, reference, positions):
+        '''
+        Usage: fa.bases(chrom, positions) -> uppercased bases as uint8 array
+        fetch single bases of many positions at once, 'N' is returned for
+        positions out of the reference. Sorted positions are read in one
+        sequential sweep.
+        '''
+        offset, length, n_lo, n_hi = self.chroms[reference]
+        positions = np.asarray(positions, np.int64)
+        inside = (positions >= 0) & (positions < length)
+        pos = np.where(inside, positions, 0)
+        packed = self.packed[offset + (pos >> 2)].astype(np.int64)
+        seq = DECODE[packed, pos & 3]
+        n_end = self.n_end[n_lo:n_hi]
+        i = np.searchsorted(n_end, pos, 'right')
+        masked = np.zeros(len(pos), np.bool_)
+        hit = i < len(n_end)
+        masked[hit] = self.n_start[n_lo:n_hi][i[hit]] <= pos[hit]
+        seq[masked] = self.n_base[n_lo:n_hi][i[masked]]
+        seq[~inside] = ord('N')
+        return seq
+
+    def get_reference_length(self, reference):
+        return self.chroms[reference][1]
+
+    def close(self):
+        pass
+
+
+def read_fasta(fa_file, block_size):
+    '''
+    Yield (chrom, sequence blocks) from FASTA file, blocks of block_size
+    bytes (the last one may be shorter) are read while they are iterated
+    '''
+    with open(fa_file, 'rb') as f:
+        header = [None]  # header line of the next chrom
+
+        def blocks():
+            seq, size = [], 0
+            for line in f:
+                if line.startswith(b'>'):
+                    header[0] = line
+                    break
+                seq.append(line.rstrip())
+                size += len(seq[-1])
+                while size >= block_size:
+                    seq = b''.join(seq)
+                    yield seq[:block_size]
+                    seq = [seq[block_size:]]
+                    size -= block_size
+            if size:
+                yield b''.join(seq)
+
+        for line in f:
+            if line.startswith(b'>'):
+                header[0] = line
+                break
+        while header[0] is not None:
+            chrom = header[0][1:].split()[0].decode('ascii')
+            header[0] = None
+            chrom_blocks = blocks()
+            yield (chrom, chrom_blocks)
+            for _ in chrom_blocks:  # skip blocks left by the caller
+                pass
+
+
+def load_genome(fa_file):
+    '''
+    Load 2-bit genome saved next to fa_file, or pack and save it
+    '''
+    store_dir = fa_file + '.c2bit'
+    if os.path.isfile('%s/meta.json' % store_dir):
+        try:
+            genome = TwoBitGenome(store_dir)
+        except (IOError, OSError, KeyError, ValueError):
+            genome = None  # store of older version
+        if genome is not None and genome.fingerprint == fingerprint(fa_file):
+            return genome
+    print('Pack genome %s into 2-bit store...' % fa_file)
+    TwoBitGenome.build(fa_file, store_dir)
+    return TwoBitGenome(store_dir)